@@ -4,6 +4,7 @@ from __future__ import absolute_import
 import copy
 import os
 import re
+import pickle
 import sys
 import types
 import importlib
@@ -55,6 +56,10 @@ try:
 
     from . import common
     from . import debug
+    from . import lazy
+    
+    # Importing common converts env to an indexed subclass.
+    yaml.add_representer(type(env), _represent_dictorder)
     
     Satchel = common.Satchel
     ServiceSatchel = common.ServiceSatchel
@@ -75,14 +80,24 @@ try:
     debug
 except NameError:
     debug = None
+
+try:
+    lazy
+except NameError:
+    lazy = None
     
-def _get_environ_handler(name, d):
+def _get_environ_handler(name, d=None):
     """
     Dynamically creates a Fabric task for each configuration role.
+    
+    If no settings are given, they're loaded when the task is run.
     """
     
+    _d = d
+    
     def func(site=None, **kwargs):
         from fabric import state
+        d = _d if _d is not None else get_role_settings(name)
         site = site or d.get('default_site') or env.SITE
         
         BURLAP_SHELL_PREFIX = int(os.environ.get('BURLAP_SHELL_PREFIX', '0'))
@@ -113,6 +128,11 @@ def _get_environ_handler(name, d):
             env[common.SITE] = os.environ[common.SITE] = site
         env.update(d)
         
+        # Import the modules for the role's satchels, if not already loaded.
+        lazy.set_role_settings(d)
+        lazy.load_satchels(
+            list(env.services or []) + list(env.get('satchels') or []) + lazy.get_role_satchels(d))
+        
         # Load host retriever.
         retriever = None
         if env.hosts_retriever:
@@ -197,7 +217,13 @@ def find_yaml_settings_fn(name, local=False):
     if os.path.isfile(settings_fn):
         return settings_fn
 
-def load_yaml_settings(name, priors=None, verbose=0):
+def load_yaml_settings(name, priors=None, verbose=0, sources=None):
+    """
+    Parses the settings for a role, along with those of every role it inherits from.
+    
+    If sources is a list, the name of every file that was or could have been read
+    is appended to it.
+    """
     verbose = int(verbose)
     config = type(env)()
     if priors is None:
@@ -206,6 +232,10 @@ def load_yaml_settings(name, priors=None, verbose=0):
         return config
     priors.add(name)
     
+    if sources is not None:
+        sources.append(os.path.join(common.ROLE_DIR, name, 'settings.yaml'))
+        sources.append(os.path.join(common.ROLE_DIR, name, 'settings_local.yaml'))
+    
     settings_fn = find_yaml_settings_fn(name)
     if not settings_fn:
         warnings.warn('Warning: Could not find Yaml settings for role %s.' % (name,))
@@ -220,7 +250,8 @@ def load_yaml_settings(name, priors=None, verbose=0):
         parent_config = load_yaml_settings(
             parent_name,
             priors=priors,
-            verbose=verbose)
+            verbose=verbose,
+            sources=sources)
         parent_config.update(config)
         config = parent_config
     #if verbose: sys.stdout.write('sites1:'); pprint(config['sites'], indent=4)
@@ -234,6 +265,41 @@ def load_yaml_settings(name, priors=None, verbose=0):
     
     return config
 
+def _get_file_state(fn):
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+def get_role_settings(name, verbose=0):
+    """
+    Returns the settings for a role, cached in the burlap data directory
+    until any file in its inheritance chain is changed, added or removed.
+    """
+    cache_fn = os.path.join(env.burlap_data_dir, 'roles', '%s.pickle' % name)
+    try:
+        with open(cache_fn, 'rb') as fin:
+            file_states, config = pickle.load(fin)
+        if all(_get_file_state(fn) == state for fn, state in file_states):
+            return config
+    except Exception:
+        pass
+    
+    sources = []
+    config = load_yaml_settings(name, verbose=verbose, sources=sources)
+    file_states = [(fn, _get_file_state(fn)) for fn in sources]
+    try:
+        if not os.path.isdir(os.path.dirname(cache_fn)):
+            os.makedirs(os.path.dirname(cache_fn))
+        tmp_fn = '%s.%s.tmp' % (cache_fn, os.getpid())
+        with open(tmp_fn, 'wb') as fout:
+            pickle.dump((file_states, config), fout, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fn, cache_fn)
+    except (IOError, OSError) as e:
+        warnings.warn('Unable to cache settings for role %s: %s' % (name, e))
+    return config
+
 def populate_fabfile():
     """
     Automatically includes all submodules and role selectors
@@ -280,6 +346,10 @@ def populate_fabfile():
         for _module_alias in common._post_import_modules:
             exec("import %s" % _module_alias)
             locals_[_module_alias] = locals()[_module_alias]
+        
+        # Along with any that haven't been imported yet.
+        for _module_alias, _module in virtual_modules.items():
+            locals_.setdefault(_module_alias, _module)
             
 #         locals_['shell'] = debug.shell
 #         locals_['info'] = debug.info
@@ -289,8 +359,8 @@ def populate_fabfile():
         del stack
 
 def load_role_handler(name):
-    _config = load_yaml_settings(name)
-    _f = _get_environ_handler(name, _config)
+    # Settings are resolved when the role is actually used.
+    _f = _get_environ_handler(name)
     _f = WrappedCallableTask(_f, name=name)
     return _f
 
@@ -320,16 +390,31 @@ if common and not no_load:
     # Auto-import all sub-modules.
     sub_modules = {}
     sub_modules['common'] = common
+    virtual_modules = {}
     __all__ = []
-    for loader, module_name, is_pkg in  pkgutil.walk_packages(__path__):
-        if module_name in locals():
-            continue
-        if module_name.startswith('tests'):
-            continue
-        __all__.append(module_name)
-#         print('Importing: %s' % module_name, file=sys.stderr)
-        module = loader.find_module(module_name).load_module(module_name)
-        sub_modules[module_name] = module
+    _index = lazy.read_index(__path__)
+    if _index is not None:
+        # Only create placeholders, deferring each import until a task needs it.
+        _index_names = set(_['name'] for _ in _index)
+        for module_name, module in lazy.install(_index):
+            if module_name in _index_names:
+                __all__.append(module_name)
+                sub_modules[module_name] = module
+            else:
+                virtual_modules[module_name] = module
+    else:
+        for loader, module_name, is_pkg in  pkgutil.walk_packages(__path__):
+            if module_name in locals():
+                continue
+            if module_name.startswith('tests'):
+                continue
+            __all__.append(module_name)
+#             print('Importing: %s' % module_name, file=sys.stderr)
+            _before = lazy.snapshot()
+            module = loader.find_module(module_name).load_module(module_name)
+            sub_modules[module_name] = module
+            lazy.record_module(module_name, module, _before)
+        lazy.write_index(__path__)
 
     if burlap_populate_stack:
         populate_fabfile()
@@ -338,5 +423,4 @@ if common and not no_load:
     # These are useful for calling inter-sub-module functions
     # after the modules tasks are registered so task names don't get
     # mistakenly registered under the wrong module.
-    for cb in env.post_callbacks:
-        cb()
+    lazy.run_post_callbacks()
@@ -531,24 +531,20 @@ class ApacheSatchel(ServiceSatchel):
         self.get_apache_settings()
         apache_specifics = self.set_apache_specifics()
         
-        for site, site_data in iter_sites(site=site, setter=self.set_apache_site_specifics):
-            
-            site_secure = site+'_secure'
-            if site_secure not in self.genv.sites:
-                continue
-            self.set_apache_site_specifics(site_secure)
-        
-            self.sudo_or_dryrun('mkdir -p %(apache_ssl_dir)s' % self.genv)
+        with self.bundle() as bundle:
+            for site, site_data in iter_sites(site=site, setter=self.set_apache_site_specifics):
+                
+                site_secure = site+'_secure'
+                if site_secure not in self.genv.sites:
+                    continue
+                self.set_apache_site_specifics(site_secure)
             
-            if self.genv.apache_ssl:
-                for cert_type, local_cert_file, remote_cert_file in self.iter_certificates():
-                    if verbose:
-                        print('='*80)
-                        print('Installing certificate %s...' % (remote_cert_file,))
-                    self.put_or_dryrun(
-                        local_path=local_cert_file,
-                        remote_path=remote_cert_file,
-                        use_sudo=True)
+                if self.genv.apache_ssl:
+                    for cert_type, local_cert_file, remote_cert_file in self.iter_certificates():
+                        if verbose:
+                            print('='*80)
+                            print('Installing certificate %s...' % (remote_cert_file,))
+                        bundle.add(remote_cert_file, local_path=local_cert_file)
         
         self.sudo_or_dryrun('mkdir -p %(apache_ssl_dir)s' % self.genv)
         self.sudo_or_dryrun('chown -R %(apache_user)s:%(apache_group)s %(apache_ssl_dir)s' % self.genv)
@@ -601,6 +597,10 @@ class ApacheSatchel(ServiceSatchel):
             pprint(data, indent=4)
         data['available_sites'] = self.genv.available_sites
         data['available_sites_by_host'] = self.genv.available_sites_by_host
+        # Record each site's own Apache settings, so only the sites that change need reconfiguring.
+        data['sites'] = dict(
+            (site, dict((_k, _v) for _k, _v in site_data.items() if _k.startswith('apache_')))
+            for site, site_data in (self.genv.sites or {}).items())
         return data
 
     def configure_site(self, full=1, site=None, delete_old=0):
@@ -627,45 +627,51 @@ class ApacheSatchel(ServiceSatchel):
             cmd = 'rm -f %(apache_sites_enabled)s/*' % self.genv
             self.sudo_or_dryrun(cmd)
         
-        for site, site_data in iter_sites(site=site, setter=self.set_apache_site_specifics):
-            if self.verbose:
-                print('-'*80, file=sys.stderr)
-                print('Site:',site, file=sys.stderr)
-                print('-'*80, file=sys.stderr)
-            
-            # Only load site configurations that are allowed for this host.
-            if target_sites is None:
-                pass
-            else:
-                assert isinstance(target_sites, (tuple, list))
-                if site not in target_sites:
-                    continue
-            
-            if self.verbose:
-                print('env.apache_ssl_domain:', self.genv.apache_ssl_domain, file=sys.stderr)
-                print('env.apache_ssl_domain_template:', self.genv.apache_ssl_domain_template, file=sys.stderr)
-                print('env.django_settings_module:', self.genv.django_settings_module, file=sys.stderr)
-            
-    #        raw_input('enter')
-            fn = self.render_to_file('django/django.template.wsgi', verbose=verbose)
-            remote_dir = os.path.split(self.genv.apache_django_wsgi)[0]
-            cmd = 'mkdir -p %s' % remote_dir
-            self.sudo_or_dryrun(cmd)
-            
-            if self.verbose:
-                print(fn, file=sys.stderr)
-            self.put_or_dryrun(local_path=fn, remote_path=self.genv.apache_django_wsgi, use_sudo=True)
-            
-            if self.genv.apache_ssl:
-                self.genv.apache_ssl_certificates = list(self.iter_certificates())
-            
-            fn = self.render_to_file(self.env.site_template, verbose=verbose)
-            self.genv.apache_site_conf = site+'.conf'
-            self.genv.apache_site_conf_fqfn = os.path.join(self.genv.apache_sites_available, self.genv.apache_site_conf)
-            self.put_or_dryrun(local_path=fn, remote_path=self.genv.apache_site_conf_fqfn, use_sudo=True)
+        site_confs = []
+        # Send every configuration file in one transfer, before any site is enabled.
+        with self.bundle() as bundle:
+            for site, site_data in iter_sites(site=site, setter=self.set_apache_site_specifics):
+                if self.verbose:
+                    print('-'*80, file=sys.stderr)
+                    print('Site:',site, file=sys.stderr)
+                    print('-'*80, file=sys.stderr)
+                
+                # Only load site configurations that are allowed for this host.
+                if target_sites is None:
+                    pass
+                else:
+                    assert isinstance(target_sites, (tuple, list))
+                    if site not in target_sites:
+                        continue
+                
+                if self.verbose:
+                    print('env.apache_ssl_domain:', self.genv.apache_ssl_domain, file=sys.stderr)
+                    print('env.apache_ssl_domain_template:', self.genv.apache_ssl_domain_template, file=sys.stderr)
+                    print('env.django_settings_module:', self.genv.django_settings_module, file=sys.stderr)
+                
+        #        raw_input('enter')
+                fn = self.render_to_file('django/django.template.wsgi', verbose=verbose)
+                if self.verbose:
+                    print(fn, file=sys.stderr)
+                bundle.add(self.genv.apache_django_wsgi, local_path=fn)
+                
+                if self.genv.apache_ssl:
+                    self.genv.apache_ssl_certificates = list(self.iter_certificates())
+                
+                fn = self.render_to_file(self.env.site_template, verbose=verbose)
+                self.genv.apache_site_conf = site+'.conf'
+                self.genv.apache_site_conf_fqfn = os.path.join(self.genv.apache_sites_available, self.genv.apache_site_conf)
+                bundle.add(self.genv.apache_site_conf_fqfn, local_path=fn)
+                site_confs.append(self.genv.apache_site_conf)
             
-            cmd = 'a2ensite %(apache_site_conf)s' % self.genv
-            self.sudo_or_dryrun(cmd)
+            if int(full):
+                # Write master Apache configuration file.
+                fn = self.render_to_file('apache/apache_httpd.template.conf', verbose=verbose)
+                bundle.add(self.genv.apache_conf, local_path=fn)
+                
+                # Write Apache listening ports configuration.
+                fn = self.render_to_file('apache/apache_ports.template.conf', verbose=verbose)
+                bundle.add(self.genv.apache_ports, local_path=fn)
         
 #         if service.is_selected(APACHE2_MODEVASIVE):
 #             configure_modevasive()
@@ -673,20 +679,16 @@ class ApacheSatchel(ServiceSatchel):
 #         if service.is_selected(APACHE2_MODSECURITY):
 #             configure_modsecurity()
         
-        for mod_enabled in self.genv.apache_mods_enabled:
-            self.genv.apache_mod_enabled = mod_enabled
-            cmd = 'a2enmod %(apache_mod_enabled)s' % self.genv
-            with settings(warn_only=True):
-                self.sudo_or_dryrun(cmd)
-            
-        if int(full):
-            # Write master Apache configuration file.
-            fn = self.render_to_file('apache/apache_httpd.template.conf', verbose=verbose)
-            self.put_or_dryrun(local_path=fn, remote_path=self.genv.apache_conf, use_sudo=True)
+        # Enabling sites and modules only creates symlinks, so do it all in one round trip.
+        with self.batch():
+            for site_conf in site_confs:
+                self.sudo_or_dryrun('a2ensite %s' % site_conf)
             
-            # Write Apache listening ports configuration.
-            fn = self.render_to_file('apache/apache_ports.template.conf', verbose=verbose)
-            self.put_or_dryrun(local_path=fn, remote_path=self.genv.apache_ports, use_sudo=True)
+            for mod_enabled in self.genv.apache_mods_enabled:
+                self.genv.apache_mod_enabled = mod_enabled
+                cmd = 'a2enmod %(apache_mod_enabled)s' % self.genv
+                with settings(warn_only=True):
+                    self.sudo_or_dryrun(cmd)
             
         #sudo_or_dryrun('mkdir -p %(apache_app_log_dir)s' % self.genv)
         #sudo_or_dryrun('chown -R %(apache_user)s:%(apache_group)s %(apache_app_log_dir)s' % self.genv)
@@ -699,9 +701,21 @@ class ApacheSatchel(ServiceSatchel):
     
         #restart()#break apache? run separately?
 
-    def configure(self):
+    def configure(self, diff=None):
             
         self.get_apache_settings()
+        
+        sites = diff.get_changed_keys('sites') if diff else None
+        if sites and set(sites).issubset(self.genv.sites) \
+        and all(path[0] == 'sites' for path in diff.paths):
+            # Only the settings of existing sites changed, so leave all the others alone.
+            for site in sorted(sites):
+                self.configure_site(full=0, site=site)
+                self.install_auth_basic_user_file(site=site)
+                if not site.endswith('_secure'):
+                    self.install_ssl(site=site)
+            return
+        
         self.configure_site(full=1, site=ALL, delete_old=1)
         
         self.install_auth_basic_user_file(site=ALL)
@@ -805,6 +819,7 @@ class ApacheMediaSatchel(Satchel):
         apache.get_apache_settings()
         
         from burlap.dj import render_remote_paths
+        from burlap.common import get_ssh_control_options
         
         apache_specifics = apache.set_apache_specifics()
         
@@ -842,7 +857,8 @@ class ApacheMediaSatchel(Satchel):
                 #with settings(warn_only=True):
                 self.sudo_or_dryrun('mkdir -p %(apache_sync_remote_path)s' % self.genv, user=self.genv.apache_user)
                 self.sudo_or_dryrun('chmod -R %(apache_tmp_chmod)s %(apache_sync_remote_path)s' % self.genv, user=self.genv.apache_user)
-                cmd = ('rsync -rvz --progress --recursive --no-p --no-g --rsh "ssh -o StrictHostKeyChecking=no -i %(key_filename)s" %(apache_sync_local_path)s %(user)s@%(host_string)s:%(apache_sync_remote_path)s') % self.genv
+                self.genv.apache_ssh_control_options = get_ssh_control_options()
+                cmd = ('rsync -rvz --progress --recursive --no-p --no-g --rsh "ssh -o StrictHostKeyChecking=no %(apache_ssh_control_options)s -i %(key_filename)s" %(apache_sync_local_path)s %(user)s@%(host_string)s:%(apache_sync_remote_path)s') % self.genv
                 self.local_or_dryrun(cmd)
                 self.sudo_or_dryrun('chown -R %(apache_user)s:%(apache_group)s %(apache_sync_remote_path)s' % self.genv)
                 
@@ -2,6 +2,10 @@ from __future__ import with_statement, print_function
 
 import os
 import re
+import atexit
+import errno
+import hashlib
+import heapq
 import sys
 import types
 import copy
@@ -15,9 +19,20 @@ import pipes
 import json
 import getpass
 import inspect
+import string
+import stat
+import fnmatch
+import pickle
 import subprocess
-from collections import namedtuple, OrderedDict
+import tarfile
+import threading
+from collections import namedtuple, OrderedDict, defaultdict
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
 from pprint import pprint
+from contextlib import contextmanager
 from datetime import date
 import six
 
@@ -37,6 +52,8 @@ from fabric.api import (
 )
 from fabric.contrib import files
 from fabric import state
+from fabric.utils import _AttributeDict, error
+from fabric.operations import _AttributeString, _prefix_commands, _prefix_env_vars
 import fabric.api
 
 from .constants import *
@@ -52,6 +69,137 @@ if hasattr(fabric.api, '_sudo'):
 
 BURLAP_COMMAND_PREFIX = int(os.environ.get('BURLAP_COMMAND_PREFIX', '1'))
 
+# Marks a key that didn't exist before a change.
+_missing = object()
+
+class NamespacedEnv(_AttributeDict):
+    """
+    Fabric's environment dictionary, extended to index its keys by namespace,
+    the part of the key before the first underscore, so a satchel can find its
+    settings without scanning every key.
+    
+    Only the global env is ever of this type. Creating a new instance, as is
+    done with `type(env)()` throughout burlap, returns a plain _AttributeDict.
+    
+    Changes can also be recorded in layers, so a temporary set of overrides,
+    such as a site's settings, can be undone without copying the whole env.
+    Mutable values are copied when a layer starts, so changing them in place is undone too.
+    """
+    
+    is_namespaced = True
+    
+    def __new__(cls, *args, **kwargs):
+        return _AttributeDict(*args, **kwargs)
+    
+    @classmethod
+    def install(cls, obj):
+        """
+        Converts an existing dictionary in-place, so all references to it see the index.
+        """
+        object.__setattr__(obj, '__class__', cls)
+        object.__setattr__(obj, '_namespaces', defaultdict(set))
+        object.__setattr__(obj, '_layers', [])
+        for k in obj:
+            obj._index_key(k)
+    
+    @staticmethod
+    def _get_namespace(k):
+        if isinstance(k, six.string_types):
+            return k.split('_', 1)[0]
+    
+    def _index_key(self, k):
+        ns = self._get_namespace(k)
+        if ns:
+            self._namespaces[ns].add(k)
+    
+    def _unindex_key(self, k):
+        ns = self._get_namespace(k)
+        if ns and ns in self._namespaces:
+            self._namespaces[ns].discard(k)
+    
+    def _journal_key(self, k):
+        if self._layers and k not in self._layers[-1]:
+            self._layers[-1][k] = dict.get(self, k, _missing)
+    
+    def namespace_keys(self, name):
+        """
+        Returns all keys starting with the given name followed by an underscore.
+        """
+        prefix = name + '_'
+        return [k for k in self._namespaces.get(name.split('_', 1)[0], ()) if k.startswith(prefix)]
+    
+    def push_layer(self):
+        """
+        Starts recording changes so they can be reverted by the matching pop_layer().
+        
+        Mutable values may be changed in place, so like save_env(), they're copied now.
+        """
+        layer = {}
+        for k, v in six.iteritems(dict(self)):
+            if isinstance(k, six.string_types) and k.startswith('_'):
+                continue
+            if isinstance(v, (dict, list, set)):
+                layer[k] = copy.deepcopy(v)
+        self._layers.append(layer)
+    
+    def pop_layer(self):
+        """
+        Reverts every key added, changed or removed since the last push_layer().
+        """
+        journal = self._layers.pop()
+        for k, v in six.iteritems(journal):
+            if v is _missing:
+                if dict.__contains__(self, k):
+                    dict.__delitem__(self, k)
+                    self._unindex_key(k)
+            else:
+                if not dict.__contains__(self, k):
+                    self._index_key(k)
+                dict.__setitem__(self, k, v)
+    
+    def __setitem__(self, k, v):
+        self._journal_key(k)
+        if k not in self:
+            self._index_key(k)
+        super(NamespacedEnv, self).__setitem__(k, v)
+    
+    def __delitem__(self, k):
+        self._journal_key(k)
+        super(NamespacedEnv, self).__delitem__(k)
+        self._unindex_key(k)
+    
+    def update(self, *args, **kwargs):
+        for k, v in six.iteritems(dict(*args, **kwargs)):
+            self[k] = v
+    
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self[k] = default
+        return self[k]
+    
+    def pop(self, k, *args):
+        if k in self:
+            self._journal_key(k)
+            self._unindex_key(k)
+        return super(NamespacedEnv, self).pop(k, *args)
+    
+    def popitem(self):
+        k, v = super(NamespacedEnv, self).popitem()
+        if self._layers and k not in self._layers[-1]:
+            self._layers[-1][k] = v
+        self._unindex_key(k)
+        return k, v
+    
+    def clear(self):
+        for k in list(self):
+            self._journal_key(k)
+        super(NamespacedEnv, self).clear()
+        self._namespaces.clear()
+
+# Guard against duplicate imports re-wrapping the environment.
+if not getattr(type(env), 'is_namespaced', False):
+    NamespacedEnv.install(env)
+
 OS = namedtuple('OS', ['type', 'distro', 'release'])
 
 ROLE_DIR = env.ROLES_DIR = 'roles'
@@ -221,6 +369,7 @@ def resolve_deployer(func_name):
     
     if '.' in func_name:
         mod_name, func_name = func_name.split('.')
+        load_satchels([mod_name])
     else:
         mod_name = 'fabfile'
         
@@ -285,15 +434,265 @@ class _EnvProxy(object):
             return super(_EnvProxy, self).__setattr__(k, v)
         env[self.satchel.env_prefix + k] = v
 
+class LayeredContext(MutableMapping):
+    """
+    A stack of dictionaries read as one, with all writes going to a new
+    dictionary on top, so a context can be extended or overridden without
+    copying, or modifying, any of the layers below it.
+    
+    Like Fabric's env, keys can also be accessed as attributes.
+    """
+    
+    def __init__(self, *layers):
+        object.__setattr__(self, '_layers', [{}] + [_ for _ in layers if _ is not None])
+        object.__setattr__(self, '_deleted', set())
+    
+    def __getitem__(self, k):
+        if k not in self._deleted:
+            for layer in self._layers:
+                if k in layer:
+                    return layer[k]
+        raise KeyError(k)
+    
+    def __setitem__(self, k, v):
+        self._layers[0][k] = v
+        self._deleted.discard(k)
+    
+    def __delitem__(self, k):
+        if k not in self:
+            raise KeyError(k)
+        self._layers[0].pop(k, None)
+        self._deleted.add(k)
+    
+    def __contains__(self, k):
+        if k in self._deleted:
+            return False
+        return any(k in layer for layer in self._layers)
+    
+    def __iter__(self):
+        seen = set(self._deleted)
+        for layer in self._layers:
+            for k in layer:
+                if k not in seen:
+                    seen.add(k)
+                    yield k
+    
+    def __len__(self):
+        return sum(1 for _ in self)
+    
+    def __getattr__(self, k):
+        if k.startswith('__'):
+            raise AttributeError(k)
+        try:
+            return self[k]
+        except KeyError:
+            raise AttributeError(k)
+    
+    def __setattr__(self, k, v):
+        self[k] = v
+    
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self._layers)
+    
+    def new_child(self, *layers):
+        """
+        Returns a new context with the given layers stacked on top of this one.
+        """
+        ctx = type(self)(*(list(layers) + self._layers))
+        ctx._deleted.update(self._deleted)
+        return ctx
+    
+    def get_overrides(self):
+        """
+        Returns the dictionary holding all values set on this context.
+        """
+        return self._layers[0]
+    
+    def copy(self):
+        return _AttributeDict(self)
+
+class NamespaceView(Mapping):
+    """
+    A read-only view of the env keys in a satchel's namespace, with the prefix removed.
+    """
+    
+    def __init__(self, name):
+        self.name = name
+        self.prefix = name + '_'
+    
+    def __getitem__(self, k):
+        return env[self.prefix + k]
+    
+    def __contains__(self, k):
+        return (self.prefix + k) in env
+    
+    def __iter__(self):
+        for k in env.namespace_keys(self.name):
+            yield k[len(self.prefix):]
+    
+    def __len__(self):
+        return len(env.namespace_keys(self.name))
+
+_formatter = string.Formatter()
+
 SATCHEL_NAME_PATTERN = re.compile(r'^[a-z][a-z0-9]*$')
 
 all_satchels = {}
 
+def load_satchels(names):
+    """
+    Ensures the modules defining the given satchels have been imported.
+    """
+    from burlap import lazy
+    lazy.load_satchels(names)
+
 def assert_valid_satchel(name):
     name = name.strip().upper()
+    load_satchels([name])
     assert name in all_satchels
     return name
 
+class BatchedCommand(object):
+    """
+    A command queued in a CommandBatch, whose output and return code are
+    filled in when the batch is flushed.
+    """
+    
+    def __init__(self, op, command, prefixed, user=None, warn_only=False):
+        self.op = op
+        self.command = command
+        self.prefixed = prefixed
+        self.user = user
+        self.warn_only = warn_only
+        self.output = None
+        self.return_code = None
+    
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+    
+    @property
+    def failed(self):
+        return self.return_code not in (0, None)
+
+class CommandBatch(object):
+    """
+    Queues remote commands that don't depend on each other's output, so
+    they can be run on the host as one script instead of one round trip each.
+    
+    Each command runs in its own subshell, and the script stops at the first
+    command that fails, unless it was queued with warn_only.
+    """
+    
+    # Options that run() and sudo() can honor inside a script.
+    supported_options = ('user', 'warn_only', 'quiet', 'dryrun')
+    
+    def __init__(self):
+        self.host_string = None
+        self.queue = []
+        self.results = []
+        self.marker = '__burlap_batch_%s__' % hashlib.md5(os.urandom(16)).hexdigest()[:12]
+    
+    def add(self, op, command, **kwargs):
+        """
+        Queues a run or sudo command, or runs it immediately if it can't be batched.
+        """
+        func = run_or_dryrun if op == 'run' else sudo_or_dryrun
+        if get_dryrun(kwargs.get('dryrun')) or set(kwargs) - set(self.supported_options):
+            # Keep commands in order by running everything queued before them.
+            self.flush()
+            return func(command, **kwargs)
+        if self.host_string != env.host_string:
+            self.flush()
+            self.host_string = env.host_string
+        cmd = BatchedCommand(
+            op=op,
+            command=command,
+            prefixed=_prefix_commands(_prefix_env_vars(command), 'remote'),
+            user=kwargs.get('user'),
+            warn_only=kwargs.get('warn_only', kwargs.get('quiet', env.warn_only)),
+        )
+        self.queue.append(cmd)
+        return cmd
+    
+    def render_script(self, cmds):
+        lines = []
+        for i, cmd in enumerate(cmds):
+            lines.extend([
+                "printf '%%s\\n' '%s:%i'" % (self.marker, i),
+                '(',
+                cmd.prefixed,
+                ')',
+                '_rc=$?',
+                "printf '\\n%%s\\n' \"%s:%i:$_rc\"" % (self.marker, i),
+            ])
+            if not cmd.warn_only:
+                lines.append('[ $_rc -eq 0 ] || exit $_rc')
+        return '\n'.join(lines)
+    
+    def parse_output(self, cmds, output):
+        """
+        Splits the script's combined output back into each command's output and return code.
+        """
+        current = None
+        buf = []
+        for line in (output or '').splitlines():
+            if line.startswith(self.marker + ':'):
+                parts = line[len(self.marker)+1:].split(':')
+                if len(parts) == 1:
+                    current = cmds[int(parts[0])]
+                    buf = []
+                elif current is not None:
+                    # Drop the newline printed in case the output didn't end with one.
+                    if buf and not buf[-1]:
+                        buf.pop()
+                    current.output = _AttributeString('\n'.join(buf))
+                    current.return_code = int(parts[1])
+                    current = None
+            elif current is not None:
+                buf.append(line)
+    
+    def flush(self):
+        """
+        Runs all queued commands, grouped into one script per consecutive run of
+        commands executed the same way, and aborts on the first failure.
+        """
+        while self.queue:
+            first = self.queue[0]
+            cmds = []
+            while self.queue and (self.queue[0].op, self.queue[0].user) == (first.op, first.user):
+                cmds.append(self.queue.pop(0))
+            self.results.extend(cmds)
+            
+            script = self.render_script(cmds)
+            kwargs = dict(user=first.user) if first.op == 'sudo' else {}
+            with settings(hide('running', 'stdout'), warn_only=True, cwd='', command_prefixes=[], path='', shell_env={}):
+                if first.op == 'sudo':
+                    ret = sudo_or_dryrun(script, **kwargs)
+                else:
+                    ret = run_or_dryrun(script)
+            self.parse_output(cmds, ret)
+            
+            for cmd in cmds:
+                if cmd.return_code is None:
+                    break
+                if state.output.running:
+                    print('%s %s: %s' % (render_command_prefix(), cmd.op, cmd.command))
+                if state.output.stdout and cmd.output:
+                    for line in cmd.output.splitlines():
+                        print('[%s] out: %s' % (env.host_string, line))
+                if cmd.failed and not cmd.warn_only:
+                    self.queue = []
+                    error('Batched command failed with exit code %s: %s' % (cmd.return_code, cmd.command), stdout=cmd.output)
+                    return
+            else:
+                continue
+            # The script stopped without any command reporting a failure.
+            self.queue = []
+            error('Batched script failed with exit code %s before running: %s' % (
+                getattr(ret, 'return_code', None), cmd.command), stdout=ret)
+            return
+
 class Renderer(object):
     """
     Base convenience wrapper around command executioners.
@@ -304,9 +703,15 @@ class Renderer(object):
     def __init__(self, obj, lenv=None):
         # Satchel instance.
         self.obj = obj
-        # Copy the environment dictionary so we don't modify the original.
-        self.lenv = type(env)(obj.lenv if lenv is None else lenv)
-        self.genv = type(env)(obj.genv)
+        # Layer over the environment dictionaries so we don't modify the originals.
+        self.lenv = LayeredContext(NamespaceView(obj.name) if lenv is None else lenv)
+        self.genv = LayeredContext(obj.genv)
+    
+    def batch(self):
+        """
+        Queues the commands issued through this renderer, see Satchel.batch().
+        """
+        return self.obj.batch()
     
     def __getattr__(self, attrname):
         
@@ -315,12 +720,13 @@ class Renderer(object):
             attrname = self.env_type
         
         if attrname in ('obj', 'lenv', 'genv', 'env_type'):
-            return super(LocalRenderer, self).__getattribute__(attrname)
+            return object.__getattribute__(self, attrname)
         
         def wrap(func):
             
             def _wrap(cmd, *args, **kwargs):
-                cmd = cmd.format(**getattr(self, self.env_type))
+                # Only look up the referenced keys, rather than flattening the context.
+                cmd = _formatter.vformat(cmd, (), getattr(self, self.env_type))
                 return func(cmd, *args, **kwargs)
             
             return _wrap
@@ -376,14 +782,15 @@ class Satchel(object):
     # These files will have their changes tracked.
     templates = []
     
+    # The CommandBatch queuing remote commands, if inside batch().
+    _batch = None
+    
     def __init__(self):
         assert self.name, 'A name must be specified.'
         self.name = self.name.strip().lower()
         
         assert SATCHEL_NAME_PATTERN.findall(self.name), 'Invalid name: %s' % self.name
         
-        self._os_version_cache = {} # {host:info}
-        
         all_satchels[self.name.upper()] = self
         
         # Global environment.
@@ -533,9 +940,9 @@ class Satchel(object):
         Returns a version of env filtered to only include the variables in our namespace.
         """
         _env = type(env)()
-        for _k, _v in six.iteritems(env):
-            if _k.startswith(self.name+'_'):
-                _env[_k[len(self.name)+1:]] = _v
+        _prefix_len = len(self.name) + 1
+        for _k in env.namespace_keys(self.name):
+            _env[_k[_prefix_len:]] = env[_k]
         return _env
     
     @property
@@ -548,10 +955,15 @@ class Satchel(object):
     
     @property
     def os_version(self):
-        hs = env.host_string
-        if hs not in self._os_version_cache:
-            self._os_version_cache[hs] = get_os_version()
-        return self._os_version_cache[hs]
+        return get_os_version()
+    
+    @property
+    def facts(self):
+        """
+        The facts about the current host, see burlap.facts.
+        """
+        from burlap.facts import get_facts
+        return get_facts()
     
     def sleep(self, seconds):
         if self.dryrun:
@@ -613,6 +1025,16 @@ class Satchel(object):
                 package_list = req_packages[pattern]
                 break
 #         print('package_list:', package_list)
+        if package_list and not self.dryrun:
+            # Skip anything already installed, checked against the host's whole inventory at once.
+            # Unlike running the package manager on every package, this doesn't upgrade installed packages,
+            # unless they're pinned to a version that isn't the one installed.
+            if os_version.distro in (UBUNTU, DEBIAN):
+                from burlap.deb import is_installed
+                package_list = [_ for _ in package_list if not is_installed(_)]
+            elif os_version.distro == FEDORA:
+                from burlap.rpm import is_installed
+                package_list = [_ for _ in package_list if not is_installed(_)]
         if package_list:
             package_list_str = ' '.join(package_list)
             if os_version.distro == UBUNTU:
@@ -659,39 +1081,90 @@ class Satchel(object):
     def render_to_file(self, *args, **kwargs):
         return render_to_file(*args, **kwargs)
     
+    @contextmanager
+    def batch(self):
+        """
+        Queues the run and sudo commands issued inside the block and runs them
+        as one remote script, per host, when the block exits or before any
+        other kind of command.
+        
+        Queued commands return a BatchedCommand, whose output is only available
+        after the batch is flushed, so only batch commands whose output isn't needed.
+        """
+        if self._batch is not None:
+            yield self._batch
+            return
+        self._batch = CommandBatch()
+        try:
+            yield self._batch
+            self._batch.flush()
+        finally:
+            self._batch = None
+    
+    def flush_batch(self):
+        if self._batch is not None:
+            self._batch.flush()
+    
     def put_or_dryrun(self, *args, **kwargs):
         warnings.warn('Use self.put() instead.', DeprecationWarning, stacklevel=2)
+        self.flush_batch()
         return put_or_dryrun(*args, **kwargs)
     
     def put(self, *args, **kwargs):
+        self.flush_batch()
         return put_or_dryrun(*args, **kwargs)
     
+    def put_if_changed(self, *args, **kwargs):
+        self.flush_batch()
+        return put_if_changed(*args, **kwargs)
+    
+    @contextmanager
+    def bundle(self, use_sudo=True):
+        """
+        Stages the files added inside the block and uploads them in one
+        transfer when the block exits, see UploadBundle.
+        
+        The remote paths uploaded are in the bundle's ``uploaded`` attribute afterwards.
+        """
+        bundle = UploadBundle(use_sudo=use_sudo)
+        yield bundle
+        self.flush_batch()
+        bundle.uploaded = bundle.upload(dryrun=self.dryrun)
+    
     def run_or_dryrun(self, *args, **kwargs):
         warnings.warn('Use self.run() instead.', DeprecationWarning, stacklevel=2)
-        return run_or_dryrun(*args, **kwargs)
+        return self.run(*args, **kwargs)
     
     def run(self, *args, **kwargs):
+        if self._batch is not None:
+            return self._batch.add('run', *args, **kwargs)
         return run_or_dryrun(*args, **kwargs)
     
     def local_or_dryrun(self, *args, **kwargs):
         warnings.warn('Use self.local() instead.', DeprecationWarning, stacklevel=2)
+        self.flush_batch()
         return local_or_dryrun(*args, **kwargs)
     
     def append(self, *args, **kwargs):
+        self.flush_batch()
         return append_or_dryrun(*args, **kwargs)
     
     def sed(self, *args, **kwargs):
+        self.flush_batch()
         return sed_or_dryrun(*args, **kwargs)
     
     def local(self, *args, **kwargs):
+        self.flush_batch()
         return local_or_dryrun(*args, **kwargs)
     
     def sudo_or_dryrun(self, *args, **kwargs):
+        if self._batch is not None:
+            return self._batch.add('sudo', *args, **kwargs)
         return sudo_or_dryrun(*args, **kwargs)
     
     def sudo(self, *args, **kwargs):
         warnings.warn('Use self.sudo() instead.', DeprecationWarning, stacklevel=2)
-        return sudo_or_dryrun(*args, **kwargs)
+        return self.sudo_or_dryrun(*args, **kwargs)
     
     def comment(self, *args):
         print('# ' + (' '.join(map(str, args))))
@@ -713,6 +1186,13 @@ class Satchel(object):
         
         return manifest
     
+    def get_tracked_paths(self):
+        """
+        Returns the local files and directories, besides its templates, that record_manifest()
+        reads, as a list of (path, exclude patterns), so a manifest is recorded again when they change.
+        """
+        return []
+    
     def configure(self):
         """
         The standard method called to apply functionality when the manifest changes.
@@ -885,7 +1365,60 @@ env.disk_usage_command = "df -H | grep -vE '^Filesystem|tmpfs|cdrom|none' | awk
 
 env.post_callbacks = []
 
-env.burlap_data_dir = '.burlap'
+env.burlap_data_dir = os.environ.get('BURLAP_DATA_DIR', '.burlap')
+
+# If true, every command run on a host is recorded to a trace file.
+env.trace_enabled = int(os.environ.get('BURLAP_TRACE', 0))
+
+env.trace_dir = '%(burlap_data_dir)s/traces'
+
+# Remembers the hash of every file fingerprinted, by its inode, size and mtime.
+env.fingerprint_cache_fn = '%(burlap_data_dir)s/fingerprints.pickle'
+
+# How many levels of subdirectories have their own hash in a fingerprint.
+env.fingerprint_depth = 1
+
+# If true, the ssh and rsync processes we spawn share one master connection per host.
+env.ssh_multiplex = int(os.environ.get('BURLAP_SSH_MULTIPLEX', 1))
+
+# Seconds an idle master connection stays open in the background.
+env.ssh_control_persist = 600
+
+# Kept short and outside the project, since socket paths are limited to ~100 characters.
+env.ssh_control_dir = os.path.join(tempfile.gettempdir(), 'burlap-ssh-%s' % getpass.getuser())
+
+env.host_lock_dir = '%(burlap_data_dir)s/locks'
+
+# If true, put_if_changed() skips files the host already has with the same content.
+env.put_skip_unchanged = 1
+
+# Compiled templates are saved here, so later runs don't have to compile them again.
+env.template_cache_dir = '%(burlap_data_dir)s/templates'
+
+# Commands that must never run at the same time on one host, such as package managers holding the dpkg lock.
+# Each pattern is anchored to the command word, so queries like dpkg-query, apt-cache or rpm -q don't match.
+env.host_lock_commands = [
+    r'(^|[;&|(]\s*|sudo\s+|\w+=\S*\s+)(apt-get|apt|aptitude|yum|dnf|opkg)(\s+-\S+(\s+[^-\s]\S*)?)*?\s+'
+    r'(install|reinstall|remove|purge|autoremove|upgrade|dist-upgrade|full-upgrade|update|downgrade|erase'
+    r'|localinstall|groupinstall|groupremove)\b',
+    r'(^|[;&|(]\s*|sudo\s+|\w+=\S*\s+)(dpkg|rpm)(\s+-\S+)*?\s+'
+    r'(-[iUFe][a-zA-Z]*|-r|-P|--install|--remove|--purge|--configure|--unpack|--upgrade|--freshen|--erase)(\s|$)',
+]
+
+# Commands known not to change the host, so running them keeps what's cached about its files.
+# Each pattern is matched against every command in a list or pipeline, after any variable assignments
+# and sudo, and a command only counts if all of them match. Anything else is assumed to change any file.
+env.read_only_commands = [
+    r'(cd|cat|test|\[|ls|stat|head|tail|grep|egrep|fgrep|wc|which|type|id|whoami|pwd|getent|uname|lsb_release'
+    r'|dpkg-query|apt-cache|readlink|realpath|df|du|ps|date|sort|uniq|cut|diff|nproc|getconf|true|false|echo|printf'
+    r'|md5sum|sha1sum|sha256sum|file)(\s|$)',
+    r'command\s+-v\s',
+    r'crontab\s+-l(\s|$)',
+    r'(dpkg\s+-[lsLS]|rpm\s+(-q|--query))(\s|$)',
+    r'systemctl\s+(status|is-active|is-enabled|is-failed|show|list-units|list-unit-files)(\s|$)',
+    r'sed(?!.*\s-(-in-place|[a-zA-Z]*i))(\s|$)',
+    r'find(?!.*\s-(delete|exec|execdir|ok|okdir|fprint|fprintf|fprint0|fls)(\s|$))(\s|$)',
+]
 
 def env_hosts_retriever(*args, **kwargs):
     data = {}
@@ -1028,7 +1561,7 @@ def local_or_dryrun(*args, **kwargs):
         cmd = args[0]
         print('[%s@localhost] local: %s' % (getpass.getuser(), cmd))
     else:
-        return local(*args, **kwargs)
+        return trace_call('local', args[0], local, *args, **kwargs)
         
 def run_or_dryrun(*args, **kwargs):
     dryrun = get_dryrun(kwargs.get('dryrun'))
@@ -1041,7 +1574,8 @@ def run_or_dryrun(*args, **kwargs):
         else:
             print(cmd)
     else:
-        return _run(*args, **kwargs)
+        with command_lock(args[0]):
+            return trace_call('run', args[0], _run, *args, **kwargs)
 
 def sudo_or_dryrun(*args, **kwargs):
     dryrun = get_dryrun(kwargs.get('dryrun'))
@@ -1054,7 +1588,8 @@ def sudo_or_dryrun(*args, **kwargs):
         else:
             print(cmd)
     else:
-        return _sudo(*args, **kwargs)
+        with command_lock(args[0]):
+            return trace_call('sudo', args[0], _sudo, *args, **kwargs)
 
 def reboot_or_dryrun(*args, **kwargs):
     from fabric.operations import reboot
@@ -1107,7 +1642,133 @@ def put_or_dryrun(**kwargs):
             
         return [real_remote_path]
     else:
-        return _put(**kwargs)
+        return trace_call('put', kwargs.get('remote_path'), _put, **kwargs)
+
+def put_if_changed(**kwargs):
+    """
+    Uploads a file like put_or_dryrun(), unless the host already has the same
+    content at the remote path.
+
+    Returns true if the file was uploaded, so callers can skip reloading
+    anything that depends on it.
+    """
+    local_path = kwargs.get('local_path')
+    remote_path = kwargs.get('remote_path')
+    if get_dryrun(kwargs.get('dryrun')) or not env.put_skip_unchanged \
+    or not remote_path or not remote_path.startswith('/') \
+    or not isinstance(local_path, six.string_types) or not os.path.isfile(local_path):
+        put_or_dryrun(**kwargs)
+        return True
+    from burlap.files import get_hash_algorithm
+    with open(local_path, 'rb') as fin:
+        digest = get_file_hash(fin, algorithm=get_hash_algorithm())
+    if get_remote_checksums([remote_path], use_sudo=kwargs.get('use_sudo', False))[remote_path] == digest:
+        if get_verbose():
+            print('Unchanged: %s' % remote_path)
+        return False
+    put_or_dryrun(**kwargs)
+    _remote_checksums[(env.host_string, remote_path)] = digest
+    return True
+
+class UploadBundle(object):
+    """
+    Stages many files for a host, then uploads them as one compressed archive
+    and unpacks it with one remote command, instead of one upload, move and
+    chown per file.
+    
+    Each file is unpacked next to its destination and then renamed over it,
+    so nothing ever sees a partially written file.
+    """
+    
+    def __init__(self, use_sudo=True):
+        self.use_sudo = use_sudo
+        self.entries = OrderedDict() # {remote path: (content, owner, group, mode)}
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def add(self, remote_path, content=None, local_path=None, owner=None, group=None, mode=None):
+        """
+        Stages a file, given either its content or a local file to read it from.
+        """
+        assert remote_path.startswith('/'), 'Remote path must be absolute: %s' % remote_path
+        assert (content is None) != (local_path is None), 'Either content or local_path must be given.'
+        if local_path is not None:
+            with open(local_path, 'rb') as fin:
+                content = fin.read()
+        elif isinstance(content, six.text_type):
+            content = content.encode('utf-8')
+        if isinstance(mode, six.string_types):
+            mode = int(mode, 8)
+        self.entries[remote_path] = (content, owner, group, mode)
+    
+    def get_staged_path(self, remote_path):
+        head, tail = os.path.split(remote_path)
+        return os.path.join(head, '.%s.burlap' % tail)
+    
+    def render_archive(self, remote_paths, fileobj):
+        with tarfile.open(fileobj=fileobj, mode='w:gz') as tar:
+            for remote_path in remote_paths:
+                content, owner, group, mode = self.entries[remote_path]
+                info = tarfile.TarInfo(self.get_staged_path(remote_path).lstrip('/'))
+                info.size = len(content)
+                info.mode = 0o644 if mode is None else mode
+                info.mtime = time.time()
+                tar.addfile(info, six.BytesIO(content))
+    
+    def render_script(self, remote_paths, archive_path):
+        lines = [
+            # Remove the archive and its private directory even if unpacking fails.
+            'trap %s EXIT' % pipes.quote('rm -rf %s' % pipes.quote(os.path.dirname(archive_path))),
+            'set -e',
+            'tar -xzf %s -C / --no-same-owner' % pipes.quote(archive_path),
+        ]
+        for remote_path in remote_paths:
+            content, owner, group, mode = self.entries[remote_path]
+            staged_path = pipes.quote(self.get_staged_path(remote_path))
+            if owner or group:
+                lines.append('chown %s:%s %s' % (owner or '', group or '', staged_path))
+            lines.append('mv -f %s %s' % (staged_path, pipes.quote(remote_path)))
+        return '\n'.join(lines)
+    
+    def upload(self, dryrun=None):
+        """
+        Uploads every staged file whose content the host doesn't already have.
+        
+        Returns the remote paths that were uploaded.
+        """
+        from burlap.files import get_hash_algorithm
+        dryrun = get_dryrun(dryrun)
+        remote_paths = list(self.entries)
+        digests = {}
+        if not dryrun and env.put_skip_unchanged and remote_paths:
+            algorithm = get_hash_algorithm()
+            digests = dict(
+                (remote_path, hashlib.new(algorithm, content).hexdigest())
+                for remote_path, (content, _, _, _) in self.entries.items())
+            remote_digests = get_remote_checksums(remote_paths, use_sudo=self.use_sudo)
+            remote_paths = [_ for _ in remote_paths if remote_digests[_] != digests[_]]
+        if not remote_paths:
+            return []
+        
+        fd, local_path = tempfile.mkstemp(suffix='.tar.gz')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                self.render_archive(remote_paths, fout)
+            # The archive may hold private keys, so only the login user may read it.
+            archive_dir = run_or_dryrun('mktemp -d /tmp/burlap-bundle.XXXXXXXXXX', dryrun=dryrun)
+            archive_dir = archive_dir.strip() if archive_dir else '/tmp/burlap-bundle.XXXXXXXXXX'
+            archive_path = '%s/bundle.tar.gz' % archive_dir
+            put_or_dryrun(local_path=local_path, remote_path=archive_path, mode=0o600, dryrun=dryrun)
+            func = sudo_or_dryrun if self.use_sudo else run_or_dryrun
+            func(self.render_script(remote_paths, archive_path), dryrun=dryrun)
+        finally:
+            os.remove(local_path)
+        
+        for remote_path in remote_paths:
+            if remote_path in digests:
+                _remote_checksums[(env.host_string, remote_path)] = digests[remote_path]
+        return remote_paths
 
 def get_or_dryrun(**kwargs):
     dryrun = get_dryrun(kwargs.get('dryrun'))
@@ -1126,13 +1787,383 @@ def get_or_dryrun(**kwargs):
         env.get_local_path = local_path
         
     else:
-        return _get(**kwargs)
+        return trace_call('get', kwargs.get('remote_path'), _get, **kwargs)
 
 def _get(*args, **kwargs):
     ret = __get(*args, **kwargs)
     env.get_local_path = ret
     return ret
 
+_trace_lock = threading.Lock()
+
+# When this invocation started.
+_start_time = time.time()
+
+# Identifies all traces written by this invocation, including forked workers,
+# and sorts by start time. The pid tells apart invocations started in the same microsecond.
+_trace_session = '%s.%06d-%s' % (
+    time.strftime('%Y%m%d-%H%M%S', time.localtime(_start_time)), _start_time % 1 * 1000000, os.getpid())
+
+# The names of the Fabric tasks currently executing, outermost first.
+_task_stack = []
+
+# Satchel methods that only forward a command, and so don't identify its origin.
+_trace_forwarders = set([
+    'run', 'sudo', 'local', 'put', 'get',
+    'run_or_dryrun', 'sudo_or_dryrun', 'local_or_dryrun', 'put_or_dryrun',
+])
+
+# The number of commands this process has run, by operation, whether or not tracing is enabled.
+command_counts = defaultdict(int) # {op: count}
+
+def push_task(name):
+    _task_stack.append(name)
+
+def pop_task():
+    if _task_stack:
+        _task_stack.pop()
+
+def get_trace_origin():
+    """
+    Returns the (satchel name, method name) that issued the current command,
+    found by walking up the stack to the first satchel method.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        obj = frame.f_locals.get('self')
+        if isinstance(obj, Satchel) and frame.f_code.co_name not in _trace_forwarders:
+            return obj.name, frame.f_code.co_name
+        frame = frame.f_back
+    return None, None
+
+def get_trace_filename():
+    return os.path.join(env.trace_dir % env, '%s-%s.jsonl' % (_trace_session, os.getpid()))
+
+def get_transfer_size(paths):
+    """
+    Returns the total size of the given local files, ignoring anything that isn't a file.
+    """
+    if isinstance(paths, six.string_types):
+        paths = [paths]
+    total = 0
+    for path in paths or []:
+        if isinstance(path, six.string_types) and os.path.isfile(path):
+            total += os.path.getsize(path)
+    return total
+
+def write_trace(record):
+    """
+    Appends a record to this process's trace file.
+    """
+    fn = get_trace_filename()
+    line = json.dumps(record, sort_keys=True) + '\n'
+    try:
+        with _trace_lock:
+            init_burlap_data_dir()
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            with open(fn, 'a') as fout:
+                fout.write(line)
+    except (IOError, OSError) as e:
+        print('Unable to write trace %s: %s' % (fn, e), file=sys.stderr)
+
+def trace_call(op, command, func, *args, **kwargs):
+    """
+    Calls func, recording how long it took and what it did if tracing is enabled.
+    """
+    command_counts[op] += 1
+    forget_changed_host_state(op, command)
+    if not env.trace_enabled:
+        return func(*args, **kwargs)
+    satchel, method = get_trace_origin()
+    ret = None
+    status = None
+    start = time.time()
+    try:
+        ret = func(*args, **kwargs)
+        status = getattr(ret, 'return_code', 0)
+        return ret
+    finally:
+        if op == 'put':
+            size = get_transfer_size(kwargs.get('local_path'))
+        elif op == 'get':
+            size = get_transfer_size(ret)
+        elif isinstance(ret, six.string_types):
+            size = len(ret)
+        else:
+            size = 0
+        write_trace(dict(
+            session=_trace_session,
+            time=start,
+            duration=round(time.time() - start, 4),
+            host='localhost' if op == 'local' else env.host_string,
+            op=op,
+            command=command if isinstance(command, six.string_types) else None,
+            satchel=satchel,
+            method=method,
+            task=_task_stack[-1] if _task_stack else None,
+            bytes=size,
+            # None means the call raised an exception.
+            status=status,
+        ))
+
+def load_traces(session='last'):
+    """
+    Returns the records from all trace files of the given session.
+    
+    The session may be 'last', for the most recent invocation, 'all', or a session name.
+    """
+    trace_dir = env.trace_dir % env
+    fns = sorted(glob.glob(os.path.join(trace_dir, '*.jsonl')))
+    if session == 'last':
+        sessions = sorted(set(os.path.basename(fn).rsplit('-', 1)[0] for fn in fns))
+        session = sessions[-1] if sessions else None
+    records = []
+    for fn in fns:
+        if session != 'all' and os.path.basename(fn).rsplit('-', 1)[0] != session:
+            continue
+        with open(fn) as fin:
+            for line in fin:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return records
+
+def aggregate_traces(records, key):
+    """
+    Groups trace records by the given key, or tuple of keys.
+    
+    Returns a list of (key value, stats) tuples, ordered by descending total duration.
+    """
+    keys = key if isinstance(key, (tuple, list)) else (key,)
+    groups = {}
+    for record in records:
+        value = tuple(record.get(_) for _ in keys)
+        value = value if len(keys) > 1 else value[0]
+        stats = groups.setdefault(value, dict(count=0, duration=0, max=0, bytes=0, failures=0))
+        stats['count'] += 1
+        stats['duration'] += record.get('duration') or 0
+        stats['max'] = max(stats['max'], record.get('duration') or 0)
+        stats['bytes'] += record.get('bytes') or 0
+        if record.get('status') != 0:
+            stats['failures'] += 1
+    return sorted(groups.items(), key=lambda o: (-o[1]['duration'], str(o[0])))
+
+# Control sockets of master connections possibly opened during this run, with the process that first used each.
+_ssh_control_paths = {} # {control path: (host string, pid)}
+
+def get_ssh_control_path(host_string=None):
+    """
+    Returns the path of the control socket shared by all connections to the host.
+    """
+    from fabric.network import normalize
+    user, host, port = normalize(host_string or env.host_string)
+    key = '%s@%s:%s' % (user, host, port)
+    return os.path.join(env.ssh_control_dir, hashlib.md5(key.encode('utf-8')).hexdigest()[:16])
+
+def get_ssh_control_options(host_string=None):
+    """
+    Returns the ssh options that route a connection through the host's shared
+    master connection, starting the master on first use.
+    
+    Fabric's own connections use paramiko and are unaffected.
+    """
+    if not env.ssh_multiplex:
+        return ''
+    host_string = host_string or env.host_string
+    path = get_ssh_control_path(host_string)
+    if not get_dryrun():
+        if not os.path.isdir(env.ssh_control_dir):
+            try:
+                os.makedirs(env.ssh_control_dir, 0o700)
+            except OSError as e:
+                # Another process, such as a parallel worker, may have just created it.
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                os.chmod(env.ssh_control_dir, 0o700)
+        _ssh_control_paths.setdefault(path, (host_string, os.getpid()))
+    return '-o ControlMaster=auto -o ControlPath=%s -o ControlPersist=%s' % (path, env.ssh_control_persist)
+
+@atexit.register
+def close_ssh_masters():
+    """
+    Shuts down any master connections opened during this run.
+    
+    Forked workers inherit the connections of their parent, which are left for the parent to close.
+    """
+    from fabric.network import normalize
+    while _ssh_control_paths:
+        path, (host_string, pid) = _ssh_control_paths.popitem()
+        if pid != os.getpid() or not os.path.exists(path):
+            continue
+        user, host, _ = normalize(host_string)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(
+                ['ssh', '-o', 'ControlPath=%s' % path, '-O', 'exit', '%s@%s' % (user, host)],
+                stdout=devnull, stderr=devnull)
+
+# Attributes of remote paths looked up by burlap.files.stat_many(), kept until burlap changes the host.
+_remote_stats = {} # {(host string, use_sudo): {path: attributes}}
+
+def get_remote_stats(use_sudo=False, host_string=None):
+    return _remote_stats.setdefault((host_string or env.host_string, bool(use_sudo)), {})
+
+def invalidate_remote_stats(paths=None, host_string=None):
+    """
+    Forgets the cached attributes of the given remote paths, or of every path
+    on the host, after they may have changed.
+    """
+    host_string = host_string or env.host_string
+    for key in list(_remote_stats):
+        if key[0] != host_string:
+            continue
+        if paths is None:
+            del _remote_stats[key]
+        else:
+            for path in paths:
+                _remote_stats[key].pop(path, None)
+    if paths is not None:
+        forget_remote_checksums(paths, host_string=host_string)
+
+# SHA-256 hashes of remote files, kept for the run since only burlap is expected to change the files it uploads.
+_remote_checksums = {} # {(host string, path): sha256 or None}
+
+def get_remote_checksums(paths, use_sudo=False):
+    """
+    Returns the hash of each remote file, or None if it doesn't exist, using the
+    algorithm burlap.files.get_hash_algorithm() reports for the host.
+
+    Uncached files are all hashed with one remote command.
+    """
+    from burlap.files import checksums
+    host_string = env.host_string
+    missing = [_ for _ in paths if (host_string, _) not in _remote_checksums]
+    if missing:
+        for path, digest in checksums(missing, use_sudo=use_sudo).items():
+            _remote_checksums[(host_string, path)] = digest
+    return dict((_, _remote_checksums[(host_string, _)]) for _ in paths)
+
+def forget_remote_checksums(paths=None, command=None, host_string=None):
+    """
+    Forgets the cached hashes of the given remote files, or of every file on
+    the host.
+
+    If a command is given, every hash is forgotten unless it's known to be
+    read-only, since the files it changes can't be told from its text.
+    """
+    host_string = host_string or env.host_string
+    if command is not None and is_read_only_command(command):
+        return
+    for key in list(_remote_checksums):
+        if key[0] != host_string:
+            continue
+        if paths is None or key[1] in paths:
+            del _remote_checksums[key]
+
+# Packages installed on each host, as listed by burlap.deb or burlap.rpm, kept until a package manager runs there.
+_installed_packages = {} # {host string: {name: version}}
+
+def forget_installed_packages(command=None, host_string=None):
+    """
+    Forgets the packages installed on the host, if the given command may have
+    changed them, or unconditionally if no command is given.
+    """
+    if command is None or is_host_lock_command(command):
+        _installed_packages.pop(host_string or env.host_string, None)
+
+def is_read_only_command(command):
+    """
+    Returns true if every command in the given shell command matches one of
+    env.read_only_commands, and none of them redirect output to a file.
+    """
+    if not command or re.search(r'`|\$\(|>(?!\s*/dev/null|&\d)', command):
+        return False
+    for part in re.split(r'\|\||&&|[;|&\n]', command):
+        part = re.sub(r'^(\s*(\w+=\S*|sudo(\s+-\S+)*)\s+)*', '', part.strip())
+        if part and not any(re.match(pattern, part) for pattern in env.read_only_commands):
+            return False
+    return True
+
+def forget_changed_host_state(op, command, host_string=None):
+    """
+    Forgets what's cached about the host that the given operation may have changed.
+
+    Uploads may change the directory they're put into, and other commands
+    may change any file, unless they're known to be read-only.
+    """
+    if op == 'get' or (op != 'put' and is_read_only_command(command)):
+        return
+    invalidate_remote_stats(host_string=host_string)
+    if op == 'put':
+        forget_remote_checksums(paths=[command], host_string=host_string)
+    else:
+        forget_remote_checksums(command=command or '', host_string=host_string)
+        forget_installed_packages(command=command or '', host_string=host_string)
+
+# Host locks held by this process, so they can be re-entered.
+_host_locks = {} # {lock path: (file, depth)}
+
+@contextmanager
+def host_lock(name='default', host_string=None):
+    """
+    Holds an exclusive lock on the host, shared by every burlap process
+    running from this machine, such as parallel deployers.
+    """
+    import fcntl
+    host_string = host_string or env.host_string or 'localhost'
+    lock_dir = env.host_lock_dir % env
+    if not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir)
+    path = os.path.join(lock_dir, '%s-%s.lock' % (re.sub(r'[^a-zA-Z0-9_.@-]+', '_', host_string), name))
+    if path in _host_locks:
+        fout, depth = _host_locks[path]
+        _host_locks[path] = (fout, depth + 1)
+    else:
+        fout = open(path, 'a')
+        fcntl.flock(fout, fcntl.LOCK_EX)
+        _host_locks[path] = (fout, 1)
+    try:
+        yield
+    finally:
+        fout, depth = _host_locks[path]
+        if depth > 1:
+            _host_locks[path] = (fout, depth - 1)
+        else:
+            del _host_locks[path]
+            fcntl.flock(fout, fcntl.LOCK_UN)
+            fout.close()
+
+def is_host_lock_command(command):
+    """
+    Returns true if the command matches one of env.host_lock_commands.
+    """
+    return any(re.search(pattern, command or '') for pattern in env.host_lock_commands)
+
+@contextmanager
+def command_lock(command):
+    """
+    Holds the host's lock while running a command matching env.host_lock_commands.
+    """
+    if is_host_lock_command(command):
+        with host_lock('commands'):
+            yield
+    else:
+        yield
+
+def percentile(values, percent):
+    """
+    Returns the value below which the given percent of the values fall,
+    interpolating between the nearest two.
+    """
+    values = sorted(values)
+    if not values:
+        return
+    k = (len(values) - 1) * percent / 100.
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
 def pretty_bytes(bytes):
     """
     Scales a byte count to the largest scale with a small whole number
@@ -1149,33 +2180,240 @@ def pretty_bytes(bytes):
             return sign*bytes, x
         bytes /= 1024.0
 
-def get_component_settings(prefixes=[]):
+def get_component_settings(prefixes=None):
     """
     Returns a subset of the env dictionary containing
     only those keys with the name prefix.
+    
+    Accepts either a single name or a list of names.
     """
+    prefixes = prefixes or []
+    if isinstance(prefixes, six.string_types):
+        prefixes = [prefixes]
     data = {}
     for name in prefixes:
         name = name.lower().strip()
-        for k in env:
-            if k.startswith('%s_' % name):
-                data[k] = env[k]
+        for k in env.namespace_keys(name):
+            data[k] = env[k]
     return data
 
+class ManifestDiff(object):
+    """
+    The differences between two manifests, as lists of the paths of nested keys
+    that were added, removed or changed, each path being a tuple of keys.
+    
+    Nested dictionaries are compared key by key, and anything else as a whole.
+    """
+    
+    def __init__(self, last=None, current=None):
+        self.added = []
+        self.removed = []
+        self.changed = []
+        last = {} if last is None else last
+        current = {} if current is None else current
+        if isinstance(last, dict) and isinstance(current, dict):
+            self.compare(last, current, ())
+        elif last != current:
+            self.changed.append(())
+    
+    def compare(self, last, current, path):
+        for key in sorted(set(last).union(current), key=str):
+            key_path = path + (key,)
+            if key not in last:
+                self.added.append(key_path)
+            elif key not in current:
+                self.removed.append(key_path)
+            elif isinstance(last[key], dict) and isinstance(current[key], dict):
+                self.compare(last[key], current[key], key_path)
+            elif last[key] != current[key]:
+                self.changed.append(key_path)
+    
+    @property
+    def paths(self):
+        return sorted(self.added + self.removed + self.changed, key=lambda o: tuple(map(str, o)))
+    
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+    
+    __nonzero__ = __bool__
+    
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, ', '.join('.'.join(map(str, _)) for _ in self.paths))
+    
+    def has_changed(self, *prefix):
+        """
+        Returns true if anything at or under the given keys differs.
+        """
+        return any(path[:len(prefix)] == prefix or prefix[:len(path)] == path for path in self.paths)
+    
+    def get_changed_keys(self, *prefix):
+        """
+        Returns the set of keys directly under the given keys with differences beneath them,
+        or None if the value at the given keys was replaced as a whole.
+        """
+        keys = set()
+        for path in self.paths:
+            if prefix[:len(path)] == path:
+                return None
+            if path[:len(prefix)] == prefix:
+                keys.add(path[len(prefix)])
+        return keys
+    
+    def to_dict(self):
+        return dict(
+            added=[list(_) for _ in self.added],
+            removed=[list(_) for _ in self.removed],
+            changed=[list(_) for _ in self.changed],
+        )
+    
+    @classmethod
+    def from_dict(cls, data):
+        diff = cls()
+        diff.added = [tuple(_) for _ in data.get('added', [])]
+        diff.removed = [tuple(_) for _ in data.get('removed', [])]
+        diff.changed = [tuple(_) for _ in data.get('changed', [])]
+        return diff
+
 def get_last_modified_timestamp(path):
     """
     Recursively finds the most recent timestamp in the given directory.
     """
-    cmd = 'find '+path+' -type f -printf "%T@ %p\n" | sort -n | tail -1 | cut -f 1 -d " "'
-         #'find '+path+' -type f -printf "%T@ %p\n" | sort -n | tail -1 | cut -d " " -f1
-    ret = subprocess.check_output(cmd, shell=True)
+    latest = None
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            try:
+                mtime = os.stat(os.path.join(dirpath, fn)).st_mtime
+            except OSError:
+                continue
+            latest = mtime if latest is None else max(latest, mtime)
+    if latest is None:
+        return
     # Note, we round now to avoid rounding errors later on where some formatters
     # use different decimal contexts.
-    try: 
-        ret = round(float(ret), 2)
-    except ValueError:
-        return
-    return ret
+    return round(latest, 2)
+
+_stat_cache = None # {path: (inode, size, mtime, sha1)}
+
+# The paths added, updated or removed from _stat_cache since it was last saved.
+_stat_cache_changes = set()
+
+def _read_stat_cache(fn):
+    try:
+        with open(fn, 'rb') as fin:
+            return pickle.load(fin)
+    except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return {}
+
+def _load_stat_cache():
+    global _stat_cache
+    if _stat_cache is None:
+        _stat_cache = _read_stat_cache(env.fingerprint_cache_fn % env)
+    return _stat_cache
+
+def _save_stat_cache():
+    """
+    Merges our changes into the saved cache, so processes fingerprinting
+    at the same time, like manifest recorders, don't lose each other's.
+    """
+    global _stat_cache
+    import fcntl
+    fn = env.fingerprint_cache_fn % env
+    tmp_fn = '%s.%s.tmp' % (fn, os.getpid())
+    try:
+        init_burlap_data_dir()
+        with open(fn + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cache = _read_stat_cache(fn)
+            for path in _stat_cache_changes:
+                if path in _stat_cache:
+                    cache[path] = _stat_cache[path]
+                else:
+                    cache.pop(path, None)
+            with open(tmp_fn, 'wb') as fout:
+                pickle.dump(cache, fout, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_fn, fn)
+        _stat_cache = cache
+        _stat_cache_changes.clear()
+    except (IOError, OSError) as e:
+        print('Unable to save fingerprint cache %s: %s' % (fn, e), file=sys.stderr)
+
+def get_content_fingerprint(path, exclude=None, depth=None):
+    """
+    Returns a Merkle hash of the contents of a directory tree, as a dictionary
+    of {relative directory: hash}, containing the root, '.', and each
+    subdirectory up to `depth` levels deep, so changes can be narrowed down.
+    
+    Only file contents and names count, not timestamps. Files are only re-hashed
+    when their inode, size or mtime have changed since they were last seen.
+    Files and directories are skipped if their name, or their path relative to
+    the root, matches any of the `exclude` glob patterns, as with tar --exclude.
+    """
+    depth = env.fingerprint_depth if depth is None else int(depth)
+    exclude = exclude or []
+    cache = _load_stat_cache()
+    root = os.path.abspath(path)
+    seen = set()
+    visited = set()
+    hashes = {}
+    changed = [False]
+    
+    def hash_file(fqfn, st):
+        key = (st.st_ino, st.st_size, st.st_mtime)
+        cached = cache.get(fqfn)
+        if cached and cached[:3] == key:
+            return cached[3]
+        with open(fqfn, 'rb') as fin:
+            file_hash = get_file_hash(fin)
+        cache[fqfn] = key + (file_hash,)
+        _stat_cache_changes.add(fqfn)
+        changed[0] = True
+        return file_hash
+    
+    def hash_dir(dirpath, rel, level):
+        st = os.stat(dirpath)
+        dir_key = (st.st_dev, st.st_ino)
+        # Guard against symlinks looping back up the tree.
+        if dir_key in visited:
+            return ''
+        visited.add(dir_key)
+        h = hashlib.sha1()
+        for name in sorted(os.listdir(dirpath)):
+            child_rel = os.path.join(rel, name) if rel != '.' else name
+            if any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(child_rel, pattern.strip('/'))
+                   for pattern in exclude):
+                continue
+            fqfn = os.path.join(dirpath, name)
+            try:
+                st = os.stat(fqfn)
+            except OSError:
+                # A broken symlink.
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                child_hash = hash_dir(fqfn, child_rel, level + 1)
+                h.update(('d %s %s\n' % (name, child_hash)).encode('utf-8'))
+            elif stat.S_ISREG(st.st_mode):
+                seen.add(fqfn)
+                h.update(('f %s %s\n' % (name, hash_file(fqfn, st))).encode('utf-8'))
+        visited.discard(dir_key)
+        digest = h.hexdigest()
+        if level <= depth:
+            hashes[rel] = digest
+        return digest
+    
+    if os.path.isdir(root):
+        hash_dir(root, '.', 0)
+    
+    # Forget files that were under this tree but no longer exist.
+    prefix = root + os.sep
+    for fqfn in [_ for _ in cache if _.startswith(prefix) and _ not in seen]:
+        if not os.path.isfile(fqfn):
+            del cache[fqfn]
+            _stat_cache_changes.add(fqfn)
+            changed[0] = True
+    
+    if changed[0]:
+        _save_stat_cache()
+    return hashes
 
 def check_settings_for_differences(old, new, as_bool=False, as_tri=False):
     """
@@ -1374,11 +2612,13 @@ except ImportError:
 
 def _put(**kwargs):
     local_path = kwargs['local_path']
-    fd, fn = tempfile.mkstemp()
-    if not env.is_local:
-        os.remove(fn)
-    #kwargs['remote_path'] = kwargs.get('remote_path', '/tmp/%s' % os.path.split(local_path)[-1])
-    kwargs['remote_path'] = kwargs.get('remote_path', fn)
+    if not kwargs.get('remote_path'):
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        if not env.is_local:
+            os.remove(fn)
+        #kwargs['remote_path'] = kwargs.get('remote_path', '/tmp/%s' % os.path.split(local_path)[-1])
+        kwargs['remote_path'] = fn
     env.put_remote_path = kwargs['remote_path']
     return __put(**kwargs)
 
@@ -1393,65 +2633,39 @@ def get_packager():
     """
     Returns the packager detected on the remote system.
     """
-    common_packager = get_rc('common_packager')
-    if common_packager:
-        return common_packager
-    #TODO:cache result by current env.host_string so we can handle multiple hosts with different OSes
-    with settings(warn_only=True) as a, hide('running', 'stdout', 'stderr', 'warnings') as b:
-            ret = _run('cat /etc/fedora-release')
-            if ret.succeeded:
-                common_packager = YUM
-            else:
-                ret = _run('cat /etc/lsb-release')
-                if ret.succeeded:
-                    common_packager = APT
-                else:
-                    for pn in PACKAGERS:
-                        ret = run_or_dryrun('which %s' % pn)
-                        if ret.succeeded:
-                            common_packager = pn
-                            break
+    from burlap.facts import get_fact
+    common_packager = get_fact('packager')
     if not common_packager:
         raise Exception('Unable to determine packager.')
-    set_rc('common_packager', common_packager)
     return common_packager
 
 def get_os_version():
     """
     Returns a named tuple describing the operating system on the remote host.
     """
-    common_os_version = get_rc('common_os_version')
-    if common_os_version:
-        return common_os_version
-    with settings(warn_only=True), hide('running', 'stdout', 'stderr', 'warnings'):
-        
-        ret = _run('cat /etc/lsb-release')
-        if ret.succeeded:
-            return OS(
-                type = LINUX,
-                distro = UBUNTU,
-                release = re.findall('DISTRIB_RELEASE=([0-9\.]+)', ret)[0])
-                
-        ret = _run('cat /etc/debian_version')
-        if ret.succeeded:
-            return OS(
-                type = LINUX,
-                distro = DEBIAN,
-                release = re.findall('([0-9\.]+)', ret)[0])
-    
-        ret = _run('cat /etc/fedora-release')
-        if ret.succeeded:
-            return OS(
-                type = LINUX,
-                distro = FEDORA,
-                release = re.findall('release ([0-9]+)', ret)[0])
-
+    from burlap.facts import get_fact
+    os_version = get_fact('os')
+    if not os_version:
         raise Exception('Unable to determine OS version.')
+    return OS(*os_version)
+
+_template_paths = {} # {(template dirs, template): absolute path}
+
+_jinja_env = None
+
+_compiled_templates = {} # {source sha1: jinja2.Template}
 
 def find_template(template):
     verbose = get_verbose()
+    dirs = tuple(get_template_dirs())
+    key = (dirs, template)
+    final_fqfn = _template_paths.get(key)
+    if final_fqfn and os.path.isfile(final_fqfn):
+        if verbose:
+            print('Using template: %s' % (final_fqfn,))
+        return final_fqfn
     final_fqfn = None
-    for path in get_template_dirs():
+    for path in dirs:
         if verbose:
             print('Checking: %s' % path)
         fqfn = os.path.abspath(os.path.join(path, template))
@@ -1463,41 +2677,62 @@ def find_template(template):
         else:
             if verbose:
                 print('Template not found: %s' % (fqfn,))
+    if final_fqfn:
+        _template_paths[key] = final_fqfn
     return final_fqfn
 
 def get_template_contents(template):
     final_fqfn = find_template(template)
     return open(final_fqfn).read()
 
+def get_jinja_environment():
+    """
+    Returns the Jinja2 environment shared by all rendered templates, with a bytecode cache on disk.
+    """
+    global _jinja_env
+    if _jinja_env is None:
+        from jinja2 import Environment, FileSystemBytecodeCache
+        cache_dir = env.template_cache_dir % env
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        _jinja_env = Environment(bytecode_cache=FileSystemBytecodeCache(cache_dir))
+    return _jinja_env
+
+def get_compiled_template(source, filename=None):
+    """
+    Returns the template compiled from the given source, compiling each distinct source only once.
+    """
+    source = six.text_type(source, 'utf-8') if isinstance(source, six.binary_type) else source
+    key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    t = _compiled_templates.get(key)
+    if t is None:
+        jinja_env = get_jinja_environment()
+        bcc = jinja_env.bytecode_cache
+        # The bucket is keyed by the source's hash, so it's shared by identical templates at any path.
+        bucket = bcc.get_bucket(jinja_env, key, None, source)
+        if bucket.code is None:
+            bucket.code = jinja_env.compile(source, filename=filename)
+            bcc.set_bucket(bucket)
+        t = jinja_env.template_class.from_code(jinja_env, bucket.code, jinja_env.globals)
+        _compiled_templates[key] = t
+    return t
+
 def render_to_string(template, extra=None):
     """
     Renders the given template to a string.
     """
-    #import django
-    #from django.template import Context, Template
-    #from django.template.loader import render_to_string
-    from jinja2 import Template
-    
-    extra = extra or {}
-    
     final_fqfn = find_template(template)
     assert final_fqfn, 'Template not found: %s' % template
-    #from django.conf import settings
-#     try:
-#         settings.configure()
-#     except RuntimeError:
-#         pass
-    
-    #content = render_to_string('template.txt', dict(env=env))
-    template_content = open(final_fqfn, 'r').read()
-    t = Template(template_content)
-    #c = Context(env)
-    if extra:
-        context = env.copy()
-        context.update(extra)
-    else:
-        context = env
-    rendered_content = t.render(**context)
+    with open(final_fqfn, 'r') as fin:
+        template_content = fin.read()
+    t = get_compiled_template(template_content, filename=final_fqfn)
+    # Share a layered context with Jinja2 instead of having it copy the env.
+    context = t.new_context(LayeredContext(extra, env, t.globals), shared=True)
+    try:
+        rendered_content = u''.join(t.root_render_func(context))
+    except Exception:
+        # Like Template.render(), so errors point at the template's line.
+        rendered_content = t.environment.handle_exception()
     rendered_content = rendered_content.replace('&quot;', '"')
     return rendered_content
 
@@ -1575,18 +2810,20 @@ def iter_sites(sites=None, site=None, renderer=None, setter=None, no_secure=Fals
             sites = [(site, env.sites[site])]
         
     renderer = renderer or render_remote_paths
-    env_default = save_env()
     for site, site_data in sites:
         if no_secure and site.endswith('_secure'):
             continue
-        env.update(env_default)
-        env.update(env.sites[site])
-        env.SITE = site
-        renderer()
-        if setter:
-            setter(site)
-        yield site, site_data
-    env.update(env_default)
+        # Record only the keys each site changes, instead of copying the whole env.
+        env.push_layer()
+        try:
+            env.update(env.sites[site])
+            env.SITE = site
+            renderer()
+            if setter:
+                setter(site)
+            yield site, site_data
+        finally:
+            env.pop_layer()
 
 def pc(*args):
     """
@@ -1617,38 +2854,149 @@ def get_current_hostname():
     #ret = run_or_dryrun('hostname')#)
     
     if env.host_string not in env[key]:
-        ret = _run('hostname')
-        env[key][env.host_string] = str(ret).strip()
+        from burlap.facts import get_fact
+        env[key][env.host_string] = get_fact('hostname')
         
     return env[key][env.host_string]
 
-#http://stackoverflow.com/questions/11557241/python-sorting-a-dependency-list
+class CycleError(ValueError):
+    """
+    Raised when a dependency graph has a cycle, with the names around it.
+    """
+    
+    def __init__(self, cycle):
+        self.cycle = cycle
+        super(CycleError, self).__init__(
+            'Dependency cycle detected, where each depends on the next: %s' % ' -> '.join(map(str, cycle)))
+
+class DependencyGraph(object):
+    """
+    A set of names, each depending on some others.
+    
+    Everything is computed in time linear in the number of names and dependencies,
+    and ties are always broken by name, so results are deterministic.
+    """
+    
+    def __init__(self, source=None):
+        self.dependencies = {} # {name: set(names it depends on)}
+        if isinstance(source, dict):
+            source = source.items()
+        for name, deps in source or []:
+            self.add(name, deps)
+    
+    def add(self, name, deps=None):
+        self.dependencies.setdefault(name, set()).update(deps or [])
+    
+    def get_dependents(self):
+        """
+        Returns {name: [names depending on it]}.
+        """
+        dependents = dict((name, []) for name in self.dependencies)
+        for name in sorted(self.dependencies):
+            for dep in self.dependencies[name]:
+                if dep in dependents:
+                    dependents[dep].append(name)
+        return dependents
+    
+    def find_cycle(self, names):
+        """
+        Returns a cycle among the given names, each of which depends on another of them.
+        """
+        names = set(names)
+        path = []
+        seen = {}
+        name = min(names)
+        while name not in seen:
+            seen[name] = len(path)
+            path.append(name)
+            name = min(self.dependencies[name].intersection(names))
+        return path[seen[name]:] + [name]
+    
+    def sort(self):
+        """
+        Returns all names, each after all of its dependencies, using Kahn's algorithm.
+        
+        Raises CycleError if there's a cycle, or ValueError if a dependency is unknown.
+        """
+        missing = {}
+        for name, deps in self.dependencies.items():
+            for dep in deps:
+                if dep not in self.dependencies:
+                    missing.setdefault(dep, []).append(name)
+        if missing:
+            raise ValueError('Missing dependencies: %s' % ', '.join(
+                '%s (needed by %s)' % (dep, ', '.join(map(str, sorted(names))))
+                for dep, names in sorted(missing.items())))
+        
+        dependents = self.get_dependents()
+        counts = dict((name, len(deps)) for name, deps in self.dependencies.items())
+        ready = [name for name, count in counts.items() if not count]
+        heapq.heapify(ready)
+        names = []
+        while ready:
+            name = heapq.heappop(ready)
+            names.append(name)
+            for dependent in dependents[name]:
+                counts[dependent] -= 1
+                if not counts[dependent]:
+                    heapq.heappush(ready, dependent)
+        
+        if len(names) < len(self.dependencies):
+            raise CycleError(self.find_cycle(name for name, count in counts.items() if count))
+        return names
+    
+    def levels(self):
+        """
+        Returns lists of names, where each name's dependencies are all in earlier lists,
+        so all the names in one list can be run at once.
+        """
+        level_of = {}
+        for name in self.sort():
+            level_of[name] = max([level_of[dep] + 1 for dep in self.dependencies[name]] or [0])
+        levels = [[] for _ in range(max(list(level_of.values()) + [-1]) + 1)]
+        for name in sorted(level_of):
+            levels[level_of[name]].append(name)
+        return levels
+    
+    def remaining_durations(self, durations):
+        """
+        Returns {name: the least time needed to finish it and everything depending on it},
+        given the expected time each name takes, where unknown names take no time.
+        """
+        dependents = self.get_dependents()
+        remaining = {}
+        for name in reversed(self.sort()):
+            remaining[name] = (durations.get(name) or 0) \
+                + max([remaining[_] for _ in dependents[name]] or [0])
+        return remaining
+    
+    def critical_path(self, durations):
+        """
+        Returns (seconds, [names]) for the chain of dependencies that takes the longest,
+        and so bounds how quickly everything can finish, however much is run at once.
+        """
+        if not self.dependencies:
+            return 0, []
+        dependents = self.get_dependents()
+        remaining = self.remaining_durations(durations)
+        key = lambda name: (-remaining[name], name)
+        # Prefer starting from a name with no dependencies of its own.
+        name = min(self.dependencies, key=lambda name: (-remaining[name], bool(self.dependencies[name]), name))
+        total = remaining[name]
+        path = [name]
+        while dependents[name]:
+            name = min(dependents[name], key=key)
+            path.append(name)
+        return total, path
+
 def topological_sort(source):
-    """perform topo sort on elements.
-
-    :arg source: list of ``(name, [list of dependancies])`` pairs
-    :returns: list of names, with dependancies listed first
-    """
-    if isinstance(source, dict):
-        source = source.items()
-    pending = sorted([(name, set(deps)) for name, deps in source]) # copy deps so we can modify set in-place       
-    emitted = []        
-    while pending:
-        next_pending = []
-        next_emitted = []
-        for entry in pending:
-            name, deps = entry
-            deps.difference_update(emitted) # remove deps we emitted last pass
-            if deps: # still has deps? recheck during next pass
-                next_pending.append(entry) 
-            else: # no more deps? time to emit
-                yield name 
-                emitted.append(name) # <-- not required, but helps preserve original ordering
-                next_emitted.append(name) # remember what we emitted for difference_update() in next pass
-        if not next_emitted: # all entries have unmet deps, one of two things is wrong...
-            raise ValueError("cyclic or missing dependancy detected: %r" % (next_pending,))
-        pending = next_pending
-        emitted = next_emitted
+    """
+    Sorts names so each follows its dependencies.
+    
+    :arg source: dict or list of ``(name, [list of dependencies])`` pairs
+    :returns: list of names, with dependencies listed first
+    """
+    return DependencyGraph(source).sort()
 
 def represent_ordereddict(dumper, data):
     value = []
@@ -3,7 +3,10 @@ from __future__ import print_function
 import os
 import sys
 
+from fabric.api import hide, settings
+
 from burlap import ServiceSatchel
+from burlap.common import LayeredContext
 from burlap.constants import * 
 
 class CronSatchel(ServiceSatchel):
@@ -66,7 +69,7 @@ class CronSatchel(ServiceSatchel):
         from pip import render_paths as pip_render_paths
         from dj import render_remote_paths as dj_render_paths
         
-        env = env or self.genv
+        env = self.genv if env is None else env
         env = pip_render_paths(env)
         env = dj_render_paths(env)
         
@@ -82,6 +85,8 @@ class CronSatchel(ServiceSatchel):
     def deploy(self, site=None):
         """
         Writes entire crontab to the host.
+        
+        Returns true if the crontab was changed.
         """
         from burlap.common import get_current_hostname, iter_sites
         
@@ -94,7 +99,7 @@ class CronSatchel(ServiceSatchel):
             if self.verbose:
                 print('site:', site, file=sys.stderr)
             
-            env = self.render_paths(type(self.genv)(self.genv))
+            env = self.render_paths(LayeredContext(self.genv))
             
             # Only load site configurations that are allowed for this host.
             if target_sites is None:
@@ -121,19 +126,30 @@ class CronSatchel(ServiceSatchel):
         cron_crontabs = self.env.crontab_headers + cron_crontabs
         cron_crontabs.append('\n')
         env.crontabs_rendered = '\n'.join(cron_crontabs)
+        
+        # The installed crontab is the only copy that matters, so compare against it instead of an uploaded file.
+        if not self.dryrun:
+            with settings(warn_only=True), hide('running', 'stdout', 'stderr', 'warnings'):
+                current = self.sudo_or_dryrun('crontab -u %(cron_user)s -l' % env)
+            if current.succeeded and current.replace('\r\n', '\n').strip() == env.crontabs_rendered.strip():
+                print('Crontab is unchanged.', file=sys.stderr)
+                return False
+        
         fn = self.write_to_file(content=env.crontabs_rendered)
         if self.dryrun:
             print('echo %s > %s' % (env.crontabs_rendered, fn))
         self.put_or_dryrun(local_path=fn)
         env.put_remote_path = self.genv.put_remote_path
         self.sudo_or_dryrun('crontab -u %(cron_user)s %(put_remote_path)s' % env)
+        return True
     
     def configure(self, **kwargs):
         if self.env.enabled:
             kwargs['site'] = ALL
-            self.deploy(**kwargs)
+            changed = self.deploy(**kwargs)
             self.enable()
-            self.restart()
+            if changed:
+                self.restart()
         else:
             self.disable()
             self.stop()
@@ -35,6 +35,7 @@ from burlap.common import (
     QueuedCommand,
     get_dryrun,
     LocalRenderer,
+    get_ssh_control_options,
 )
 from burlap.decorators import task_or_dryrun, task
 #from burlap.plan import run, sudo
@@ -298,7 +299,8 @@ def dump(dest_dir=None, to_local=None, from_local=0, archive=0, dump_fn=None):
     
     # Download the database dump file on the remote host to localhost.
     if not from_local and (0 if to_local is None else int(to_local)) and not env.is_local:
-        cmd = ('rsync -rvz --progress --recursive --no-p --no-g --rsh "ssh -o StrictHostKeyChecking=no -i %(key_filename)s" %(user)s@%(host_string)s:%(db_dump_fn)s %(db_dump_fn)s') % env
+        env.db_ssh_control_options = get_ssh_control_options()
+        cmd = ('rsync -rvz --progress --recursive --no-p --no-g --rsh "ssh -o StrictHostKeyChecking=no %(db_ssh_control_options)s -i %(key_filename)s" %(user)s@%(host_string)s:%(db_dump_fn)s %(db_dump_fn)s') % env
         local_or_dryrun(cmd)
     
     if to_local and int(archive):
@@ -8,8 +8,9 @@ and repositories.
 """
 from __future__ import print_function
 
-from fabric.api import hide, run, settings
+from fabric.api import env, hide, run, settings
 
+from burlap.common import _installed_packages, forget_installed_packages
 from burlap.utils import run_as_root
 from burlap.files import getmtime, is_file
 
@@ -37,18 +38,44 @@ def upgrade(safe=True):
     run_as_root("%(manager)s --assume-yes %(cmd)s" % locals(), pty=False)
 
 
+def get_installed_packages(refresh=False):
+    """
+    Get the version of every package installed, by name, and by name
+    qualified with its architecture, like "libc6:i386".
+
+    All packages are listed with a single remote command, and remembered
+    until a package manager runs on the host.
+    """
+    if refresh or env.host_string not in _installed_packages:
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
+            res = run("dpkg-query -W -f='${Package} ${Architecture} ${Version} ${Status}\\n'")
+        packages = {}
+        for line in res.splitlines():
+            parts = line.split()
+            # The status is three words, like "install ok installed".
+            if len(parts) == 6 and parts[-1] == 'installed':
+                packages[parts[0]] = parts[2]
+                packages['%s:%s' % (parts[0], parts[1])] = parts[2]
+        _installed_packages[env.host_string] = packages
+    return _installed_packages[env.host_string]
+
+
 def is_installed(pkg_name):
     """
     Check if a package is installed.
+
+    A name qualified by architecture, like "libc6:i386", only matches
+    that architecture, or an architecture independent package, and one
+    pinned to a version, like "nginx=1.10.3-0ubuntu0.16.04.2", only
+    matches that version.
     """
-    with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
-        res = run("dpkg -s %(pkg_name)s" % locals())
-        for line in res.splitlines():
-            if line.startswith("Status: "):
-                status = line[8:]
-                if "installed" in status.split(' '):
-                    return True
-        return False
+    installed = get_installed_packages()
+    if '=' in pkg_name:
+        pkg_name, version = pkg_name.split('=', 1)
+        return is_installed(pkg_name) and installed.get(pkg_name) == version
+    if ':' in pkg_name:
+        return pkg_name in installed or '%s:all' % pkg_name.split(':')[0] in installed
+    return pkg_name in installed
 
 
 def install(packages, update=False, options=None, version=None):
@@ -93,6 +120,8 @@ def install(packages, update=False, options=None, version=None):
     options = " ".join(options)
     cmd = '%(manager)s install %(options)s %(packages)s%(version)s' % locals()
     run_as_root(cmd, pty=False)
+    # List the inventory again when next needed, since dependencies may have been installed or the install failed.
+    forget_installed_packages()
 
 
 def uninstall(packages, purge=False, options=None):
@@ -15,6 +15,9 @@ from burlap.common import (
     run_or_dryrun,
     sudo_or_dryrun,
     local_or_dryrun,
+    load_traces,
+    aggregate_traces,
+    pretty_bytes,
 )
 from burlap.decorators import task_or_dryrun
 
@@ -240,3 +243,39 @@ def tunnel(local_port, remote_port):
     env.tunnel_local_port = local_port
     env.tunnel_remote_port = remote_port
     local_or_dryrun(' ssh -i %(key_filename)s -L %(tunnel_local_port)s:localhost:%(tunnel_remote_port)s %(user)s@%(host_string)s -N' % env)
+
+def print_trace_table(title, groups, total, limit=None):
+    print(title)
+    rows = [('%.1f' % stats['duration'],
+             '%.1f%%' % (100.*stats['duration']/total if total else 0),
+             str(stats['count']),
+             '%.1f' % stats['max'],
+             '%.1f %s' % pretty_bytes(stats['bytes']) if stats['bytes'] else '-',
+             str(stats['failures']),
+             ' '.join(str(_) for _ in value) if isinstance(value, tuple) else str(value))
+            for value, stats in groups[:limit]]
+    header = ('Seconds', 'Percent', 'Count', 'Max', 'Bytes', 'Failed', 'Name')
+    widths = [max(len(_[i]) for _ in [header] + rows) for i in range(len(header)-1)]
+    for row in [header] + rows:
+        print('    ' + '  '.join(_.rjust(w) for _, w in zip(row, widths)) + '  ' + row[-1])
+    print()
+
+@task_or_dryrun
+def trace_report(session='last', limit=20):
+    """
+    Summarizes where time was spent by the commands recorded with BURLAP_TRACE=1.
+    
+    The session may be 'last', 'all', or the name of a specific session.
+    """
+    limit = int(limit)
+    records = load_traces(session=session)
+    if not records:
+        print('No traces found.')
+        return
+    total = sum(_.get('duration') or 0 for _ in records)
+    print('%i commands in %.1f seconds.' % (len(records), total))
+    print()
+    print_trace_table('By satchel:', aggregate_traces(records, 'satchel'), total, limit)
+    print_trace_table('By task:', aggregate_traces(records, 'task'), total, limit)
+    print_trace_table('By host:', aggregate_traces(records, 'host'), total, limit)
+    print_trace_table('By command:', aggregate_traces(records, ('satchel', 'op', 'command')), total, limit)
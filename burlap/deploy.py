@@ -1,7 +1,11 @@
 from __future__ import print_function
 
 import os
+import atexit
+import pipes
 import gc
+import copy
+import hashlib
 import re
 import sys
 import types
@@ -9,16 +13,20 @@ import datetime
 import glob
 import tempfile
 import json
+import pickle
 import yaml
+import six
 import shutil
 import functools
+import fcntl
 import traceback
+import inspect
 import time
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from pprint import pprint
 
 from fabric.api import (
-    env, runs_once, sudo as _sudo, get as _get,
+    env, hide, runs_once, settings, sudo as _sudo, get as _get,
 )
 import fabric.contrib.files
 import fabric.api
@@ -55,6 +63,35 @@ env.plan = None
 env.plan_data_dir = '%(burlap_data_dir)s/plans'
 env.plan_digits = 3
 
+PLAN_STORE_FILES = 'files'
+PLAN_STORE_INDEX = 'index'
+
+# How plans are stored, either one file per plan attribute, or one index file per role.
+env.plan_store = PLAN_STORE_INDEX
+
+# Bump whenever the structure of the plan index changes.
+PLAN_INDEX_FORMAT = 1
+
+# The number of manifest recorders run at once, each in its own process.
+env.thumbprint_workers = 4
+
+# The seconds each manifest recorder is given to finish.
+env.thumbprint_timeout = 300
+
+# The number of components deployed at once, each in its own process, as soon as the components
+# they depend on are done. Parallel deployment is disabled by default: 1 deploys them one at a time,
+# in-process, as before.
+# Only raise this if every host can be logged into, and sudo run, without a password prompt,
+# since workers can't answer prompts, and if no component's deployers rely on env changes
+# made by the deployers of another, since each worker only sees its own.
+env.deploy_workers = 1
+
+# The number of most recent deployments compared by deploy.timing_report.
+env.deploy_timing_count = 20
+
+# How many times slower than its median a component's last deployment must be to be flagged.
+env.deploy_timing_threshold = 1.5
+
 RUN = 'run'
 SUDO = 'sudo'
 LOCAL = 'local'
@@ -63,21 +100,33 @@ PLAN_METHODS = [RUN, SUDO, LOCAL, PUT]
 
 INITIAL = 'initial'
 
-_fs_cache = defaultdict(dict) # {func_name:{path:ret}}
+# The seconds a remote plan file may hold unwritten changes between flushes.
+# 0 writes every change as soon as the file is closed.
+env.remote_file_flush_interval = 0
+
+_fs_cache = defaultdict(dict) # {func_name:{(host, path):ret}}
+
+def _fs_key(path):
+    # Remote paths are only unique per host.
+    if env.plan_storage == STORAGE_REMOTE:
+        return env.host_string, path
+    return None, path
 
 def make_dir(d):
-    if d not in _fs_cache['make_dir']:
+    key = _fs_key(d)
+    if key not in _fs_cache['make_dir']:
         if env.plan_storage == STORAGE_REMOTE:
             sudo_or_dryrun('mkdir -p "%s"' % d)
         else:
             if not os.path.isdir(d):
                 os.makedirs(d)
-        _fs_cache['make_dir'][d] = True
-    return _fs_cache['make_dir'][d]
+        _fs_cache['make_dir'][key] = True
+    return _fs_cache['make_dir'][key]
 
 @task_or_dryrun
 def list_dir(d):
-    if d not in _fs_cache['list_dir']:
+    key = _fs_key(d)
+    if key not in _fs_cache['list_dir']:
         verbose = common.get_verbose()
         if env.plan_storage == STORAGE_REMOTE:
             #output = sudo_or_dryrun('ls "%s"' % d)
@@ -88,12 +137,13 @@ def list_dir(d):
             ret = output
         else:
             ret = os.listdir(d)
-        _fs_cache['list_dir'][d] = ret
-    return _fs_cache['list_dir'][d]
+        _fs_cache['list_dir'][key] = ret
+    return _fs_cache['list_dir'][key]
 
 @task_or_dryrun
 def is_dir(d):
-    if d not in _fs_cache['is_dir']:
+    key = _fs_key(d)
+    if key not in _fs_cache['is_dir']:
         verbose = common.get_verbose()
         if env.plan_storage == STORAGE_REMOTE:
             cmd = 'if [ -d "%s" ]; then echo 1; else echo 0; fi' % d
@@ -104,12 +154,13 @@ def is_dir(d):
             ret = int(re.findall(r'^[0-9]+$', output, flags=re.DOTALL|re.I|re.M)[0])
         else:
             ret = os.path.isdir(d)
-        _fs_cache['is_dir'][d] = ret
-    return _fs_cache['is_dir'][d]
+        _fs_cache['is_dir'][key] = ret
+    return _fs_cache['is_dir'][key]
 
 @task_or_dryrun
 def is_file(fqfn):
-    if fqfn not in _fs_cache['is_file']:
+    key = _fs_key(fqfn)
+    if key not in _fs_cache['is_file']:
         verbose = common.get_verbose()
         if env.plan_storage == STORAGE_REMOTE:
             cmd = 'if [ -f "%s" ]; then echo 1; else echo 0; fi' % fqfn
@@ -119,8 +170,8 @@ def is_file(fqfn):
             ret = int(re.findall(r'^[0-9]+$', output, flags=re.DOTALL|re.I|re.M)[0])
         else:
             ret = os.path.isfile(fqfn)
-        _fs_cache['is_file'][fqfn] = ret
-    return _fs_cache['is_file'][fqfn]
+        _fs_cache['is_file'][key] = ret
+    return _fs_cache['is_file'][key]
 
 # class Singleton(type):
 #     def __init__(cls, name, bases, dict):
@@ -137,99 +188,110 @@ def is_file(fqfn):
 
 class RemoteFile(object):
     """
-    A helper class for allowing a remote file to be read and written locally
-    while still ultimately being saved remotely.
-    """
+    A remote file read and written in memory, so it can be used like a local file.
+    
+    Nothing is written until the file is flushed or closed, and then only an append's
+    new content is sent, rather than the whole file. A rewritten file is uploaded beside
+    the original and moved over it, so it's never left partially written.
     
-#     __metaclass__ = Singleton
+    If env.remote_file_flush_interval is set, each file is written at most once every
+    that many seconds, and changes made sooner are held until the next flush after that,
+    or the next call to RemoteFile.flush_all(). Held changes are lost if the process is killed.
+    """
     
-    _file_cache = {} # {fqfn, obj}
+    _file_cache = {} # {(host, fqfn): obj}
     
-    #TODO:use meta-class instead?
-    #http://stackoverflow.com/questions/31875/is-there-a-simple-elegant-way-to-define-singletons-in-python/33201#33201
+    # Files with changes not yet written.
+    _dirty = {} # {(host, fqfn): obj}
     
     def __new__(cls, fqfn, *args, **kwargs):
-        # Remember and cache every class instance per unique file name.
-        if fqfn not in cls._file_cache:
-#             print('creating new instance:', fqfn)
-            cls._file_cache[fqfn] = super(RemoteFile, cls).__new__(cls, fqfn, *args, **kwargs)
-#         else:
-#             print('using cache:', fqfn)
-        return cls._file_cache[fqfn]
+        # Remember and cache every class instance per unique file name on each host.
+        key = (env.host_string, fqfn)
+        if key not in cls._file_cache:
+            cls._file_cache[key] = super(RemoteFile, cls).__new__(cls)
+        return cls._file_cache[key]
     
     def __init__(self, fqfn, mode='r'):
-        super(RemoteFile, self).__init__() # causes instantiation error?
-        
         assert mode in ('r', 'w', 'a'), 'Invalid mode: %s' % mode
         
-        self.mode = mode
-            
         # Due to the singleton-nature of __new__, this may be called multiple times,
-        # so we check for and avoid duplicate calls.
+        # so only the first call sets up the file's state.
         if not hasattr(self, 'fqfn'):
-            
+            self.host_string = env.host_string
             self.fqfn = fqfn
+            self.content = None # Loaded when first read.
+            self.appended = '' # Written since the last flush, if the file only grew.
+            self.rewrite = False # True if the whole file must be written.
+            self.last_flush = 0
+        
+        self.mode = mode
+        if mode == 'w':
             self.content = ''
-            self.fresh = True
-            
-            if mode in 'ra':
+            self.appended = ''
+            self.rewrite = True
+            self._dirty[(self.host_string, self.fqfn)] = self
+        
+        if mode in 'wa':
+            # Update file system cache.
+            _fs_cache['is_file'][_fs_key(fqfn)] = True
     
-                _, tmp_fn = tempfile.mkstemp()
-                os.remove(tmp_fn)
-                ret = _get(remote_path=fqfn, local_path=tmp_fn, use_sudo=True)
-                #ret = get_or_dryrun(remote_path=fqfn, local_path=tmp_fn, use_sudo=True)
-#                 print('ret:', ret)
-                _fn = ret[0]
-#                 print('reading:', _fn)
-                fin = open(_fn, 'rb')
-#                 print('reading2:', _fn)
-                self.content = fin.read()
-#                 print('closing')
-                fin.close()
-                #print('removing:', tmp_fn)
-                os.remove(tmp_fn)#TODO:memory leak?
-#                 print('done init load')
-                
-            if mode in 'wa':
-                
-                # Update file system cache.
-                _fs_cache['is_file'][fqfn] = True
-                
-#         print('done init all')
-
     def write(self, s):
         assert self.mode in 'wa', 'File must be in write-mode.'
-        self.content += s
-        self.fresh = False
+        if self.content is not None:
+            self.content += s
+        if not self.rewrite:
+            self.appended += s
+        self._dirty[(self.host_string, self.fqfn)] = self
         # Note, flush() must to be called to actually write this.
-
+    
     def read(self, *args, **kwargs):
+        if self.content is None:
+            fout = six.BytesIO()
+            with settings(hide('running', 'stdout')):
+                _get(remote_path=self.fqfn, local_path=fout, use_sudo=True)
+            # Appends not yet flushed aren't in the remote copy.
+            self.content = fout.getvalue().decode('utf-8') + self.appended
         return self.content
     
     def readlines(self):
-        return self.content.split('\n')
+        return self.read().split('\n')
     
-    def flush(self):
-        if self.fresh:
+    def flush(self, force=False):
+        key = (self.host_string, self.fqfn)
+        if key not in self._dirty:
+            return
+        if not force and time.time() - self.last_flush < env.remote_file_flush_interval:
             return
-            
-        _, tmp_fn = tempfile.mkstemp()
-        os.remove(tmp_fn)
-        fout = open(tmp_fn, 'w')
-        fout.write(self.content)
-        fout.close()
-        put_or_dryrun(
-            local_path=tmp_fn,
-            remote_path=self.fqfn,
-            use_sudo=True)
-        os.remove(tmp_fn)#TODO:memory leak?
-        self.fresh = True
         
-        # Update file system cache.
-        _fs_cache['is_file'][self.fqfn] = True
+        if self.rewrite:
+            put_or_dryrun(
+                local_path=six.BytesIO(self.content.encode('utf-8')),
+                remote_path=self.fqfn + '.tmp',
+                use_sudo=True)
+            sudo_or_dryrun('mv -f "%s.tmp" "%s"' % (self.fqfn, self.fqfn))
+        elif self.appended:
+            sudo_or_dryrun('printf %%s %s >> "%s"' % (pipes.quote(self.appended), self.fqfn))
+        self.appended = ''
+        self.rewrite = False
+        self.last_flush = time.time()
+        del self._dirty[key]
         
+        # Update file system cache.
+        _fs_cache['is_file'][_fs_key(self.fqfn)] = True
+    
     def close(self):
-        self.flush()
+        self.flush(force=not env.remote_file_flush_interval)
+    
+    @classmethod
+    def flush_all(cls):
+        """
+        Writes every file's outstanding changes.
+        """
+        for (host_string, fqfn), obj in sorted(cls._dirty.items()):
+            with settings(host_string=host_string):
+                obj.flush(force=True)
+
+atexit.register(RemoteFile.flush_all)
 
 def open_file(fqfn, mode='r'):
     verbose = common.get_verbose()
@@ -264,12 +326,7 @@ def ongoing(s):
     return Colors.WARNING + str(s) + Colors.ENDC
 
 def iter_plan_names(role=None):
-    d = get_plan_dir(role=role)
-    assert is_dir(d)
-    for name in sorted(list_dir(d)):
-        fqfn = os.path.join(d, name)
-        if not is_dir(fqfn):
-            continue
+    for name in get_plan_store(role).names():
         yield name
 
 def get_thumbprint_path(role, name):
@@ -355,6 +412,295 @@ def get_plan_dir(role, name=None):
     make_dir(d)
     return d
 
+class FilePlanStore(object):
+    """
+    Stores each of a role's plans as a directory, with a file for each attribute.
+    
+    Every attribute read or written is a separate round trip when stored remotely.
+    """
+    
+    def __init__(self, role):
+        self.role = role
+    
+    def names(self):
+        d = get_plan_dir(role=self.role)
+        assert is_dir(d)
+        names = []
+        for name in sorted(list_dir(d)):
+            fqfn = os.path.join(d, name)
+            if not is_dir(fqfn):
+                continue
+            names.append(name)
+        return names
+    
+    def load(self, name, hosts=None):
+        """
+        Returns a dictionary of the plan's attributes, creating the plan if it doesn't exist.
+        """
+        plan_dir = get_plan_dir(self.role, name)
+        assert is_dir(plan_dir)
+        data = {}
+        
+        fn = os.path.join(plan_dir, 'history')
+        if not is_file(fn):
+            fout = open_file(fn, 'w')
+            fout.write(','.join(HISTORY_HEADERS))
+            fout.close()
+        data['history'] = []
+        for line in open_file(fn).readlines()[1:]:
+            if line.strip():
+                data['history'].append(line.strip().split(','))
+        
+        fn = os.path.join(plan_dir, 'index')
+        if not is_file(fn):
+            fout = open_file(fn, 'w')
+            fout.write(str(0))
+            fout.close()
+        data['index'] = int(open_file(fn).read().strip())
+        
+        fn = os.path.join(plan_dir, 'steps')
+        if not is_file(fn):
+            fout = open_file(fn, 'w')
+            fout.write('')
+            fout.close()
+        data['steps'] = open_file(fn).readlines()
+        
+        fn = os.path.join(plan_dir, 'hosts')
+        if hosts is not None and not is_file(fn):
+            fout = open_file(fn, 'w')
+            fout.write('\n'.join(hosts))
+            fout.close()
+        data['hosts'] = [_.strip() for _ in open_file(fn).readlines() if _.strip()]
+        
+        return data
+    
+    def set_index(self, name, index):
+        fout = open_file(os.path.join(get_plan_dir(self.role, name), 'index'), 'w')
+        fout.write(str(index))
+        fout.flush()
+        fout.close()
+    
+    def add_history(self, name, index, start, end):
+        fout = open_file(os.path.join(get_plan_dir(self.role, name), 'history'), 'a')
+        fout.write('%s,%s,%s\n' % (index, start, end))
+        fout.flush()
+        fout.close()
+    
+    def get_thumbprint_filename(self, name, host_string):
+        d = os.path.join(get_plan_dir(self.role, name), 'thumbprints')
+        make_dir(d)
+        return os.path.join(d, host_string)
+    
+    def is_thumbprinted(self, name, host_string):
+        return is_file(self.get_thumbprint_filename(name, host_string))
+    
+    def get_thumbprint(self, name, host_string):
+        content = open_file(self.get_thumbprint_filename(name, host_string)).read()
+        return yaml.load(content)
+    
+    def set_thumbprint(self, name, host_string, data):
+        fout = open_file(self.get_thumbprint_filename(name, host_string), 'w')
+        yaml.dump(data, fout, default_flow_style=False, indent=4)
+        fout.flush()
+    
+    def get_host_data(self, name, kind, host_string, default=None):
+        """
+        Returns the data of the given kind recorded for a host by the plan, like its deployer timings.
+        """
+        fn = os.path.join(get_plan_dir(self.role, name), kind, host_string)
+        if not is_file(fn):
+            return default
+        return json.loads(open_file(fn).read() or 'null')
+    
+    def set_host_data(self, name, kind, host_string, data):
+        d = os.path.join(get_plan_dir(self.role, name), kind)
+        make_dir(d)
+        fout = open_file(os.path.join(d, host_string), 'w')
+        fout.write(json.dumps(data, indent=4, sort_keys=True))
+        fout.close()
+    
+    def get_timings(self, name):
+        """
+        Returns {host: [timing]} with how long each deployer took on each host the plan was deployed to.
+        """
+        d = os.path.join(get_plan_dir(self.role, name), 'timings')
+        if not is_dir(d):
+            return {}
+        timings = {}
+        for host_string in list_dir(d):
+            timings[host_string] = self.get_host_data(name, 'timings', host_string, default=[])
+        return timings
+    
+    def get_checkpoint_filename(self, host_string):
+        # Kept outside the role's directory, where every directory is a plan.
+        d = os.path.join(init_plan_data_dir(), '%s.checkpoints' % self.role)
+        make_dir(d)
+        return os.path.join(d, host_string)
+    
+    def get_checkpoint(self, host_string):
+        """
+        Returns the progress of the host's unfinished deployment, if any.
+        """
+        fn = self.get_checkpoint_filename(host_string)
+        if not is_file(fn):
+            return
+        return yaml.load(open_file(fn).read()) or None
+    
+    def set_checkpoint(self, host_string, data):
+        """
+        Atomically records the progress of the host's deployment, or clears it if data is None.
+        """
+        fn = self.get_checkpoint_filename(host_string)
+        content = yaml.dump(data, default_flow_style=False, indent=4) if data else ''
+        if env.plan_storage == STORAGE_REMOTE:
+            _, tmp_fn = tempfile.mkstemp()
+            try:
+                with open(tmp_fn, 'w') as fout:
+                    fout.write(content)
+                put_or_dryrun(local_path=tmp_fn, remote_path=fn + '.tmp', use_sudo=True)
+                sudo_or_dryrun('mv -f "%s.tmp" "%s"' % (fn, fn))
+            finally:
+                os.remove(tmp_fn)
+            # Don't let a later read return what was cached before this write.
+            RemoteFile._file_cache.pop((env.host_string, fn), None)
+        else:
+            tmp_fn = '%s.%s.tmp' % (fn, os.getpid())
+            with open(tmp_fn, 'w') as fout:
+                fout.write(content)
+            os.rename(tmp_fn, fn)
+        _fs_cache['is_file'][_fs_key(fn)] = True
+
+class IndexPlanStore(FilePlanStore):
+    """
+    Stores all of a role's plans, except their thumbprints and history, in a single
+    JSON file that's fetched once, kept in memory, and atomically rewritten on every change.
+    
+    Each plan's history is appended to its own log, as a FilePlanStore does, so recording
+    a step doesn't rewrite the index.
+    
+    Plans recorded by a FilePlanStore are imported the first time the index is used.
+    """
+    
+    def __init__(self, role):
+        super(IndexPlanStore, self).__init__(role)
+        self.fn = os.path.join(init_plan_data_dir(), '%s.json' % role)
+        self._data = None
+    
+    @property
+    def data(self):
+        if self._data is None:
+            if is_file(self.fn):
+                self._data = json.loads(open_file(self.fn).read())
+            else:
+                self._data = self.migrate()
+                self.save()
+        return self._data
+    
+    def migrate(self):
+        """
+        Returns the plans stored in the legacy per-file layout, if any.
+        """
+        data = {'format': PLAN_INDEX_FORMAT, 'plans': {}}
+        if not is_dir(os.path.join(init_plan_data_dir(), self.role)):
+            return data
+        if common.get_verbose():
+            print('Importing plans for role %s into %s.' % (self.role, self.fn), file=sys.stderr)
+        for name in super(IndexPlanStore, self).names():
+            plan = super(IndexPlanStore, self).load(name)
+            # It's already in the plan's log.
+            del plan['history']
+            plan['thumbprinted'] = [
+                _ for _ in plan['hosts']
+                if super(IndexPlanStore, self).is_thumbprinted(name, _)
+            ]
+            data['plans'][name] = plan
+        return data
+    
+    def merge(self, other):
+        """
+        Adds another process's changes to the index, so that hosts deployed
+        in parallel don't overwrite each other's progress.
+        """
+        for name, plan in other['plans'].items():
+            mine = self._data['plans'].setdefault(name, plan)
+            if mine is plan:
+                continue
+            mine['thumbprinted'] = sorted(set(mine['thumbprinted']).union(plan['thumbprinted']))
+            # Only indexes written before history had its own log contain it.
+            if plan.get('history'):
+                history = mine.setdefault('history', [])
+                for entry in plan['history']:
+                    if entry not in history:
+                        history.append(entry)
+                history.sort(key=lambda o: o[1])
+    
+    def save(self):
+        if env.plan_storage == STORAGE_REMOTE:
+            # Atomically replaced, see RemoteFile.
+            fout = open_file(self.fn, 'w')
+            fout.write(json.dumps(self._data, indent=4, sort_keys=True))
+            fout.close()
+        else:
+            tmp_fn = '%s.%s.tmp' % (self.fn, os.getpid())
+            with open(self.fn + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if os.path.isfile(self.fn):
+                    with open(self.fn) as fin:
+                        self.merge(json.load(fin))
+                with open(tmp_fn, 'w') as fout:
+                    json.dump(self._data, fout, indent=4, sort_keys=True)
+                os.rename(tmp_fn, self.fn)
+        _fs_cache['is_file'][_fs_key(self.fn)] = True
+    
+    def names(self):
+        return sorted(self.data['plans'])
+    
+    def load(self, name, hosts=None):
+        if name not in self.data['plans']:
+            self.data['plans'][name] = dict(index=0, steps=[], hosts=list(hosts or []), thumbprinted=[])
+            self.save()
+        return self.data['plans'][name]
+    
+    def set_index(self, name, index):
+        self.data['plans'][name]['index'] = index
+        self.save()
+    
+    def add_history(self, name, index, start, end):
+        fn = os.path.join(get_plan_dir(self.role, name), 'history')
+        # Written the way FilePlanStore.load() expects, in case the store is switched back.
+        header = '' if is_file(fn) else ','.join(HISTORY_HEADERS) + '\n'
+        fout = open_file(fn, 'a')
+        fout.write('%s%s,%s,%s\n' % (header, index, start, end))
+        fout.close()
+        _fs_cache['is_file'][_fs_key(fn)] = True
+    
+    def is_thumbprinted(self, name, host_string):
+        return host_string in self.data['plans'][name]['thumbprinted']
+    
+    def set_thumbprint(self, name, host_string, data):
+        super(IndexPlanStore, self).set_thumbprint(name, host_string, data)
+        thumbprinted = self.data['plans'][name]['thumbprinted']
+        if host_string not in thumbprinted:
+            thumbprinted.append(host_string)
+            thumbprinted.sort()
+            self.save()
+
+PLAN_STORES = {
+    PLAN_STORE_FILES: FilePlanStore,
+    PLAN_STORE_INDEX: IndexPlanStore,
+}
+
+_plan_stores = {} # {(host, role): store}
+
+def get_plan_store(role=None):
+    """
+    Returns the plan store for the role, shared for the rest of the run.
+    """
+    key = _fs_key(role or env.ROLE)
+    if key not in _plan_stores:
+        _plan_stores[key] = PLAN_STORES[env.plan_store](role or env.ROLE)
+    return _plan_stores[key]
+
 class Plan(object):
     """
     A sequence of steps for accomplishing a state change.
@@ -368,49 +714,17 @@ class Plan(object):
         
         self.role = role or env.ROLE
         
-        if verbose: print('init plan dir')
-        self.plan_dir = get_plan_dir(role, name)
-        make_dir(self.plan_dir)
-        assert is_dir(self.plan_dir)
+        self.store = get_plan_store(self.role)
         
-        if verbose: print('init plan history dir')
-        self.plan_dir_history = os.path.join(self.plan_dir, 'history')
-        if not is_file(self.plan_dir_history):
-            fout = open_file(self.plan_dir_history, 'w')
-            fout.write(','.join(HISTORY_HEADERS))
-            fout.close()
-        if verbose: print('loading plan history')
-        self.load_history()
+        if verbose: print('loading plan')
+        # Only record the hosts if the plan's for our role, since we don't know any other role's hosts.
+        self._data = self.store.load(name, hosts=sorted(env.hosts) if self.role == env.ROLE else None)
         
-        if verbose: print('init plan index')
-        self.plan_dir_index = os.path.join(self.plan_dir, 'index')
-        if not is_file(self.plan_dir_index):
-            fout = open_file(self.plan_dir_index, 'w')
-            fout.write(str(0))
-            fout.close()
-        if verbose: print('loading plan index')
+        self.load_history()
         self.load_index()
-        
-        if verbose: print('init plan steps')
-        self.plan_dir_steps = os.path.join(self.plan_dir, 'steps')
-        if not is_file(self.plan_dir_steps):
-            fout = open_file(self.plan_dir_steps, 'w')
-            fout.write('')
-            fout.close()
-        if verbose: print('loading plan steps')
         self.load_steps()
-        
-        if verbose: print('init plan hosts')
-        self.plan_dir_hosts = os.path.join(self.plan_dir, 'hosts')
-        if self.role == env.ROLE and not is_file(self.plan_dir_hosts):
-            fout = open_file(self.plan_dir_hosts, 'w')
-            fout.write('\n'.join(sorted(env.hosts)))
-            fout.close()
-        if verbose: print('loading plan hosts')
         self.load_hosts()
         
-        #self.plan_thumbprint_fn = os.path.join(self.plan_dir, 'thumbprint')
-        
         if verbose: print('plan init done')
     
     def __cmp__(self, other):
@@ -439,24 +753,18 @@ class Plan(object):
     def failed(self):
         return False #TODO
     
+    @property
+    def plan_dir(self):
+        return os.path.join(init_plan_data_dir(), self.role, self.name)
+    
     def load_hosts(self):
-        self.hosts = []
-        if self.verbose: print('loading hosts, opening')
-        fin = open_file(self.plan_dir_hosts, 'r')
-        if self.verbose: print('loading hosts, readlines')
-        lines = fin.readlines()
-        if self.verbose: print('loading hosts, lines:', lines)
-        for line in lines:
-            if not line.strip():
-                continue
-            self.hosts.append(line.strip())
-        if self.verbose: print('loading hosts, done')
+        self.hosts = list(self._data['hosts'])
+        if self.verbose: print('loading hosts, done:', self.hosts)
     
     @property
     def all_hosts_thumbprinted(self):
         for host in self.hosts:
-            fn = self.get_thumbprint_filename(host)
-            if not is_file(fn):
+            if not self.store.is_thumbprinted(self.name, host):
                 return False
         return True
     
@@ -464,20 +772,13 @@ class Plan(object):
         pass
     
     def get_thumbprint_filename(self, host_string):
-        d = os.path.join(self.plan_dir, 'thumbprints')
-        make_dir(d)
-        fn = os.path.join(d, env.host_string)
-        return fn
+        return self.store.get_thumbprint_filename(self.name, host_string)
     
     @property
     def thumbprint(self):
         verbose = common.get_verbose()
         if verbose: print('plan.thumbprint')
-        fn = self.get_thumbprint_filename(env.host_string)
-        if verbose: print('plan.thumbprint.fn:', fn)
-        content = open_file(fn).read()
-        if verbose: print('plan.thumbprint.yaml.raw:', content)
-        data = yaml.load(content)
+        data = self.store.get_thumbprint(self.name, env.host_string)
         if verbose: print('plan.thumbprint.yaml.data:', data)
         return data
     
@@ -485,32 +786,39 @@ class Plan(object):
     def thumbprint(self, data):
         assert isinstance(data, dict)
         if not common.get_dryrun():
-            fout = open_file(self.get_thumbprint_filename(env.host_string), 'w')
-            yaml.dump(data, fout, default_flow_style=False, indent=4)
-            fout.flush()
+            self.store.set_thumbprint(self.name, env.host_string, data)
+            # The last completed plan may now be this one.
+            _last_thumbprint_cache.pop((self.role, env.host_string), None)
     
-    def record_thumbprint(self, only_components=None):
+    def record_thumbprint(self, only_components=None, data=None):
         """
         Creates a thumbprint file for the current host in the current role and name.
+        
+        data := the thumbprint to record, instead of the current one
         """
         only_components = only_components or []
-        data = get_current_thumbprint(role=self.role, name=self.name, only_components=only_components)
+        if data is None:
+            data = get_current_thumbprint(role=self.role, name=self.name, only_components=only_components)
         print('Recording thumbprint for host %s with deployment %s on %s.' \
             % (env.host_string, self.name, self.role))
         self.thumbprint = data
     
+    def get_diffs(self, host_string=None):
+        """
+        Returns {component: ManifestDiff} with what changed in each component deployed to the host.
+        """
+        data = self.store.get_host_data(self.name, 'diffs', host_string or env.host_string, default={})
+        return dict((component, common.ManifestDiff.from_dict(diff)) for component, diff in data.items())
+    
     @property
     def remaining_step_count(self):
         return len(self._steps) - self.index
     
     def add_history(self, index, start, end):
-        fout = open_file(self.plan_dir_history, 'a')
-        fout.write('%s,%s,%s\n' % (index, start, end))
-        fout.flush()
-        fout.close()
+        self.store.add_history(self.name, index, start, end)
     
     def load_index(self):
-        self._index = int(open_file(self.plan_dir_index).read().strip())
+        self._index = int(self._data['index'])
     
     @property
     def index(self):
@@ -530,15 +838,11 @@ class Plan(object):
     @index.setter
     def index(self, v):
         self._index = int(v)
-        fout = open_file(self.plan_dir_index, 'w')
-        fout.write(str(self._index))
-        fout.flush()
-        fout.close()
+        self.store.set_index(self.name, self._index)
     
     def load_steps(self):
         self._steps = []
-        lines = open_file(self.plan_dir_steps).readlines()
-        for line in lines:
+        for line in self._data['steps']:
             line = line.strip()
             if not line:
                 continue
@@ -585,23 +889,27 @@ class Plan(object):
     def execute(self, i=None, j=None):
         i = i or self.index
         steps_ran = []
-        for step_i, step in enumerate(self.steps):
-            if step_i < i:
-                continue
+        try:
+            for step_i, step in enumerate(self.steps):
+                if step_i < i:
+                    continue
+                    
+                # Run command.
+                t0 = datetime.datetime.utcnow().isoformat()
+                step.execute()
+                t1 = datetime.datetime.utcnow().isoformat()
+                steps_ran.append(step)
                 
-            # Run command.
-            t0 = datetime.datetime.utcnow().isoformat()
-            step.execute()
-            t1 = datetime.datetime.utcnow().isoformat()
-            steps_ran.append(step)
-            
-            # Record success.
-            if not common.get_dryrun():
-                self.index = step_i + 1
-                self.add_history(self.index, t0, t1)
-            
-            if j is not None and step_i >= j:
-                break
+                # Record success.
+                if not common.get_dryrun():
+                    self.index = step_i + 1
+                    self.add_history(self.index, t0, t1)
+                
+                if j is not None and step_i >= j:
+                    break
+        finally:
+            # Record the progress made, even if a step failed.
+            RemoteFile.flush_all()
                 
         return steps_ran
 
@@ -689,6 +997,365 @@ def status(name=None):
             output = ongoing(output)
         print(output)
 
+class RecorderError(Exception):
+    pass
+
+# The seconds taken to record each component's manifest by the last call to record_manifests().
+manifest_timings = {} # {component: seconds}
+
+# The exc_info() of each recorder that raised an exception during the last call to record_manifests().
+# Those raised in a worker process have no traceback.
+manifest_errors = {} # {component: (type, value, traceback)}
+
+def _dump_exception(e):
+    """
+    Returns the pickled exception, or None if it can't be sent back to the parent process.
+    """
+    try:
+        data = pickle.dumps(e, pickle.HIGHEST_PROTOCOL)
+        pickle.loads(data)
+    except Exception:
+        return None
+    return data
+
+def _record_manifest_process(component_name, conn):
+    """
+    The body of a worker process recording a single component's manifest.
+    """
+    from fabric import state
+    # Connections inherited from the parent can't be shared with it.
+    state.connections.clear()
+    start = time.time()
+    try:
+        ret = ('ok', common.manifest_recorder[component_name.lower()](), None)
+    except exceptions.AbortDeployment as e:
+        ret = ('abort', str(e), None)
+    except BaseException as e:
+        ret = ('error', traceback.format_exc(), _dump_exception(e))
+    finally:
+        common.close_ssh_masters()
+    try:
+        conn.send(ret + (time.time() - start,))
+    except Exception:
+        conn.send(('error', traceback.format_exc(), None, time.time() - start))
+    conn.close()
+
+def iter_recorded_manifests(component_names, workers=None, timeout=None):
+    """
+    Calls the manifest recorder of each component, in up to `workers` forked processes
+    at once, each given `timeout` seconds to finish.
+    
+    Yields (component, status, data, seconds) in the order the components are given,
+    where status is 'ok', 'abort' or 'error', and data the manifest or the error message.
+    The exception behind an error, if any, is kept in manifest_errors.
+    """
+    import multiprocessing
+    
+    workers = int(workers or env.thumbprint_workers)
+    timeout = float(timeout or env.thumbprint_timeout)
+    manifest_timings.clear()
+    manifest_errors.clear()
+    
+    if workers <= 1 or len(component_names) <= 1:
+        # Record in-process, which can't enforce a timeout.
+        for component_name in component_names:
+            start = time.time()
+            try:
+                ret = 'ok', common.manifest_recorder[component_name.lower()]()
+            except exceptions.AbortDeployment as e:
+                ret = 'abort', str(e)
+            except Exception:
+                ret = 'error', traceback.format_exc()
+                manifest_errors[component_name] = sys.exc_info()
+            manifest_timings[component_name] = time.time() - start
+            yield (component_name,) + ret + (manifest_timings[component_name],)
+        return
+    
+    results = {} # {component: (status, data, seconds)}
+    queue = list(component_names)
+    running = {} # {component: (process, conn, start)}
+    try:
+        while queue or running:
+            while queue and len(running) < workers:
+                component_name = queue.pop(0)
+                parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(
+                    target=_record_manifest_process, args=(component_name, child_conn))
+                process.start()
+                child_conn.close()
+                running[component_name] = (process, parent_conn, time.time())
+            
+            for component_name, (process, conn, start) in list(running.items()):
+                exc_data = None
+                # The process may send its result and exit between the two checks,
+                # so always look for a result before treating an exit as a failure.
+                if conn.poll() or (not process.is_alive() and conn.poll()):
+                    try:
+                        status, data, exc_data, seconds = conn.recv()
+                    except EOFError:
+                        status, data, seconds = 'error', 'Recorder process exited unexpectedly.', time.time() - start
+                elif not process.is_alive():
+                    status, data, seconds = 'error', 'Recorder process exited with code %s.' % process.exitcode, time.time() - start
+                elif time.time() - start > timeout:
+                    process.terminate()
+                    status, data, seconds = 'error', 'Timed out after %s seconds.' % timeout, time.time() - start
+                else:
+                    continue
+                process.join()
+                conn.close()
+                del running[component_name]
+                results[component_name] = (status, data, seconds)
+                if exc_data is not None:
+                    e = pickle.loads(exc_data)
+                    manifest_errors[component_name] = (type(e), e, None)
+            
+            if running:
+                time.sleep(0.05)
+    finally:
+        for process, conn, start in running.values():
+            process.terminate()
+    
+    for component_name in component_names:
+        status, data, seconds = results[component_name]
+        manifest_timings[component_name] = seconds
+        yield component_name, status, data, seconds
+
+def _count_remote_commands():
+    return sum(count for op, count in common.command_counts.items() if op != 'local')
+
+def _time_deployer(component, func_name, func):
+    """
+    Calls a deployer, returning how long it took and how many remote commands it ran.
+    """
+    from burlap.executor import check_stop
+    check_stop()
+    commands = _count_remote_commands()
+    start = time.time()
+    if callable(func):
+        func()
+    return dict(
+        component=component,
+        deployer=func_name,
+        seconds=round(time.time() - start, 3),
+        commands=_count_remote_commands() - commands,
+    )
+
+def _run_deployers_process(component, funcs, log_fn):
+    """
+    The body of a worker process running a single component's deployers.
+    """
+    from fabric import state
+    # Buffer all output, including that of any subprocesses, so it's shown in one piece.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    fd = os.open(log_fn, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o644)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    sys.stdout = sys.stderr = os.fdopen(1, 'w', 1)
+    
+    # Connections inherited from the parent can't be shared with it.
+    state.connections.clear()
+    # There's nobody to answer a prompt.
+    env.abort_on_prompts = True
+    
+    code = 0
+    try:
+        timings = []
+        for func_name, func in funcs:
+            print('%s Executing step %s...' % (datetime.datetime.now(), func_name))
+            timings.append(_time_deployer(component, func_name, func))
+        with open(log_fn + '.json', 'w') as fout:
+            json.dump(timings, fout)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        common.close_ssh_masters()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    sys.exit(code)
+
+def run_deployers(components, dependencies, component_funcs, workers=None, fout=None, callback=None, priorities=None):
+    """
+    Runs the deployers of each component, starting a component as soon as all the
+    components it depends on are done, with up to `workers` components running at once.
+    
+    components := the components, sorted so each follows its dependencies
+    dependencies := {component: set(components it depends on)}
+    component_funcs := {component: [(func_name, func)]}
+    fout := an optional file to log progress to
+    callback := an optional function called with each component, and the timings of
+        its deployers, once it's done
+    priorities := {component: priority}, where higher priority components are started
+        first when several are ready
+    
+    If a component fails, no more are started, and it aborts once the running ones finish.
+    When only one component can run at a time, it's run in-process, so any env changes
+    its deployers make are seen by the components that depend on it.
+    
+    Returns a list of the timings of every deployer run.
+    """
+    import multiprocessing
+    
+    workers = int(workers or env.deploy_workers)
+    
+    def log_progress(msg):
+        if fout:
+            print('%s %s' % (datetime.datetime.now(), msg), file=fout)
+            fout.flush()
+    
+    timings = []
+    
+    def run_in_process(component):
+        component_timings = []
+        for func_name, func in component_funcs.get(component, []):
+            print('%s Executing step %s...' % (datetime.datetime.now(), func_name))
+            log_progress('Executing step %s...' % func_name)
+            component_timings.append(_time_deployer(component, func_name, func))
+            log_progress('Done!')
+        timings.extend(component_timings)
+        if callback:
+            callback(component, component_timings)
+    
+    if workers <= 1:
+        for component in components:
+            run_in_process(component)
+        return timings
+    
+    log_dir = tempfile.mkdtemp(prefix='burlap-deploy-')
+    pending = list(components)
+    done = set()
+    failed = []
+    running = {} # {component: (process, log_fn, start)}
+    try:
+        while pending or running:
+            if not failed:
+                ready = [
+                    _ for _ in sorted(pending, key=lambda o: -(priorities or {}).get(o, 0))
+                    if set(dependencies.get(_, [])).issubset(done)
+                ]
+                for component in [_ for _ in ready if not component_funcs.get(_)]:
+                    pending.remove(component)
+                    done.add(component)
+                    if callback:
+                        callback(component, [])
+                ready = [_ for _ in ready if component_funcs.get(_)]
+                if len(ready) == 1 and not running:
+                    # Nothing could run alongside it, so there's nothing to gain by forking.
+                    pending.remove(ready[0])
+                    run_in_process(ready[0])
+                    done.add(ready[0])
+                    continue
+                for component in ready:
+                    if len(running) >= workers:
+                        break
+                    pending.remove(component)
+                    funcs = component_funcs[component]
+                    print('%s Starting %s: %s' % (
+                        datetime.datetime.now(), component, ', '.join(func_name for func_name, _ in funcs)))
+                    log_progress('Starting %s...' % component)
+                    log_fn = os.path.join(log_dir, '%s.log' % component)
+                    process = multiprocessing.Process(
+                        target=_run_deployers_process, args=(component, funcs, log_fn))
+                    process.start()
+                    running[component] = (process, log_fn, time.time())
+            elif not running:
+                break
+            
+            for component, (process, log_fn, start) in list(running.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                del running[component]
+                with open(log_fn) as fin:
+                    output = fin.read()
+                if output:
+                    print(output, end='' if output.endswith('\n') else '\n')
+                if process.exitcode == 0:
+                    done.add(component)
+                    component_timings = []
+                    if os.path.isfile(log_fn + '.json'):
+                        with open(log_fn + '.json') as fin:
+                            component_timings = json.load(fin)
+                    timings.extend(component_timings)
+                    if callback:
+                        callback(component, component_timings)
+                    print(success('%s Done %s in %.1f seconds.' % (
+                        datetime.datetime.now(), component, time.time() - start)))
+                    log_progress('Done %s!' % component)
+                else:
+                    failed.append(component)
+                    print(fail('%s Failed %s with exit code %s.' % (
+                        datetime.datetime.now(), component, process.exitcode)))
+                    log_progress('Failed %s!' % component)
+                    if running:
+                        print('Waiting for %s to finish...' % ', '.join(sorted(running)))
+            
+            if running:
+                time.sleep(0.1)
+    finally:
+        # Only reached with processes still running if we were interrupted.
+        for process, _, _ in running.values():
+            process.terminate()
+        shutil.rmtree(log_dir, ignore_errors=True)
+    
+    if failed:
+        fabric.api.abort('Deployment of %s failed. Not started: %s' % (
+            ', '.join(failed), ', '.join(pending) or 'none'))
+    
+    return timings
+
+# Thumbprints computed during this run, so they're only recorded once however many tasks need them.
+_last_thumbprint_cache = {} # {(role, host): thumbprint}
+_manifest_cache = {} # {(role, host, component): (fingerprint, manifest)}
+_fingerprint_cache = {} # {(role, host, component): (settings, fingerprint)}
+
+def clear_thumbprint_cache():
+    _last_thumbprint_cache.clear()
+    _manifest_cache.clear()
+    _fingerprint_cache.clear()
+
+def get_component_fingerprint(component_name):
+    """
+    Returns a hash of everything a component's manifest is derived from,
+    its settings, templates and other tracked files, so a cached manifest
+    is only reused while none have changed.
+    
+    Walking the tracked files can be slow, so they're only hashed again
+    during the run if the component's settings change.
+    
+    Returns None if the tracked files can't be determined, in which case
+    the manifest must not be cached.
+    """
+    key = (env.get('ROLE'), env.host_string, component_name)
+    settings = json.dumps(common.get_component_settings(component_name), sort_keys=True, default=repr)
+    if key in _fingerprint_cache and _fingerprint_cache[key][0] == settings:
+        return _fingerprint_cache[key][1]
+    parts = [str(env.get('ROLE')), str(env.get('SITE')), str(env.host_string), settings]
+    satchel = common.all_satchels.get(component_name.upper())
+    paths = []
+    for template in getattr(satchel, 'templates', None) or []:
+        paths.append((satchel.find_template('%s/%s' % (satchel.name, template)), None))
+    if satchel is not None:
+        try:
+            paths.extend(satchel.get_tracked_paths())
+        except Exception:
+            return
+    for path, exclude in paths:
+        if not path:
+            continue
+        if os.path.isdir(path):
+            parts.append('%s:%s' % (path, common.get_content_fingerprint(path, exclude=exclude, depth=0)['.']))
+        elif os.path.isfile(path):
+            st = os.stat(path)
+            parts.append('%s:%s:%s' % (path, st.st_mtime, st.st_size))
+    fingerprint = hashlib.md5('\n'.join(parts).encode('utf-8')).hexdigest()
+    _fingerprint_cache[key] = (settings, fingerprint)
+    return fingerprint
+
 def get_current_thumbprint(role=None, name=None, reraise=0, only_components=None):
     """
     Retrieves a snapshot of the current code state.
@@ -699,14 +1366,11 @@ def get_current_thumbprint(role=None, name=None, reraise=0, only_components=None
     last = get_last_thumbprint()
     only_components = only_components or []
     only_components = [_.upper() for _ in only_components]
-    data = {} # {component:data}
     manifest_data = (last and last.copy()) or {}
-#     print('manifest_data:', manifest_data.keys())
-#     print('only_components:', only_components)
-#     raw_input('enter')
-    for component_name, func in common.manifest_recorder.iteritems():
+    
+    component_names = []
+    for component_name in sorted(common.manifest_recorder):
         component_name = component_name.upper()
-        print('component_name:',component_name)
         
         if only_components and component_name not in only_components:
             if common.get_verbose():
@@ -717,16 +1381,40 @@ def get_current_thumbprint(role=None, name=None, reraise=0, only_components=None
             if common.get_verbose():
                 print('Skipping unused component:', component_name)
             continue
-            
-        try:
-            manifest_data[component_name] = func()
-#             print('manifest:', component_name, manifest_data[component_name])
-        except exceptions.AbortDeployment as e:
-            raise
-        except Exception as e:
+        
+        component_names.append(component_name)
+    
+    # Reuse the manifests already recorded during this run, unless their inputs have changed.
+    fingerprints = {}
+    for component_name in list(component_names):
+        key = (env.ROLE, env.host_string, component_name)
+        fingerprints[component_name] = get_component_fingerprint(component_name)
+        if fingerprints[component_name] is not None and key in _manifest_cache \
+        and _manifest_cache[key][0] == fingerprints[component_name]:
+            if common.get_verbose():
+                print('Using cached manifest for component:', component_name)
+            manifest_data[component_name] = copy.deepcopy(_manifest_cache[key][1])
+            component_names.remove(component_name)
+    
+    for component_name, status, ret, seconds in iter_recorded_manifests(component_names):
+        print('component_name: %s (%.2f seconds)' % (component_name, seconds))
+        if status == 'ok':
+            manifest_data[component_name] = ret
+            _manifest_cache[(env.ROLE, env.host_string, component_name)] = \
+                (fingerprints[component_name], copy.deepcopy(ret))
+        elif status == 'abort':
+            raise exceptions.AbortDeployment(ret)
+        else:
             if int(reraise):
-                raise
-            print(traceback.format_exc(), file=sys.stderr)
+                if component_name in manifest_errors:
+                    six.reraise(*manifest_errors[component_name])
+                raise RecorderError('Unable to record manifest for %s: %s' % (component_name, ret))
+            print(ret, file=sys.stderr)
+    
+    if common.get_verbose():
+        print('Slowest manifest recorders:')
+        for component_name, seconds in sorted(manifest_timings.items(), key=lambda o: (-o[1], o[0]))[:10]:
+            print('    %.2f %s' % (seconds, component_name))
         
     return manifest_data
 
@@ -736,9 +1424,12 @@ def get_last_thumbprint():
     Returns thumbprint from the last complete deployment.
     """
     verbose = common.get_verbose()
-    plan = get_last_completed_plan()
-    if verbose and plan: print('get_last_thumbprint.last completed plan:', plan.name)
-    last_thumbprint = (plan and plan.thumbprint) or {}
+    key = (env.ROLE, env.host_string)
+    if key not in _last_thumbprint_cache:
+        plan = get_last_completed_plan()
+        if verbose and plan: print('get_last_thumbprint.last completed plan:', plan.name)
+        _last_thumbprint_cache[key] = (plan and plan.thumbprint) or {}
+    last_thumbprint = copy.deepcopy(_last_thumbprint_cache[key])
     if verbose: print('get_last_thumbprint.last_thumbprint:', last_thumbprint)
     return last_thumbprint
 
@@ -798,11 +1489,19 @@ def show_diff(only=None):
         last = last.get(k)
         current = current.get(k)
         if isinstance(last, dict) and isinstance(current, dict):
-            for _k in set(last).union(current):
-                _a = last.get(_k)
-                _b = current.get(_k)
-                if _a != _b:
-                    print('DIFF: %s =' % _k, _a, _b)
+            diff = common.ManifestDiff(last, current)
+            for label, paths in (('ADDED', diff.added), ('REMOVED', diff.removed), ('CHANGED', diff.changed)):
+                for path in paths:
+                    _a = _b = None
+                    try:
+                        _a = functools.reduce(lambda d, key: d[key], path, last)
+                    except KeyError:
+                        pass
+                    try:
+                        _b = functools.reduce(lambda d, key: d[key], path, current)
+                    except KeyError:
+                        pass
+                    print('%s: %s =' % (label, '.'.join(map(str, path))), _a, _b)
         else:
             print('DIFF:', last, current)
 
@@ -812,6 +1511,96 @@ def info():
     print('storage:', env.plan_storage)
     print('dir:', d)
 
+def get_component_durations(plan):
+    """
+    Returns {component: seconds} taken by each component's deployers on the current host
+    in the given deployment, as an estimate of how long they'll take next time.
+    """
+    durations = defaultdict(float)
+    if plan:
+        for timing in plan.store.get_host_data(plan.name, 'timings', env.host_string, default=[]):
+            durations[timing['component']] += timing['seconds']
+    return dict(durations)
+
+def get_timing_history(count=None, only_components=None):
+    """
+    Returns {(component, host): [(plan name, seconds, commands)]} over the last `count` deployments,
+    oldest first, totalling the timings of each component's deployers.
+    """
+    count = int(count or env.deploy_timing_count)
+    store = get_plan_store()
+    history = defaultdict(list)
+    for name in store.names()[-count:]:
+        for host_string, timings in sorted(store.get_timings(name).items()):
+            totals = OrderedDict()
+            for timing in timings:
+                if only_components and timing['component'] not in only_components:
+                    continue
+                seconds, commands = totals.get(timing['component'], (0, 0))
+                totals[timing['component']] = (seconds + timing['seconds'], commands + timing['commands'])
+            for component, (seconds, commands) in totals.items():
+                history[(component, host_string)].append((name, seconds, commands))
+    return history
+
+@task_or_dryrun
+def timing_report(count=None, threshold=None, components=None):
+    """
+    Shows how long each component took to deploy to each host over the last deployments,
+    and flags those whose last deployment was much slower than usual.
+    
+    count := the number of most recent deployments to look at
+    
+    threshold := how many times its previous median a component's last deployment must take to be flagged
+    
+    components := list of names of components to limit the report to
+    
+    Returns a list of the flagged (component, host) pairs.
+    """
+    threshold = float(threshold or env.deploy_timing_threshold)
+    only_components = components or []
+    if isinstance(only_components, basestring):
+        only_components = [_.strip().upper() for _ in only_components.split(',') if _.strip()]
+    
+    history = get_timing_history(count=count, only_components=only_components)
+    if not history:
+        print('No deployment timings recorded.')
+        return []
+    
+    rows = []
+    regressions = []
+    for (component, host_string), runs in history.items():
+        seconds = [_[1] for _ in runs]
+        last_name, last, commands = runs[-1]
+        baseline = common.percentile(seconds[:-1], 50)
+        ratio = last/baseline if baseline else None
+        flagged = ratio is not None and ratio > threshold
+        if flagged:
+            regressions.append((component, host_string))
+        rows.append((ratio or 0, (
+            component,
+            host_string,
+            str(len(runs)),
+            '%.1f' % common.percentile(seconds, 50),
+            '%.1f' % common.percentile(seconds, 95),
+            '%.1f' % last,
+            '%.2fx' % ratio if ratio is not None else '-',
+            str(commands),
+            fail('slower') if flagged else '',
+        )))
+    rows = [row for _, row in sorted(rows, key=lambda o: (-o[0], o[1][:2]))]
+    
+    header = ('Component', 'Host', 'Runs', 'p50', 'p95', 'Last', 'vs p50', 'Commands', '')
+    widths = [max(len(_[i]) for _ in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print('    ' + '  '.join(
+            _.ljust(w) if i < 2 else _.rjust(w)
+            for i, (_, w) in enumerate(zip(row[:-1], widths))) + '  ' + row[-1])
+    print()
+    if regressions:
+        print(fail('More than %sx slower than usual in their last deployment: %s' % (
+            threshold, ', '.join('%s on %s' % _ for _ in sorted(regressions)))))
+    return regressions
+
 @task_or_dryrun
 def reset():
     """
@@ -819,14 +1608,19 @@ def reset():
     This will cause the planner to think everything needs to be re-deployed.
     """
     d = os.path.join(init_plan_data_dir(), env.ROLE)
+    index_fn = '%s.json' % d
+    checkpoint_dir = '%s.checkpoints' % d
     if env.plan_storage == STORAGE_REMOTE:
-        sudo_or_dryrun('rm -Rf "%s"' % d)
+        sudo_or_dryrun('rm -Rf "%s" "%s" "%s"' % (d, index_fn, checkpoint_dir))
         sudo_or_dryrun('mkdir -p "%s"' % d)
     elif env.plan_storage == STORAGE_LOCAL:
-        local_or_dryrun('rm -Rf "%s"' % d)
+        local_or_dryrun('rm -Rf "%s" "%s" "%s"' % (d, index_fn, checkpoint_dir))
         local_or_dryrun('mkdir -p "%s"' % d)
     else:
         raise NotImplementedError
+    _plan_stores.clear()
+    _fs_cache.clear()
+    clear_thumbprint_cache()
     
 @task_or_dryrun
 @runs_once
@@ -886,8 +1680,38 @@ def get_last_current_diffs(target_component):
     last, current = component_thumbprints[target_component]
     return last, current
 
+def accepts_diff(func):
+    """
+    Returns true if the deployer takes a `diff` argument, to be given the ManifestDiff of its component.
+    """
+    func = getattr(func, 'wrapped', func)
+    try:
+        if six.PY2:
+            args = inspect.getargspec(func).args
+        else:
+            args = inspect.getfullargspec(func).args
+    except TypeError:
+        return False
+    return 'diff' in args
+
+def get_resumable_checkpoint(last_plan=None, only_components=None):
+    """
+    Returns the checkpoint of the current host's last deployment, if it failed
+    part way through and can be resumed.
+    """
+    checkpoint = get_plan_store().get_checkpoint(env.host_string)
+    if not checkpoint:
+        return
+    if checkpoint.get('last_plan') != (last_plan and last_plan.name) \
+    or checkpoint.get('only_components') != sorted(only_components or []):
+        # The checkpoint was made against another deployment, so it's no longer valid.
+        if common.get_verbose():
+            print('Ignoring stale checkpoint from %s.' % checkpoint.get('started'))
+        return
+    return checkpoint
+
 @task_or_dryrun
-def auto(fake=0, preview=0, check_outstanding=1, components=None, explain=0):
+def auto(fake=0, preview=0, check_outstanding=1, components=None, explain=0, resume=1, workers=0):
     """
     Generates a plan based on the components that have changed since the last deployment.
     
@@ -902,8 +1726,19 @@ def auto(fake=0, preview=0, check_outstanding=1, components=None, explain=0):
     
     components := list of names of components found in the services list
     
+    resume := If true, and the last deployment to the host failed part way through,
+        only the components that didn't finish are deployed.
+    
+    workers := If above 0, deploys to every host at once, with up to this many running at a time,
+        as deploy.rollout does.
+    
     """
     
+    if int(workers) and not int(preview):
+        return deploy_hosts(functools.partial(
+            auto, fake=fake, check_outstanding=check_outstanding, components=components,
+            explain=explain, resume=resume), workers=workers)
+    
     explain = int(explain)
     only_components = components or []
     if isinstance(only_components, basestring):
@@ -938,6 +1773,8 @@ def auto(fake=0, preview=0, check_outstanding=1, components=None, explain=0):
                     if not fake:
                         if takes_diff:
                             yield func_name, functools.partial(func, last=last, current=current)
+                        elif accepts_diff(func):
+                            yield func_name, functools.partial(func, diff=component_diffs[component])
                         else:
                             yield func_name, functools.partial(func)
     
@@ -945,6 +1782,7 @@ def auto(fake=0, preview=0, check_outstanding=1, components=None, explain=0):
     fake = int(fake)
     preview = int(preview)
     check_outstanding = int(check_outstanding)
+    resume = int(resume)
     
     all_services = set(_.strip().upper() for _ in env.services)
     if verbose:
@@ -963,38 +1801,55 @@ def auto(fake=0, preview=0, check_outstanding=1, components=None, explain=0):
         ) % env.ROLE))
         sys.exit(1)
     
-    if verbose:
-        print('iter_thumbprint_differences')
-    diffs = list(iter_thumbprint_differences(only_components=only_components))
-    if diffs:
-        if verbose:
-            print('Differences detected!')
-
-    # Create plan.
-    components = set()
-    component_thumbprints = {}
-    for component, (last, current) in diffs:
-        if component not in all_services:
-            print('ignoring component:', component)
-            continue
-#         if only_components and component not in only_components:
-#             continue
-        component_thumbprints[component] = last, current
-        components.add(component)
-    component_dependences = {}
-    
-    if verbose:
-        print('all_services:', all_services)
-        print('manifest_deployers_befores:', common.manifest_deployers_befores.keys())
-        print('*'*80)
-        print('all components:', components)
+    checkpoint = resume and get_resumable_checkpoint(last_plan, only_components)
     
+    common.load_satchels(only_components)
     all_components = set(common.all_satchels)
     if only_components and not all_components.issuperset(only_components):
         unknown_components = set(only_components).difference(all_components)
         raise Exception('Unknown components: %s' \
             % ', '.join(sorted(unknown_components)))
     
+    if checkpoint:
+        # Pick up where the failed deployment left off, without re-thumbprinting the host.
+        print('Resuming the deployment started at %s.' % checkpoint['started'])
+        if checkpoint['done']:
+            print('Skipping finished components: %s' % ', '.join(checkpoint['done']))
+        last, current = checkpoint['last'], checkpoint['current']
+        components = [_ for _ in checkpoint['components'] if _ not in checkpoint['done']]
+        component_thumbprints = dict((_, (last, current)) for _ in components)
+        component_dependences = dict(
+            (_c, set(checkpoint['dependencies'].get(_c, [])).intersection(components))
+            for _c in components)
+    else:
+        last = current = None
+        component_dependences = {}
+        
+        if verbose:
+            print('iter_thumbprint_differences')
+        diffs = list(iter_thumbprint_differences(only_components=only_components))
+        if diffs:
+            if verbose:
+                print('Differences detected!')
+    
+        # Create plan.
+        components = set()
+        component_thumbprints = {}
+        for component, (last, current) in diffs:
+            if component not in all_services:
+                print('ignoring component:', component)
+                continue
+#             if only_components and component not in only_components:
+#                 continue
+            component_thumbprints[component] = last, current
+            components.add(component)
+    
+        if verbose:
+            print('all_services:', all_services)
+            print('manifest_deployers_befores:', common.manifest_deployers_befores.keys())
+            print('*'*80)
+            print('all components:', components)
+    
     for _c in components:
         if verbose:
             print('checking:',_c)
@@ -1011,17 +1866,32 @@ def auto(fake=0, preview=0, check_outstanding=1, components=None, explain=0):
         for _c in component_dependences:
             print(_c, component_dependences[_c])
         
-    components = list(common.topological_sort(component_dependences.items()))
+    graph = common.DependencyGraph(component_dependences)
+    components = graph.sort()
+    component_diffs = dict(
+        (_c, common.ManifestDiff((last or {}).get(_c), (current or {}).get(_c)))
+        for _c in components)
 #     print('components:',components)
 #     raw_input('enter')
     plan_funcs = list(get_deploy_funcs(components))
+    durations = {}
     if components and plan_funcs:
         print('These components have changed:\n')
         for component in sorted(components):
-            print((' '*4)+component)
+            paths = ['.'.join(map(str, _)) for _ in component_diffs[component].paths]
+            if len(paths) > 5:
+                paths = paths[:5] + ['and %i more' % (len(paths) - 5)]
+            print((' '*4)+component+(': '+', '.join(paths) if paths else ''))
         print('\nDeployment plan:\n')
         for func_name, _ in plan_funcs:
             print(success((' '*4)+func_name))
+        durations = get_component_durations(last_plan)
+        seconds, path = graph.critical_path(durations)
+        if seconds:
+            print('\nEstimated to take at least %.0f seconds, the time taken by %s.' % (seconds, ' -> '.join(path)))
+    elif checkpoint:
+        # Only the thumbprint remains to be recorded.
+        print('All components have already been deployed.')
     else:
         print('Nothing to do!')
         return False
@@ -1031,19 +1901,42 @@ def auto(fake=0, preview=0, check_outstanding=1, components=None, explain=0):
         print('\nTo execute this plan on all hosts run:\n\n    fab %s deploy.run' % env.ROLE)
         return components, plan_funcs
     else:
-#         raw_input('enter')
+        component_funcs = dict(
+            (component, list(get_deploy_funcs([component])))
+            for component in components)
+        
+        # Remember each finished component, so a failed deployment can be resumed.
+        store = get_plan_store()
+        resumed = bool(checkpoint)
+        if not checkpoint:
+            checkpoint = dict(
+                last_plan=last_plan and last_plan.name,
+                started=datetime.datetime.utcnow().isoformat(),
+                only_components=sorted(only_components),
+                components=components,
+                dependencies=dict((_c, sorted(_deps)) for _c, _deps in component_dependences.items()),
+                done=[],
+                timings=[],
+                last=last,
+                current=current,
+            )
+        
+        def record_checkpoint(component, timings):
+            if component not in checkpoint['done']:
+                checkpoint['done'].append(component)
+                checkpoint.setdefault('timings', []).extend(timings)
+                if not common.get_dryrun():
+                    store.set_checkpoint(env.host_string, checkpoint)
+        
+        if not common.get_dryrun():
+            store.set_checkpoint(env.host_string, checkpoint)
         with open('/tmp/burlap.progress', 'w') as fout:
             print('%s Beginning plan execution!' % (datetime.datetime.now(),), file=fout)
             fout.flush()
-            for func_name, plan_func in plan_funcs:
-                print('%s Executing step %s...' % (datetime.datetime.now(), func_name))
-                print('%s Executing step %s...' % (datetime.datetime.now(), func_name), file=fout)
-                fout.flush()
-#                 raw_input('enter'); continue
-                if callable(plan_func):
-                    plan_func()
-                print('%s Done!' % (datetime.datetime.now(),), file=fout)
-                fout.flush()
+            run_deployers(
+                components, component_dependences, component_funcs, fout=fout, callback=record_checkpoint,
+                # Start the longest chains of components first.
+                priorities=graph.remaining_durations(durations))
             print('%s Plan execution complete!' % (datetime.datetime.now(),), file=fout)
             fout.flush()
 #         raw_input('final')
@@ -1051,33 +1944,46 @@ def auto(fake=0, preview=0, check_outstanding=1, components=None, explain=0):
     # Create thumbprint.
     if not common.get_dryrun():
         plan = Plan.get_or_create_next(last_plan=last_plan)
-        plan.record_thumbprint(only_components=only_components)
+        if resumed:
+            # Record what was deployed, rather than re-thumbprinting the host.
+            data = copy.deepcopy(checkpoint['last'])
+            for component, manifest in checkpoint['current'].items():
+                if not only_components or component in only_components:
+                    data[component] = manifest
+            plan.record_thumbprint(only_components=only_components, data=data)
+        else:
+            plan.record_thumbprint(only_components=only_components)
+        if checkpoint.get('timings'):
+            store.set_host_data(plan.name, 'timings', env.host_string, checkpoint['timings'])
+        # Include the components deployed before resuming.
+        store.set_host_data(plan.name, 'diffs', env.host_string, dict(
+            (component, common.ManifestDiff((last or {}).get(component), (current or {}).get(component)).to_dict())
+            for component in checkpoint['components']))
+        store.set_checkpoint(env.host_string, None)
 
-@task_or_dryrun
-def run(*args, **kwargs):
+def confirm_deployment(assume_yes=0, *args, **kwargs):
     """
-    Performs a full deployment.
-    
-    Parameters:
-    
-        components := name of satchel to limit deployment to
+    Previews the pending changes and asks the user to confirm them,
+    exiting if there's nothing to do or the user declines.
+    """
+    pending = preview(*args, **kwargs)
+    if pending:
+        # There are changes that need to be deployed, but confirm first with user.
+        if not assume_yes \
+        and not raw_input('\nBegin deployment? [yn] ').strip().lower().startswith('y'):
+            sys.exit(1)
+    else:
+        # There are no changes pending, so abort all further tasks.
+        sys.exit(1)
+
+def deploy_host(*args, **kwargs):
+    """
+    Deploys all pending changes to the current host.
     """
     from burlap import service, notifier
     
-    assume_yes = int(kwargs.pop('assume_yes', 0)) or int(kwargs.pop('yes', 0))
     fake = int(kwargs.get('fake', 0))
     
-    if env.host_string == env.hosts[0]:
-        pending = preview(*args, **kwargs)
-        if pending:
-            # There are changes that need to be deployed, but confirm first with user.
-            if not assume_yes \
-            and not raw_input('\nBegin deployment? [yn] ').strip().lower().startswith('y'):
-                sys.exit(1)
-        else:
-            # There are no changes pending, so abort all further tasks.
-            sys.exit(1)
-    
     if not fake:
         service.pre_deploy()
         
@@ -1088,6 +1994,84 @@ def run(*args, **kwargs):
         service.post_deploy()
         notifier.notify_post_deployment()
 
+@task_or_dryrun
+def run(*args, **kwargs):
+    """
+    Performs a full deployment.
+    
+    Parameters:
+    
+        components := name of satchel to limit deployment to
+        
+        workers := If above 0, deploys to every host at once, with up to this many running at a time,
+            as deploy.rollout does.
+    """
+    assume_yes = int(kwargs.pop('assume_yes', 0)) or int(kwargs.pop('yes', 0))
+    workers = int(kwargs.pop('workers', 0))
+    
+    if env.host_string == env.hosts[0]:
+        confirm_deployment(assume_yes, *args, **kwargs)
+    
+    if workers:
+        deploy_hosts(functools.partial(deploy_host, *args, **kwargs), workers=workers)
+    else:
+        deploy_host(*args, **kwargs)
+
+def deploy_hosts(func, workers=None, batch_size=None, on_failure=None):
+    """
+    Calls func for every host at once, using burlap.executor, then shows a summary,
+    exiting if any host failed.
+    
+    Fabric still calls the task once per host, so this only does anything for the first.
+    """
+    from burlap.executor import ParallelExecutor
+    
+    if env.hosts and env.host_string != env.hosts[0]:
+        return
+    executor = ParallelExecutor(
+        func=func,
+        hosts=env.hosts,
+        pool_size=workers,
+        batch_size=batch_size,
+        on_failure=on_failure)
+    executor.run()
+    executor.print_summary()
+    if executor.failed:
+        sys.exit(1)
+
+@task_or_dryrun
+@runs_once
+def rollout(*args, **kwargs):
+    """
+    Performs a full deployment to all hosts in parallel.
+    
+    Parameters:
+    
+        pool_size := the maximum number of hosts deployed to at once
+        
+        batch_size := the number of hosts that must finish before the next batch starts,
+            with 0 meaning all hosts
+        
+        on_failure := abort, to stop all hosts immediately, drain, to let running hosts
+            finish but start no more, or continue
+        
+        components := name of satchel to limit deployment to
+    
+    Each host's output is written to its own log, and a summary shown at the end.
+    """
+    assume_yes = int(kwargs.pop('assume_yes', 0)) or int(kwargs.pop('yes', 0))
+    pool_size = kwargs.pop('pool_size', None)
+    batch_size = kwargs.pop('batch_size', None)
+    on_failure = kwargs.pop('on_failure', None)
+    
+    confirm_deployment(assume_yes, *args, **kwargs)
+    
+    deploy_hosts(
+        functools.partial(deploy_host, *args, **kwargs),
+        workers=pool_size,
+        batch_size=batch_size,
+        on_failure=on_failure)
+
 @task_or_dryrun
 def test_remotefile():
     f = RemoteFile('/var/log/auth.log')
@@ -29,6 +29,8 @@ from burlap.common import (
     local_or_dryrun,
     put_or_dryrun,
     set_site,
+    LayeredContext,
+    DependencyGraph,
 )
 from burlap.decorators import task_or_dryrun
 
@@ -82,8 +84,7 @@ def render_remote_paths(e=None):
     
     _global_env = e is None
     
-    e = e or env
-    e = type(e)(e)
+    e = LayeredContext(env if e is None else e)
     
     try:
         e.django_settings_module = e.django_settings_module_template % e
@@ -114,7 +115,7 @@ def render_remote_paths(e=None):
 #         print('remote_manage_dir:',e.remote_manage_dir)
     
     if _global_env:
-        env.update(e)
+        env.update(e.get_overrides())
     
     return e
 
@@ -510,13 +511,6 @@ def install_sql(site=None, database='default', apps=None):
     
     apps = (apps or '').split(',')
     
-    def cmp_paths(d0, d1):
-        if d0[1] and d0[1] in d1[2]:
-            return -1
-        if d1[1] and d1[1] in d0[2]:
-            return +1
-        return cmp(d0[0], d1[0])
-    
     def get_paths(t):
         """
         Returns SQL file paths in an execution order that respect dependencies.
@@ -536,8 +530,22 @@ def install_sql(site=None, database='default', apps=None):
             if matches:
                 view_name = matches[0]
             data.append((path, view_name, content))
-        for d in sorted(data, cmp=cmp_paths):
-            yield d[0]
+        # Create each view after the views it uses.
+        view_paths = defaultdict(list) # {view_name: [paths]}
+        for path, view_name, _ in data:
+            if view_name:
+                view_paths[view_name].append(path)
+        graph = DependencyGraph()
+        for path, view_name, content in data:
+            names = set(re.findall(r'[a-zA-Z0-9_]+', content))
+            graph.add(path, [
+                _path
+                for name in names.intersection(view_paths)
+                for _path in view_paths[name]
+                if _path != path
+            ])
+        for path in graph.sort():
+            yield path
     
     def run_paths(paths, cmd_template, max_retries=3):
         paths = list(paths)
@@ -809,16 +817,17 @@ class DjangoMediaSatchel(Satchel):
         self.env.manage_dir = 'src'
     
     def record_manifest(self):
-        latest_timestamp = -1e9999999999999999
-        for path in iter_static_paths():
+        data = {} # {path: {relative directory: hash}}
+        for path, _ in self.get_tracked_paths():
             if self.verbose:
-                print('checking timestamp of path:', path)
-            latest_timestamp = max(
-                latest_timestamp,
-                common.get_last_modified_timestamp(path) or latest_timestamp)
+                print('fingerprinting path:', path)
+            data[path] = common.get_content_fingerprint(path)
         if self.verbose:
-            print('latest_timestamp:', latest_timestamp)
-        return latest_timestamp
+            pprint(data, indent=4)
+        return data
+    
+    def get_tracked_paths(self):
+        return [(path, None) for path in iter_static_paths()]
     
     def configure(self, *args, **kwargs):
         self.local_or_dryrun('cd %(manage_dir)s; ./manage collectstatic --noinput' % self.lenv)
@@ -0,0 +1,241 @@
+"""
+Parallel host executor
+======================
+
+Runs a function against many hosts at once, each in its own forked process so
+it gets its own copy of Fabric's env and connections, like Fabric's parallel
+mode. Unlike Fabric's parallel mode, it supports rolling batches, a failure
+policy, and buffers each host's output to its own log file instead of
+interleaving it on the console.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+
+from fabric.api import env, abort
+from fabric import state
+
+from burlap import common
+
+# Start no more hosts, and stop the running ones before their next deployer.
+ABORT = 'abort'
+
+# Don't start any more hosts, but let the running ones finish.
+DRAIN = 'drain'
+
+# Keep going, regardless of how many hosts fail.
+CONTINUE = 'continue'
+
+FAILURE_POLICIES = (ABORT, DRAIN, CONTINUE)
+
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+ABORTED = 'aborted'
+SKIPPED = 'skipped'
+
+env.executor_pool_size = 10
+
+# The number of hosts to deploy to before starting the next batch. 0 means all hosts at once.
+env.executor_batch_size = 0
+
+env.executor_on_failure = ABORT
+
+env.executor_log_dir = '%(burlap_data_dir)s/logs'
+
+# The number of lines shown from the log of each failed host.
+env.executor_failure_lines = 20
+
+# Set in each worker process to the executor's stop event.
+_stop_event = None
+
+def check_stop():
+    """
+    Aborts if the executor running this host asked it to stop, since another host failed.
+
+    Called between deployers, so a host never stops part way through one.
+    """
+    if _stop_event is not None and _stop_event.is_set():
+        abort('Stopping, since another host failed.')
+
+class HostResult(object):
+
+    def __init__(self, host, log_fn):
+        self.host = host
+        self.log_fn = log_fn
+        self.status = PENDING
+        self.start = None
+        self.end = None
+        self.process = None
+
+    @property
+    def duration(self):
+        if self.start is None:
+            return 0
+        return (self.end or time.time()) - self.start
+
+class ParallelExecutor(object):
+    """
+    Calls func once per host, with env.host_string set to the host.
+
+    A host fails if func raises an exception, or aborts, as Fabric does on any failed command.
+    """
+
+    def __init__(self, func, hosts, pool_size=None, batch_size=None, on_failure=None, log_dir=None):
+        self.func = func
+        self.hosts = list(hosts)
+        self.pool_size = int(pool_size or env.executor_pool_size) or 1
+        self.batch_size = int(batch_size or env.executor_batch_size) or len(self.hosts) or 1
+        self.on_failure = (on_failure or env.executor_on_failure).strip().lower()
+        assert self.on_failure in FAILURE_POLICIES, 'Invalid failure policy: %s' % self.on_failure
+        self.log_dir = os.path.join(log_dir or (env.executor_log_dir % env), time.strftime('%Y%m%d-%H%M%S'))
+        self.results = [
+            HostResult(host, os.path.join(self.log_dir, '%s.log' % host.replace('/', '_')))
+            for host in self.hosts
+        ]
+        self.stop_event = multiprocessing.Event()
+
+    @property
+    def failed(self):
+        return [_ for _ in self.results if _.status in (FAILED, ABORTED)]
+
+    def run_host(self, result):
+        """
+        The body of a host's worker process.
+        """
+        global _stop_event
+        _stop_event = self.stop_event
+
+        # Buffer all output, including that of any subprocesses, to the host's log.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        fd = os.open(result.log_fn, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o644)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        sys.stdout = sys.stderr = os.fdopen(1, 'w', 1)
+
+        # Connections inherited from the parent can't be shared with it.
+        state.connections.clear()
+        env.host_string = result.host
+        # There's nobody to answer a prompt.
+        env.abort_on_prompts = True
+
+        code = 0
+        try:
+            try:
+                self.func()
+            finally:
+                # Worker processes skip atexit handlers, so write any buffered plan files now.
+                from burlap.deploy import RemoteFile
+                RemoteFile.flush_all()
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            common.close_ssh_masters()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        sys.exit(code)
+
+    def start(self, result):
+        print('[%s] Starting.' % result.host)
+        result.status = RUNNING
+        result.start = time.time()
+        result.process = multiprocessing.Process(target=self.run_host, args=(result,))
+        result.process.start()
+
+    def poll(self, running):
+        """
+        Records the results of any finished hosts and returns the ones still running.
+        """
+        still_running = []
+        for result in running:
+            if result.process.is_alive():
+                still_running.append(result)
+                continue
+            result.process.join()
+            result.end = time.time()
+            if result.process.exitcode == 0:
+                result.status = SUCCEEDED
+            elif self.stop_event.is_set():
+                result.status = ABORTED
+            else:
+                result.status = FAILED
+            print('[%s] %s in %.1f seconds.' % (result.host, result.status.title(), result.duration))
+        return still_running
+
+    def run(self):
+        """
+        Runs all hosts, returning a list of HostResults in the order of the hosts.
+        """
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        stopping = False
+        for i in range(0, len(self.results), self.batch_size):
+            if stopping:
+                break
+            queue = list(self.results[i:i+self.batch_size])
+            running = []
+            while queue or running:
+                while queue and len(running) < self.pool_size and not stopping:
+                    result = queue.pop(0)
+                    self.start(result)
+                    running.append(result)
+
+                running = self.poll(running)
+
+                if self.failed and self.on_failure != CONTINUE:
+                    stopping = True
+                    if self.on_failure == ABORT and running and not self.stop_event.is_set():
+                        # Rather than killing them mid-command, let the running hosts stop at their
+                        # next deployer and write their plan files, so they can be resumed.
+                        print('Stopping %i running hosts...' % len(running))
+                        self.stop_event.set()
+
+                if stopping:
+                    queue = []
+
+                if running:
+                    time.sleep(0.1)
+
+        for result in self.results:
+            if result.status == PENDING:
+                result.status = SKIPPED
+
+        return self.results
+
+    def print_summary(self):
+        print()
+        print('Summary:')
+        max_host_len = max([len(_.host) for _ in self.results] or [0])
+        for result in self.results:
+            print('    %s %s %s %s' % (
+                result.host.ljust(max_host_len),
+                result.status.ljust(9),
+                ('%.1fs' % result.duration).rjust(8),
+                result.log_fn if result.status != SKIPPED else ''))
+
+        for result in self.failed:
+            if not os.path.isfile(result.log_fn):
+                continue
+            print()
+            print('Last lines of the log for %s:' % result.host)
+            with open(result.log_fn) as fin:
+                lines = fin.read().splitlines()
+            for line in lines[-env.executor_failure_lines:]:
+                print('    %s' % line)
+
+        print()
+        print('%i succeeded, %i failed, %i skipped.' % (
+            len([_ for _ in self.results if _.status == SUCCEEDED]),
+            len(self.failed),
+            len([_ for _ in self.results if _.status == SKIPPED])))
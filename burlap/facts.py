@@ -0,0 +1,193 @@
+"""
+Host facts
+==========
+
+Gathers everything burlap needs to know about a host, like its OS, packager
+and hostname, with one remote script, instead of one probe per question.
+
+Facts are remembered in memory for the rest of the run, and on disk in
+env.facts_dir for env.facts_ttl seconds, so later runs don't probe again.
+"""
+from __future__ import print_function
+
+import os
+import re
+import json
+import time
+
+from fabric.api import env, hide, run, settings
+
+from burlap.constants import *
+from burlap.decorators import task_or_dryrun
+
+env.facts_dir = '%(burlap_data_dir)s/facts'
+
+# The seconds facts gathered by an earlier run are trusted. 0 gathers them on every run.
+env.facts_ttl = 24*60*60
+
+# Prints "<name>=<value>" for each raw fact.
+FACTS_SCRIPT = '; '.join([
+    'echo "hostname=$(hostname)"',
+    'echo "fqdn=$(hostname --fqdn 2>/dev/null || hostname)"',
+    'echo "kernel=$(uname -s)"',
+    'echo "arch=$(uname -m)"',
+    'echo "lsb_id=$(lsb_release --id --short 2>/dev/null)"',
+    'echo "lsb_release=$(lsb_release --release --short 2>/dev/null)"',
+    'echo "lsb_codename=$(lsb_release --codename --short 2>/dev/null)"',
+    'echo "lsb_desc=$(lsb_release --desc --short 2>/dev/null)"',
+    'echo "distrib_release=$(sed -n \'s/^DISTRIB_RELEASE=//p\' /etc/lsb-release 2>/dev/null)"',
+    'echo "debian_version=$(cat /etc/debian_version 2>/dev/null)"',
+    'echo "fedora_release=$(cat /etc/fedora-release 2>/dev/null)"',
+    'echo "redhat_release=$(cat /etc/redhat-release 2>/dev/null)"',
+    'echo "release_files=$(cd /etc && ls -d lsb-release arch-release gentoo-release 2>/dev/null | tr \'\\n\' \' \')"',
+    'echo "commands=$(for c in %s systemctl initctl; do command -v $c >/dev/null 2>&1 && printf \'%%s \' $c; done)"'
+        % ' '.join(PACKAGERS),
+    'echo "cpus=$(nproc 2>/dev/null || getconf _NPROCESSORS_ONLN 2>/dev/null)"',
+    'echo "memory=$(sed -n \'s/^MemTotal: *\\([0-9]*\\) kB/\\1/p\' /proc/meminfo 2>/dev/null)"',
+])
+
+_facts = {} # {host string: facts}
+
+def get_facts_filename(host_string=None):
+    return os.path.join(env.facts_dir % env, '%s.json' % (host_string or env.host_string).replace('/', '_'))
+
+def parse_facts(output):
+    """
+    Returns the facts derived from the output of FACTS_SCRIPT.
+    """
+    raw = {}
+    for line in output.splitlines():
+        if '=' in line:
+            k, v = line.split('=', 1)
+            raw[k.strip()] = v.strip()
+    release_files = raw.get('release_files', '').split()
+    commands = raw.get('commands', '').split()
+
+    facts = dict(
+        hostname=raw.get('hostname') or None,
+        fqdn=raw.get('fqdn') or None,
+        kernel=raw.get('kernel') or None,
+        arch=raw.get('arch') or None,
+        distrib_id=None,
+        distrib_release=raw.get('lsb_release') or None,
+        distrib_codename=raw.get('lsb_codename') or None,
+        distrib_desc=raw.get('redhat_release') or raw.get('lsb_desc') or None,
+        os=None,
+        packager=None,
+        cpus=int(raw['cpus']) if raw.get('cpus', '').isdigit() else None,
+        memory=int(raw['memory'])*1024 if raw.get('memory', '').isdigit() else None,
+        init='systemd' if 'systemctl' in commands else ('upstart' if 'initctl' in commands else 'sysv'),
+    )
+
+    # The distribution, identified as burlap.system.distrib_id() does.
+    if facts['kernel'] == 'Linux':
+        if raw.get('lsb_id'):
+            facts['distrib_id'] = 'Arch' if raw['lsb_id'] in ('arch', 'Archlinux') else raw['lsb_id']
+        elif raw.get('debian_version'):
+            facts['distrib_id'] = 'Debian'
+        elif raw.get('fedora_release'):
+            facts['distrib_id'] = 'Fedora'
+        elif 'arch-release' in release_files:
+            facts['distrib_id'] = 'Arch'
+        elif raw.get('redhat_release'):
+            for prefix, distrib_id in (
+                ('Red Hat Enterprise Linux', 'RHEL'),
+                ('CentOS', 'CentOS'),
+                ('Scientific Linux', 'SLES')):
+                if raw['redhat_release'].startswith(prefix):
+                    facts['distrib_id'] = distrib_id
+        elif 'gentoo-release' in release_files:
+            facts['distrib_id'] = 'Gentoo'
+    elif facts['kernel'] == 'SunOS':
+        facts['distrib_id'] = 'SunOS'
+
+    # The operating system, as (type, distro, release).
+    if 'lsb-release' in release_files and re.findall(r'[0-9\.]+', raw.get('distrib_release', '')):
+        facts['os'] = [LINUX, UBUNTU, re.findall(r'[0-9\.]+', raw['distrib_release'])[0]]
+    elif re.findall(r'[0-9\.]+', raw.get('debian_version', '')):
+        facts['os'] = [LINUX, DEBIAN, re.findall(r'[0-9\.]+', raw['debian_version'])[0]]
+    elif re.findall(r'release ([0-9]+)', raw.get('fedora_release', '')):
+        facts['os'] = [LINUX, FEDORA, re.findall(r'release ([0-9]+)', raw['fedora_release'])[0]]
+
+    # The packager, preferring the one implied by the distribution.
+    if raw.get('fedora_release'):
+        facts['packager'] = YUM
+    elif 'lsb-release' in release_files:
+        facts['packager'] = APT
+    else:
+        for pn in PACKAGERS:
+            if pn in commands:
+                facts['packager'] = pn
+                break
+
+    return facts
+
+def gather_facts():
+    """
+    Runs FACTS_SCRIPT on the current host and returns its facts.
+    """
+    with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
+        output = run(FACTS_SCRIPT)
+    return parse_facts(output)
+
+def get_facts(refresh=False, host_string=None):
+    """
+    Returns the facts about the current host, gathering them if they aren't known
+    or are older than env.facts_ttl.
+    """
+    from burlap.common import init_burlap_data_dir
+    host_string = host_string or env.host_string
+    if not refresh and host_string in _facts:
+        return _facts[host_string]
+
+    fn = get_facts_filename(host_string)
+    facts = None
+    if not refresh and os.path.isfile(fn) and time.time() - os.path.getmtime(fn) < int(env.facts_ttl):
+        with open(fn) as fin:
+            facts = json.load(fin)
+
+    if facts is None:
+        with settings(host_string=host_string):
+            facts = gather_facts()
+        init_burlap_data_dir()
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        tmp_fn = '%s.%s.tmp' % (fn, os.getpid())
+        with open(tmp_fn, 'w') as fout:
+            json.dump(facts, fout, indent=4, sort_keys=True)
+        os.rename(tmp_fn, fn)
+
+    _facts[host_string] = facts
+    return facts
+
+def get_fact(name, refresh=False):
+    return get_facts(refresh=refresh)[name]
+
+def forget_facts(host_string=None):
+    """
+    Forgets the facts about the current host, so they're gathered again when next needed,
+    such as after changing its hostname.
+    """
+    host_string = host_string or env.host_string
+    _facts.pop(host_string, None)
+    fn = get_facts_filename(host_string)
+    if os.path.isfile(fn):
+        os.remove(fn)
+
+@task_or_dryrun
+def refresh():
+    """
+    Gathers the facts about the current host again, ignoring any remembered.
+    """
+    facts = get_facts(refresh=True)
+    for k in sorted(facts):
+        print('%s: %s' % (k, facts[k]))
+
+@task_or_dryrun
+def show():
+    """
+    Shows the facts about the current host.
+    """
+    facts = get_facts()
+    for k in sorted(facts):
+        print('%s: %s' % (k, facts[k]))
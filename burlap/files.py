@@ -20,66 +20,131 @@ from fabric.contrib.files import upload_template as _upload_template
 from fabric.contrib.files import exists
 
 from burlap.utils import run_as_root
-from burlap.common import sudo_or_dryrun
+from burlap.common import sudo_or_dryrun, get_remote_stats, invalidate_remote_stats, forget_remote_checksums
+
+
+# The most paths stat'd by a single remote command, to stay well within the maximum command length.
+STAT_BATCH_SIZE = 200
+
+# Prints "@stat <is link> <type> [<owner> <group> <mode> <mtime> <size>]" for each path,
+# where type is f (file), d (directory), o (other) or - (missing), following any link.
+STAT_SCRIPT = (
+    'for p in %s; do '
+    'if [ -L "$p" ]; then l=1; else l=0; fi; '
+    'if [ -f "$p" ]; then t=f; elif [ -d "$p" ]; then t=d; elif [ -e "$p" ]; then t=o; else t=-; fi; '
+    'if [ $l = 1 ] || [ $t != - ]; then '
+    's=$(stat -c "%%U %%G %%a %%Y %%s" -- "$p" 2>/dev/null || stat -f "%%Su %%Sg %%Lp %%m %%z" "$p"); '
+    'else s=""; fi; '
+    'echo "@stat $l $t $s"; '
+    'done'
+)
+
+
+def _query_func(use_sudo=False):
+    """
+    Returns the function used to run a command that only reads from the host,
+    and so doesn't invalidate the cached attributes of its files.
+    """
+    if use_sudo and env.user != 'root':
+        return sudo
+    return run
+
+
+def _parse_stat(line):
+    parts = line.split()[1:]
+    is_link, file_type = parts[0] == '1', parts[1]
+    attributes = dict(
+        exists=file_type != '-',
+        is_link=is_link,
+        is_file=file_type == 'f',
+        is_dir=file_type == 'd',
+        owner=None,
+        group=None,
+        mode=None,
+        mtime=None,
+        size=None,
+    )
+    if len(parts) >= 7:
+        attributes.update(
+            owner=parts[2],
+            group=parts[3],
+            mode=parts[4],
+            mtime=int(parts[5]),
+            size=int(parts[6]),
+        )
+    return attributes
+
+
+def stat_many(paths, use_sudo=False):
+    """
+    Get the attributes of many paths with a single remote command.
+
+    Returns a dictionary mapping each path to a dictionary with the keys
+    ``exists``, ``is_link``, ``is_file``, ``is_dir`` (the last two following
+    links), ``owner``, ``group``, ``mode`` (e.g. ``'755'``), ``mtime`` and ``size``.
+
+    Attributes are cached for each host until a command is run on it through
+    burlap, so checking several attributes of the same path costs a single
+    round trip. Code changing files with Fabric's ``run`` or ``sudo``
+    directly should call :func:`burlap.common.invalidate_remote_stats`.
+    """
+    if isinstance(paths, basestring):
+        paths = [paths]
+    cache = get_remote_stats(use_sudo)
+    missing = [path for path in paths if path not in cache]
+    func = _query_func(use_sudo)
+    for i in range(0, len(missing), STAT_BATCH_SIZE):
+        batch = missing[i:i+STAT_BATCH_SIZE]
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            res = func(STAT_SCRIPT % ' '.join(quote(path) for path in batch))
+        lines = [line for line in res.splitlines() if line.startswith('@stat ')]
+        if len(lines) != len(batch):
+            abort('Unable to stat paths: %s' % res)
+        for path, line in zip(batch, lines):
+            cache[path] = _parse_stat(line)
+    return dict((path, cache[path]) for path in paths)
+
+
+def stat(path, use_sudo=False):
+    """
+    Get the attributes of a path, as returned by :func:`stat_many`.
+    """
+    return stat_many([path], use_sudo=use_sudo)[path]
 
 
 def is_file(path, use_sudo=False):
     """
     Check if a path exists, and is a file.
     """
-    func = use_sudo and run_as_root or run
-    with settings(hide('running', 'warnings'), warn_only=True):
-        return func('[ -f "%(path)s" ]' % locals()).succeeded
+    return stat(path, use_sudo)['is_file']
 
 
 def is_dir(path, use_sudo=False):
     """
     Check if a path exists, and is a directory.
     """
-    func = use_sudo and run_as_root or run
-    with settings(hide('running', 'warnings'), warn_only=True):
-        return func('[ -d "%(path)s" ]' % locals()).succeeded
+    return stat(path, use_sudo)['is_dir']
 
 
 def is_link(path, use_sudo=False):
     """
     Check if a path exists, and is a symbolic link.
     """
-    func = use_sudo and run_as_root or run
-    with settings(hide('running', 'warnings'), warn_only=True):
-        return func('[ -L "%(path)s" ]' % locals()).succeeded
+    return stat(path, use_sudo)['is_link']
 
 
 def owner(path, use_sudo=False):
     """
     Get the owner name of a file or directory.
     """
-    func = use_sudo and run_as_root or run
-    # I'd prefer to use quiet=True, but that's not supported with older
-    # versions of Fabric.
-    with settings(hide('running', 'stdout'), warn_only=True):
-        result = func('stat -c %%U "%(path)s"' % locals())
-        if result.failed and 'stat: illegal option' in result:
-            # Try the BSD version of stat
-            return func('stat -f %%Su "%(path)s"' % locals())
-        else:
-            return result
+    return stat(path, use_sudo)['owner']
 
 
 def group(path, use_sudo=False):
     """
     Get the group name of a file or directory.
     """
-    func = use_sudo and run_as_root or run
-    # I'd prefer to use quiet=True, but that's not supported with older
-    # versions of Fabric.
-    with settings(hide('running', 'stdout'), warn_only=True):
-        result = func('stat -c %%G "%(path)s"' % locals())
-        if result.failed and 'stat: illegal option' in result:
-            # Try the BSD version of stat
-            return func('stat -f %%Sg "%(path)s"' % locals())
-        else:
-            return result
+    return stat(path, use_sudo)['group']
 
 
 def mode(path, use_sudo=False):
@@ -89,16 +154,7 @@ def mode(path, use_sudo=False):
     Returns a string such as ``'0755'``, representing permissions as
     an octal number.
     """
-    func = use_sudo and run_as_root or run
-    # I'd prefer to use quiet=True, but that's not supported with older
-    # versions of Fabric.
-    with settings(hide('running', 'stdout'), warn_only=True):
-        result = func('stat -c %%a "%(path)s"' % locals())
-        if result.failed and 'stat: illegal option' in result:
-            # Try the BSD version of stat
-            return func('stat -f %%Op "%(path)s"|cut -c 4-6' % locals())
-        else:
-            return result
+    return stat(path, use_sudo)['mode']
 
 
 def umask(use_sudo=False):
@@ -110,7 +166,7 @@ def umask(use_sudo=False):
 
     If `use_sudo` is `True`, this function returns root's umask.
     """
-    func = use_sudo and run_as_root or run
+    func = _query_func(use_sudo)
     return func('umask')
 
 
@@ -131,6 +187,9 @@ def upload_template(filename, destination, context=None, use_jinja=False,
     ``user`` if specified) is the owner of the remote file.
     """
 
+    invalidate_remote_stats()
+    forget_remote_checksums([destination])
+
     if mkdir:
         remote_dir = os.path.dirname(destination)
         if use_sudo:
@@ -156,44 +215,95 @@ def upload_template(filename, destination, context=None, use_jinja=False,
         run_as_root('chown %s: %s' % (user, quote(destination)))
 
 
+# Commands that may hash files on a host, by algorithm, in order of preference.
+HASH_COMMANDS = {
+    'sha256': [
+        'sha256sum',
+        'shasum -a 256',
+        'sha256 -r', # BSD
+        '/opt/local/gnu/bin/sha256sum', # SmartOS Joyent build
+    ],
+    'md5': [
+        'md5sum', # Linux (LSB)
+        'md5 -r', # BSD / OS X
+        '/opt/local/gnu/bin/md5sum', # SmartOS Joyent build
+        '/opt/local/bin/md5sum',
+    ],
+}
+
+# The hashing command found on each host.
+_hash_commands = {} # {(host string, algorithm): command}
+
+
+def get_hash_command(algorithm='md5'):
+    """
+    Get the command that hashes files with the given algorithm on the host,
+    or with MD5 if the host has no utility for it.
+
+    All candidates are looked for with a single remote command, and the result
+    is remembered for the rest of the run.
+    """
+    key = (env.host_string, algorithm)
+    if key not in _hash_commands:
+        candidates = HASH_COMMANDS[algorithm]
+        if algorithm != 'md5':
+            candidates = candidates + HASH_COMMANDS['md5']
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
+            res = run(' || '.join(
+                '(command -v %s >/dev/null 2>&1 && echo %s)' % (quote(_.split()[0]), quote(_))
+                for _ in candidates))
+        found = [line.strip() for line in res.splitlines() if line.strip() in candidates]
+        if not found:
+            abort('No %s or MD5 utility was found on this system.' % algorithm.upper())
+        _hash_commands[key] = found[0]
+    return _hash_commands[key]
+
+
+def get_hash_algorithm(algorithm='sha256'):
+    """
+    Get the algorithm checksums() really uses on the host when asked for
+    the given one, which is MD5 if the host has no utility for it.
+    """
+    if get_hash_command(algorithm) in HASH_COMMANDS[algorithm]:
+        return algorithm
+    return 'md5'
+
+
+def checksums(filenames, algorithm='sha256', use_sudo=False):
+    """
+    Hash many remote files with a single remote command.
+
+    Returns a dictionary mapping each filename to its hex digest, or to
+    ``None`` if it isn't a readable file.
+    """
+    if isinstance(filenames, basestring):
+        filenames = [filenames]
+    command = get_hash_command(algorithm)
+    func = _query_func(use_sudo)
+    digests = {}
+    for i in range(0, len(filenames), STAT_BATCH_SIZE):
+        batch = filenames[i:i+STAT_BATCH_SIZE]
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
+            res = func(
+                'for p in %s; do '
+                'if [ -f "$p" ]; then echo "@sum $(%s "$p" 2>/dev/null | cut -d" " -f1)"; '
+                'else echo "@sum"; fi; '
+                'done' % (' '.join(quote(_) for _ in batch), command))
+        lines = [line.split() for line in res.splitlines() if line.startswith('@sum')]
+        if len(lines) != len(batch):
+            abort('Unable to hash files: %s' % res)
+        for filename, parts in zip(batch, lines):
+            digests[filename] = parts[1] if len(parts) > 1 else None
+    return digests
+
+
 def md5sum(filename, use_sudo=False):
     """
     Compute the MD5 sum of a file.
     """
-    func = use_sudo and run_as_root or run
-    with settings(hide('running', 'stdout', 'stderr', 'warnings'),
-                  warn_only=True):
-        # Linux (LSB)
-        if exists(u'/usr/bin/md5sum'):
-            res = func(u'/usr/bin/md5sum %(filename)s' % locals())
-        # BSD / OS X
-        elif exists(u'/sbin/md5'):
-            res = func(u'/sbin/md5 -r %(filename)s' % locals())
-        # SmartOS Joyent build
-        elif exists(u'/opt/local/gnu/bin/md5sum'):
-            res = func(u'/opt/local/gnu/bin/md5sum %(filename)s' % locals())
-        # SmartOS Joyent build
-        # (the former doesn't exist, at least on joyent_20130222T000747Z)
-        elif exists(u'/opt/local/bin/md5sum'):
-            res = func(u'/opt/local/bin/md5sum %(filename)s' % locals())
-        # Try to find ``md5sum`` or ``md5`` on ``$PATH`` or abort
-        else:
-            md5sum = func(u'which md5sum')
-            md5 = func(u'which md5')
-            if exists(md5sum):
-                res = func('%(md5sum)s %(filename)s' % locals())
-            elif exists(md5):
-                res = func('%(md5)s %(filename)s' % locals())
-            else:
-                abort('No MD5 utility was found on this system.')
-
-    if res.succeeded:
-        parts = res.split()
-        _md5sum = len(parts) > 0 and parts[0] or None
-    else:
-        warn(res)
-        _md5sum = None
-
+    _md5sum = checksums([filename], algorithm='md5', use_sudo=use_sudo)[filename]
+    if _md5sum is None:
+        warn('Unable to compute the MD5 sum of %s.' % filename)
     return _md5sum
 
 
@@ -252,16 +362,11 @@ class watch(object):
         self.changed = False
 
     def __enter__(self):
-        with settings(hide('warnings')):
-            for filename in self.filenames:
-                self.digest[filename] = md5sum(filename, self.use_sudo)
+        self.digest = checksums(self.filenames, use_sudo=self.use_sudo)
         return self
 
     def __exit__(self, type, value, tb):
-        for filename in self.filenames:
-            if md5sum(filename, self.use_sudo) != self.digest[filename]:
-                self.changed = True
-                break
+        self.changed = checksums(self.filenames, use_sudo=self.use_sudo) != self.digest
         if self.changed and self.callback:
             self.callback()
 
@@ -270,7 +375,7 @@ def uncommented_lines(filename, use_sudo=False):
     """
     Get the lines of a remote file, ignoring empty or commented ones
     """
-    func = run_as_root if use_sudo else run
+    func = _query_func(use_sudo)
     res = func('cat %s' % quote(filename), quiet=True)
     if res.succeeded:
         return [line for line in res.splitlines()
@@ -286,40 +391,53 @@ def getmtime(path, use_sudo=False):
 
     Same as :py:func:`os.path.getmtime()`
     """
-    func = use_sudo and run_as_root or run
-    with settings(hide('running', 'stdout')):
-        return int(func('stat -c %%Y "%(path)s" ' % locals()).strip())
+    mtime = stat(path, use_sudo)['mtime']
+    if mtime is None:
+        abort('Unable to get the modification time of %s: No such file or directory' % path)
+    return mtime
 
 
 def copy(source, destination, recursive=False, use_sudo=False):
     """
     Copy a file or directory
     """
+    invalidate_remote_stats()
     func = use_sudo and run_as_root or run
     options = '-r ' if recursive else ''
-    func('/bin/cp {0}{1} {2}'.format(options, quote(source), quote(destination)))
+    command = '/bin/cp {0}{1} {2}'.format(options, quote(source), quote(destination))
+    forget_remote_checksums(command=command)
+    func(command)
 
 
 def move(source, destination, use_sudo=False):
     """
     Move a file or directory
     """
+    invalidate_remote_stats()
     func = use_sudo and run_as_root or run
-    func('/bin/mv {0} {1}'.format(quote(source), quote(destination)))
+    command = '/bin/mv {0} {1}'.format(quote(source), quote(destination))
+    forget_remote_checksums(command=command)
+    func(command)
 
 
 def symlink(source, destination, use_sudo=False):
     """
     Create a symbolic link to a file or directory
     """
+    invalidate_remote_stats()
     func = use_sudo and run_as_root or run
-    func('/bin/ln -s {0} {1}'.format(quote(source), quote(destination)))
+    command = '/bin/ln -s {0} {1}'.format(quote(source), quote(destination))
+    forget_remote_checksums(command=command)
+    func(command)
 
 
 def remove(path, recursive=False, use_sudo=False):
     """
     Remove a file or directory
     """
+    invalidate_remote_stats()
     func = use_sudo and run_as_root or run
     options = '-r ' if recursive else ''
-    func('/bin/rm {0}{1}'.format(options, quote(path)))
+    command = '/bin/rm {0}{1}'.format(options, quote(path))
+    forget_remote_checksums(command=command)
+    func(command)
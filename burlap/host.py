@@ -166,6 +166,9 @@ class HostnameSatchel(Satchel):
         self.sudo_or_dryrun('echo "127.0.0.1 %(hostname)s" | cat - /etc/hosts > /tmp/out && mv /tmp/out /etc/hosts' % kwargs)
         self.sudo_or_dryrun('service hostname restart; sleep 3')
         
+        from burlap.facts import forget_facts
+        forget_facts()
+        
     
     configure.deploy_before = []
 
@@ -0,0 +1,295 @@
+"""
+Lazy satchel module loading
+===========================
+
+Importing a satchel module instantiates its satchels, which registers their
+tasks, deployers and default settings. Rather than paying that cost for every
+module on every invocation, an index persisted in the burlap data directory
+records the tasks each module exposes, and the real module is only imported
+the first time one of its tasks is looked up or run.
+
+The index is rebuilt, by importing everything up front, whenever burlap's
+sources change. To disable lazy loading entirely, set:
+
+    export BURLAP_LAZY_LOAD=0
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import types
+import pkgutil
+import threading
+
+from fabric.api import env
+from fabric.tasks import Task
+
+from burlap import common
+
+enabled = int(os.environ.get('BURLAP_LAZY_LOAD', 1))
+
+# Bump whenever the structure of the index changes.
+INDEX_FORMAT = 1
+
+env.lazy_index_fn = '%(burlap_data_dir)s/task_index.json'
+
+_lock = threading.RLock()
+
+_path = None
+
+# Modules recorded while building a new index, in import order.
+_index_modules = []
+
+_modules = {} # {module_name: real module}
+
+_stubs = {} # {namespace: LazyModule}
+
+_namespace_modules = {} # {namespace: module_name}
+
+_satchel_modules = {} # {satchel_name: module_name}
+
+# The settings of the currently loaded role, re-applied to satchels loaded after it.
+_role_settings = {}
+
+_callbacks_run = 0
+
+class LazyTask(Task):
+    """
+    A placeholder for a task whose module has not been imported yet.
+
+    Fabric can list it without importing anything. The first time it's run,
+    or any attribute not known from the index is accessed, the real module is
+    imported and the call delegated to the real task.
+    """
+
+    def __init__(self, namespace, name, doc=None):
+        super(LazyTask, self).__init__(name=name)
+        self.namespace = namespace
+        self.__doc__ = doc
+
+    @property
+    def real_task(self):
+        return getattr(load_namespace(self.namespace), self.name)
+
+    def __getattr__(self, attrname):
+        if attrname.startswith('__') or attrname in ('namespace', 'real_task'):
+            raise AttributeError(attrname)
+        return getattr(self.real_task, attrname)
+
+    def __details__(self):
+        return self.real_task.__details__()
+
+    def get_hosts_and_effective_roles(self, *args, **kwargs):
+        return self.real_task.get_hosts_and_effective_roles(*args, **kwargs)
+
+    def get_pool_size(self, *args, **kwargs):
+        return self.real_task.get_pool_size(*args, **kwargs)
+
+    def run(self, *args, **kwargs):
+        return self.real_task.run(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        return self.real_task(*args, **kwargs)
+
+class LazyModule(types.ModuleType):
+    """
+    A placeholder for a module, or virtual satchel module, that has not been imported yet.
+    """
+
+    def __init__(self, namespace, tasks):
+        super(LazyModule, self).__init__(str(namespace))
+        for task_name, doc in tasks.items():
+            self.__dict__[str(task_name)] = LazyTask(namespace=namespace, name=str(task_name), doc=doc)
+
+    def __getattr__(self, attrname):
+        if attrname.startswith('__'):
+            raise AttributeError(attrname)
+        return getattr(load_namespace(self.__name__), attrname)
+
+def get_index_filename():
+    return env.lazy_index_fn % env
+
+def get_source_state(fqfn):
+    """
+    Returns the (mtime, size) of a module's source, or the sum over all its files for a package.
+    """
+    if os.path.isdir(fqfn):
+        mtime = 0
+        size = 0
+        for dirpath, _, filenames in os.walk(fqfn):
+            for fn in filenames:
+                if fn.endswith('.py'):
+                    st = os.stat(os.path.join(dirpath, fn))
+                    mtime = max(mtime, st.st_mtime)
+                    size += st.st_size
+        return mtime, size
+    st = os.stat(fqfn)
+    return st.st_mtime, st.st_size
+
+def get_signature(path):
+    """
+    Returns a value that changes whenever any of burlap's modules change,
+    which invalidates the whole index.
+    """
+    from burlap import __version__
+    parts = ['%s:%s' % (__version__, INDEX_FORMAT)]
+    for importer, module_name, _ in sorted(pkgutil.iter_modules(path), key=lambda o: o[1]):
+        loader = importer.find_module(module_name)
+        fqfn = getattr(loader, 'filename', None) or getattr(loader, 'path', None)
+        if not fqfn:
+            continue
+        parts.append('%s:%s:%s' % ((module_name,) + get_source_state(fqfn)))
+    return ';'.join(parts)
+
+def read_index(path):
+    """
+    Returns the list of recorded modules if the index exists and is current, otherwise None.
+    """
+    global _path
+    _path = path
+    if not enabled:
+        return
+    try:
+        with open(get_index_filename()) as fin:
+            data = json.load(fin)
+    except (IOError, OSError, ValueError):
+        return
+    if data.get('signature') != get_signature(path):
+        return
+    return data.get('modules')
+
+def write_index(path):
+    """
+    Atomically saves the modules recorded by record_module().
+    """
+    if not enabled:
+        return
+    fn = get_index_filename()
+    tmp_fn = '%s.%s.tmp' % (fn, os.getpid())
+    try:
+        common.init_burlap_data_dir()
+        with open(tmp_fn, 'w') as fout:
+            json.dump(
+                {'signature': get_signature(path), 'modules': _index_modules},
+                fout, indent=4, sort_keys=True)
+        os.rename(tmp_fn, fn)
+    except (IOError, OSError) as e:
+        print('Unable to save task index %s: %s' % (fn, e), file=sys.stderr)
+
+def get_module_tasks(module):
+    """
+    Returns a dictionary of {name: docstring} for all Fabric tasks directly in the module.
+    """
+    names = vars(module).get('__all__') or list(vars(module))
+    tasks = {}
+    for name in names:
+        obj = vars(module).get(name)
+        if isinstance(obj, Task) and obj.use_task_objects:
+            tasks[name] = obj.__doc__
+    return tasks
+
+def snapshot():
+    return set(common._post_import_modules), set(common.all_satchels)
+
+def record_module(module_name, module, before):
+    """
+    Records the tasks and satchels registered by importing a module,
+    given the snapshot() taken immediately before importing it.
+    """
+    post_import_modules, satchels = before
+    namespaces = {module_name: get_module_tasks(module)}
+    for namespace in sorted(common._post_import_modules - post_import_modules):
+        namespaces[namespace] = get_module_tasks(sys.modules[namespace])
+    _modules[module_name] = module
+    _index_modules.append({
+        'name': module_name,
+        'namespaces': namespaces,
+        'satchels': sorted(_.lower() for _ in set(common.all_satchels) - satchels),
+    })
+
+def install(modules):
+    """
+    Creates placeholders for every module in the index.
+
+    Returns a list of (namespace, placeholder) tuples, with each module's own
+    namespace listed before any virtual satchel namespaces it creates.
+    """
+    ret = []
+    for data in modules:
+        module_name = str(data['name'])
+        for satchel_name in data['satchels']:
+            _satchel_modules[str(satchel_name)] = module_name
+        namespaces = data['namespaces']
+        for namespace in [module_name] + sorted(set(namespaces) - set([module_name])):
+            namespace = str(namespace)
+            if namespace in _namespace_modules:
+                continue
+            _namespace_modules[namespace] = module_name
+            _stubs[namespace] = LazyModule(namespace, namespaces.get(namespace) or {})
+            ret.append((namespace, _stubs[namespace]))
+    return ret
+
+def load_module(module_name):
+    """
+    Imports the real module, if not done so already, and returns it.
+    """
+    with _lock:
+        if module_name not in _modules:
+            if common.get_verbose():
+                print('Loading module %s.' % module_name, file=sys.stderr)
+            satchels = set(common.all_satchels)
+            importer = pkgutil.get_importer(_path[0])
+            _modules[module_name] = importer.find_module(module_name).load_module(module_name)
+
+            # Satchel defaults are only set on first import, so re-apply the
+            # role's settings or they'd be clobbered.
+            for satchel_name in set(common.all_satchels) - satchels:
+                prefix = '%s_' % satchel_name.lower()
+                for k, v in _role_settings.items():
+                    if k.startswith(prefix):
+                        env[k] = v
+
+            run_post_callbacks()
+        return _modules[module_name]
+
+def load_namespace(namespace):
+    """
+    Returns the real module, or virtual satchel module, for the given namespace.
+    """
+    module_name = _namespace_modules[namespace]
+    module = load_module(module_name)
+    if namespace == module_name:
+        return module
+    return sys.modules[namespace]
+
+def load_satchels(names):
+    """
+    Ensures the modules defining the given satchels have been imported.
+    """
+    for name in names or []:
+        module_name = _satchel_modules.get(name.strip().lower())
+        if module_name:
+            load_module(module_name)
+
+def get_role_satchels(d):
+    """
+    Returns the names of the indexed satchels that have settings in the given role settings,
+    since their manifests and packages count even if they aren't listed as services.
+    """
+    prefixes = set(k.split('_', 1)[0].lower() for k in d if '_' in k)
+    return sorted(_ for _ in _satchel_modules if _ in prefixes)
+
+def set_role_settings(d):
+    _role_settings.clear()
+    _role_settings.update(d)
+
+def run_post_callbacks():
+    """
+    Executes any callbacks registered by modules imported since the last call.
+    """
+    global _callbacks_run
+    while _callbacks_run < len(env.post_callbacks):
+        cb = env.post_callbacks[_callbacks_run]
+        _callbacks_run += 1
+        cb()
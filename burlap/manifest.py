@@ -24,6 +24,7 @@ from burlap.decorators import task_or_dryrun
 @runs_once
 def show(name):
     name = name.strip().lower()
+    common.load_satchels([name])
     func = common.manifest_recorder[name]
     ret = func()
     print(ret)
@@ -32,6 +33,7 @@ def show(name):
 @runs_once
 def get_current(name):
     name = name.strip().lower()
+    common.load_satchels([name])
     func = common.manifest_recorder[name]
     return func()
     
@@ -52,6 +54,7 @@ def get_last(name):
 def changed(name):
     from burlap.deploy import get_last_thumbprint
     name = name.strip().lower()
+    common.load_satchels([name])
     if name not in common.manifest_recorder:
         print('No manifest recorder has been registered for component "%s"' % name)
     else:
@@ -36,6 +36,8 @@ from burlap.common import (
     Satchel,
     Deployer,
     get_verbose,
+    LayeredContext,
+    get_ssh_control_options,
 )
 from burlap.decorators import task_or_dryrun
 from burlap import versioner
@@ -80,18 +82,17 @@ def render_paths(e=None):
     
     _global_env = e is None
     
-    e = e or env
-    e = type(e)(e)
+    e = LayeredContext(env if e is None else e)
     
     e.pip_path_versioned = e.pip_path % e
-    e = render_remote_paths(e)
+    e.update(render_remote_paths(e).get_overrides())
     if e.pip_virtual_env_dir_template:
         e.pip_virtual_env_dir = e.pip_virtual_env_dir_template % e
     if e.is_local:
         e.pip_virtual_env_dir = os.path.abspath(e.pip_virtual_env_dir)
     
     if _global_env:
-        env.update(e)
+        env.update(e.get_overrides())
     
     return e
 
@@ -860,7 +861,8 @@ def install(package='', clean=0, no_deps=1, all=0, upgrade=1):
             env.pip_cache_dir = env.pip_cache_dir + '/'
         
         env.pip_key_filename = os.path.abspath(env.key_filename)
-        local_or_dryrun('rsync -avz --progress --rsh "ssh -o StrictHostKeyChecking=no -i %(pip_key_filename)s" %(pip_local_cache_dir)s/* %(user)s@%(host_string)s:%(pip_cache_dir)s' % env)
+        env.pip_ssh_control_options = get_ssh_control_options()
+        local_or_dryrun('rsync -avz --progress --rsh "ssh -o StrictHostKeyChecking=no %(pip_ssh_control_options)s -i %(pip_key_filename)s" %(pip_local_cache_dir)s/* %(user)s@%(host_string)s:%(pip_cache_dir)s' % env)
     
     env.pip_upgrade_flag = ''
     if int(upgrade):
@@ -929,6 +931,9 @@ class PIPSatchel(Satchel):
             print(data)
         return data
     
+    def get_tracked_paths(self):
+        return [(find_template(env.pip_requirements_fn), None)]
+    
     def configure(self, *args, **kwargs):
         return update_install(*args, **kwargs)
     
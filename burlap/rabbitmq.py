@@ -184,16 +184,17 @@ class RabbitMQSatchel(ServiceSatchel):
         
         params = sorted(list(params))
         if not only_data:
-            for user, password, vhost in params:
-                self.env.broker_user = user
-                self.env.broker_password = password
-                self.env.broker_vhost = vhost
-                with settings(warn_only=True):
-                    self.sudo_or_dryrun('rabbitmqctl add_user %(rabbitmq_broker_user)s %(rabbitmq_broker_password)s' % self.genv)
-                    cmd = 'rabbitmqctl add_vhost %(rabbitmq_broker_vhost)s' % self.genv
-                    self.sudo_or_dryrun(cmd)
-                    cmd = 'rabbitmqctl set_permissions -p %(rabbitmq_broker_vhost)s %(rabbitmq_broker_user)s ".*" ".*" ".*"' % self.genv
-                    self.sudo_or_dryrun(cmd)
+            with self.batch():
+                for user, password, vhost in params:
+                    self.env.broker_user = user
+                    self.env.broker_password = password
+                    self.env.broker_vhost = vhost
+                    with settings(warn_only=True):
+                        self.sudo_or_dryrun('rabbitmqctl add_user %(rabbitmq_broker_user)s %(rabbitmq_broker_password)s' % self.genv)
+                        cmd = 'rabbitmqctl add_vhost %(rabbitmq_broker_vhost)s' % self.genv
+                        self.sudo_or_dryrun(cmd)
+                        cmd = 'rabbitmqctl set_permissions -p %(rabbitmq_broker_vhost)s %(rabbitmq_broker_user)s ".*" ".*" ".*"' % self.genv
+                        self.sudo_or_dryrun(cmd)
                     
         return params
     
@@ -23,8 +23,11 @@ from burlap.files import (
     md5sum,
     mode as _mode,
     owner as _owner,
+    stat_many,
     umask,
+    STAT_BATCH_SIZE,
 )
+from burlap.common import invalidate_remote_stats
 from burlap.utils import run_as_root
 import burlap.files
 
@@ -46,19 +49,7 @@ def directory(path, use_sudo=False, owner='', group='', mode=''):
               ``burlap.require`` module for convenience.
 
     """
-    func = use_sudo and run_as_root or run
-
-    if not is_dir(path):
-        func('mkdir -p "%(path)s"' % locals())
-
-    # Ensure correct owner
-    if (owner and _owner(path, use_sudo) != owner) or \
-       (group and _group(path, use_sudo) != group):
-        func('chown %(owner)s:%(group)s "%(path)s"' % locals())
-
-    # Ensure correct mode
-    if mode and _mode(path, use_sudo) != mode:
-        func('chmod %(mode)s "%(path)s"' % locals())
+    directories([path], use_sudo=use_sudo, owner=owner, group=group, mode=mode)
 
 
 def directories(path_list, use_sudo=False, owner='', group='', mode=''):
@@ -75,11 +66,40 @@ def directories(path_list, use_sudo=False, owner='', group='', mode=''):
         ]
         require.directories(dirs, owner='alice', mode='750')
 
+    All the directories are checked, created and fixed with a handful of
+    remote commands, however many there are.
+
     .. note:: This function can be accessed directly from the
               ``burlap.require`` module for convenience.
     """
-    for path in path_list:
-        directory(path, use_sudo, owner, group, mode)
+    func = use_sudo and run_as_root or run
+
+    def run_many(command, paths):
+        for i in range(0, len(paths), STAT_BATCH_SIZE):
+            func(command + ' ' + ' '.join(quote(path) for path in paths[i:i+STAT_BATCH_SIZE]))
+        invalidate_remote_stats(paths)
+
+    stats = stat_many(path_list, use_sudo)
+    missing = [path for path in path_list if not stats[path]['is_dir']]
+    if missing:
+        run_many('mkdir -p', missing)
+
+    if not (owner or group or mode):
+        return
+    stats = stat_many(path_list, use_sudo)
+
+    # Ensure correct owner
+    wrong_owner = [
+        path for path in path_list
+        if (owner and stats[path]['owner'] != owner) or (group and stats[path]['group'] != group)
+    ]
+    if wrong_owner:
+        run_many('chown %s:%s' % (owner, group), wrong_owner)
+
+    # Ensure correct mode
+    wrong_mode = [path for path in path_list if mode and stats[path]['mode'] != mode]
+    if wrong_mode:
+        run_many('chmod %s' % mode, wrong_mode)
 
 
 def file(path=None, contents=None, source=None, url=None, md5=None,
@@ -139,6 +159,7 @@ def file(path=None, contents=None, source=None, url=None, md5=None,
         assert path
         if not is_file(path):
             func('touch "%(path)s"' % locals())
+            invalidate_remote_stats([path])
 
     # 2) A URL is specified (path is optional)
     elif url:
@@ -147,6 +168,7 @@ def file(path=None, contents=None, source=None, url=None, md5=None,
 
         if not is_file(path) or md5 and md5sum(path) != md5:
             func('wget --progress=dot:mega %(url)s -O %(path)s' % locals())
+            invalidate_remote_stats([path])
 
     # 3) A local filename, or a content string, is specified
     else:
@@ -179,6 +201,7 @@ def file(path=None, contents=None, source=None, url=None, md5=None,
                     md5sum(path, use_sudo=use_sudo) != digest.hexdigest())):
             with settings(hide('running')):
                 put(source, path, use_sudo=use_sudo, temp_dir=temp_dir)
+            invalidate_remote_stats([path])
 
         if t is not None:
             os.unlink(source)
@@ -189,6 +212,7 @@ def file(path=None, contents=None, source=None, url=None, md5=None,
     if (owner and _owner(path, use_sudo) != owner) or \
        (group and _group(path, use_sudo) != group):
         func('chown %(owner)s:%(group)s "%(path)s"' % locals())
+        invalidate_remote_stats([path])
 
     # Ensure correct mode
     if use_sudo and mode is None:
@@ -196,6 +220,7 @@ def file(path=None, contents=None, source=None, url=None, md5=None,
         mode = oct(438 & ~int(umask(use_sudo=True), base=8)).replace('0o', '0')
     if mode and _mode(path, use_sudo) != mode:
         func('chmod %(mode)s "%(path)s"' % locals())
+        invalidate_remote_stats([path])
 
 
 def template_file(path=None, template_contents=None, template_source=None, context=None, **kwargs):
@@ -8,8 +8,9 @@ and repositories.
 """
 from __future__ import print_function
 
-from fabric.api import hide, run, settings
+from fabric.api import env, hide, run, settings
 
+from burlap.common import _installed_packages, forget_installed_packages
 from burlap.utils import run_as_root
 
 
@@ -55,16 +56,44 @@ def groupupdate(group, options=None):
     run_as_root('%(manager)s %(options)s groupupdate "%(group)s"' % locals())
 
 
+def get_installed_packages(refresh=False):
+    """
+    Get the version of every RPM package installed, by name, by name
+    qualified with its architecture, like "glibc.i686", and by name with
+    its version, like "nano-2.3.1-10.el7", since installonly packages,
+    like kernel, may have several versions installed at once.
+
+    All packages are listed with a single remote command, and remembered
+    until a package manager runs on the host.
+    """
+    if refresh or env.host_string not in _installed_packages:
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
+            res = run("rpm --query --all --queryformat '%{NAME} %{VERSION}-%{RELEASE} %{ARCH}\\n'")
+        packages = {}
+        for line in res.splitlines():
+            parts = line.split()
+            if len(parts) == 3:
+                name, version, arch = parts
+                for key in (
+                    name,
+                    '%s.%s' % (name, arch),
+                    '%s-%s' % (name, version),
+                    '%s-%s' % (name, version.split('-')[0]),
+                    '%s-%s.%s' % (name, version, arch),
+                ):
+                    packages[key] = version
+        _installed_packages[env.host_string] = packages
+    return _installed_packages[env.host_string]
+
+
 def is_installed(pkg_name):
     """
     Check if an RPM package is installed.
+
+    The name may be qualified with an architecture, like "glibc.i686", or
+    a version, like "nano-2.3.1-10.el7".
     """
-    manager = MANAGER
-    with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
-        res = run("rpm --query %(pkg_name)s" % locals())
-        if res.succeeded:
-            return True
-        return False
+    return pkg_name in get_installed_packages()
 
 
 def install(packages, repos=None, yes=None, options=None):
@@ -107,6 +136,8 @@ def install(packages, repos=None, yes=None, options=None):
         run_as_root('yes %(yes)s | %(manager)s %(options)s install %(packages)s' % locals())
     else:
         run_as_root('%(manager)s %(options)s install %(packages)s' % locals())
+    # List the inventory again when next needed, since dependencies may have been installed or the install failed.
+    forget_installed_packages()
 
 
 def groupinstall(group, options=None):
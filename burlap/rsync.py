@@ -4,6 +4,7 @@ import os
 import hashlib
 
 from burlap import Satchel
+from burlap.common import get_ssh_control_options
 from burlap.constants import *
 
 class RsyncSatchel(Satchel):
@@ -31,7 +32,7 @@ class RsyncSatchel(Satchel):
         self.env.extra_dirs = []
         self.env.chown_user = 'www-data'
         self.env.chown_group = 'www-data'
-        self.env.command = 'rsync --verbose --compress --recursive --delete --rsh "ssh -i {key_filename}" {exclusions_str} {rsync_src_dir} {user}@{host_string}:{rsync_dst_dir}'
+        self.env.command = 'rsync --verbose --compress --recursive --delete --rsh "ssh {ssh_control_options} -i {key_filename}" {exclusions_str} {rsync_src_dir} {user}@{host_string}:{rsync_dst_dir}'
     
     def deploy_code(self):
         """
@@ -46,6 +47,8 @@ class RsyncSatchel(Satchel):
         if self.env.exclusions:
             _env.exclusions_str = ' '.join(
                 "--exclude='%s'" % _ for _ in self.env.exclusions)
+        
+        _env.ssh_control_options = get_ssh_control_options(_env.host_string)
             
         cmd = _env.rsync_command.format(**_env)
         self.local_or_dryrun(cmd)
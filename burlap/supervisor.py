@@ -12,6 +12,7 @@ from __future__ import print_function
 
 import os
 import re
+import sys
 import time
 
 from fabric.api import hide, settings
@@ -192,6 +193,8 @@ class SupervisorSatchel(ServiceSatchel):
         """
         Collects the configurations for all registered services and writes
         the appropriate supervisord.conf file.
+        
+        Supervisor is only updated if a configuration file changed.
         """
         from burlap.common import iter_sites
         
@@ -202,29 +205,34 @@ class SupervisorSatchel(ServiceSatchel):
         supervisor_services = []
         process_groups = []
         
-        for site, site_data in iter_sites(site=site, renderer=self.render_paths):
-            if verbose:
-                print(site)
-            for cb in self.genv._supervisor_create_service_callbacks:
-                ret = cb()
-                if isinstance(ret, basestring):
-                    supervisor_services.append(ret)
-                elif isinstance(ret, tuple):
-                    assert len(ret) == 2
-                    conf_name, conf_content = ret
-                    if verbose:
-                        print('conf_name:', conf_name)
-                        print('conf_content:', conf_content)
-                    remote_fn = os.path.join(self.env.conf_dir, conf_name)
-                    local_fn = self.write_to_file(conf_content)
-                    self.put_or_dryrun(local_path=local_fn, remote_path=remote_fn, use_sudo=True)
-                    
-                    process_groups.append(os.path.splitext(conf_name)[0])
-                    
-        self.env.services_rendered = '\n'.join(supervisor_services)
-    
-        fn = self.render_to_file(self.env.config_template)
-        self.put_or_dryrun(local_path=fn, remote_path=self.env.config_path, use_sudo=True)
+        # Send the service configurations and supervisord.conf in one transfer.
+        with self.bundle() as bundle:
+            for site, site_data in iter_sites(site=site, renderer=self.render_paths):
+                if verbose:
+                    print(site)
+                for cb in self.genv._supervisor_create_service_callbacks:
+                    ret = cb()
+                    if isinstance(ret, basestring):
+                        supervisor_services.append(ret)
+                    elif isinstance(ret, tuple):
+                        assert len(ret) == 2
+                        conf_name, conf_content = ret
+                        if verbose:
+                            print('conf_name:', conf_name)
+                            print('conf_content:', conf_content)
+                        remote_fn = os.path.join(self.env.conf_dir, conf_name)
+                        bundle.add(remote_fn, content=conf_content)
+                        
+                        process_groups.append(os.path.splitext(conf_name)[0])
+                        
+            self.env.services_rendered = '\n'.join(supervisor_services)
+        
+            fn = self.render_to_file(self.env.config_template)
+            bundle.add(self.env.config_path, local_path=fn)
+        
+        if not bundle.uploaded:
+            print('Supervisor configuration is unchanged.', file=sys.stderr)
+            return False
         
         for pg in process_groups:
             self.sudo_or_dryrun('supervisorctl add %s' % pg)
@@ -233,6 +241,7 @@ class SupervisorSatchel(ServiceSatchel):
         self.sudo_or_dryrun('supervisorctl restart all')
         self.sudo_or_dryrun('supervisorctl reread')
         self.sudo_or_dryrun('supervisorctl update')
+        return True
     
     def configure(self, **kwargs):
         kwargs['site'] = ALL
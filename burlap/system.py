@@ -6,6 +6,7 @@ from __future__ import print_function
 
 from fabric.api import hide, run, settings
 
+from burlap.facts import forget_facts, get_fact
 from burlap.files import is_file
 from burlap.utils import read_lines, run_as_root
 
@@ -53,36 +54,7 @@ def distrib_id():
 
     """
 
-    with settings(hide('running', 'stdout')):
-        kernel = run('uname -s')
-
-        if kernel == 'Linux':
-            # lsb_release works on Ubuntu and Debian >= 6.0
-            # but is not always included in other distros
-            if is_file('/usr/bin/lsb_release'):
-                id_ = run('lsb_release --id --short')
-                if id in ['arch', 'Archlinux']:  # old IDs used before lsb-release 1.4-14
-                    id_ = 'Arch'
-                return id_
-            else:
-                if is_file('/etc/debian_version'):
-                    return "Debian"
-                elif is_file('/etc/fedora-release'):
-                    return "Fedora"
-                elif is_file('/etc/arch-release'):
-                    return "Arch"
-                elif is_file('/etc/redhat-release'):
-                    release = run('cat /etc/redhat-release')
-                    if release.startswith('Red Hat Enterprise Linux'):
-                        return "RHEL"
-                    elif release.startswith('CentOS'):
-                        return "CentOS"
-                    elif release.startswith('Scientific Linux'):
-                        return "SLES"
-                elif is_file('/etc/gentoo-release'):
-                    return "Gentoo"
-        elif kernel == "SunOS":
-            return "SunOS"
+    return get_fact('distrib_id')
 
 
 def distrib_release():
@@ -98,15 +70,10 @@ def distrib_release():
 
     """
 
-    with settings(hide('running', 'stdout')):
-
-        kernel = run('uname -s')
-
-        if kernel == 'Linux':
-            return run('lsb_release -r --short')
-
-        elif kernel == 'SunOS':
+    if get_fact('kernel') == 'SunOS':
+        with settings(hide('running', 'stdout')):
             return run('uname -v')
+    return get_fact('distrib_release')
 
 
 def distrib_codename():
@@ -121,8 +88,7 @@ def distrib_codename():
             print(u"Ubuntu 12.04 LTS detected")
 
     """
-    with settings(hide('running', 'stdout')):
-        return run('lsb_release --codename --short')
+    return get_fact('distrib_codename')
 
 
 def distrib_desc():
@@ -131,10 +97,7 @@ def distrib_desc():
 
     For example: ``Debian GNU/Linux 6.0.7 (squeeze)``.
     """
-    with settings(hide('running', 'stdout')):
-        if not is_file('/etc/redhat-release'):
-            return run('lsb_release --desc --short')
-        return run('cat /etc/redhat-release')
+    return get_fact('distrib_desc')
 
 
 def distrib_family():
@@ -163,8 +126,7 @@ def get_hostname():
     """
     Get the fully qualified hostname.
     """
-    with settings(hide('running', 'stdout')):
-        return run('hostname --fqdn')
+    return get_fact('fqdn')
 
 
 def set_hostname(hostname, persist=True):
@@ -174,6 +136,7 @@ def set_hostname(hostname, persist=True):
     run_as_root('hostname %s' % hostname)
     if persist:
         run_as_root('echo %s >/etc/hostname' % hostname)
+    forget_facts()
 
 
 def get_sysctl(key):
@@ -257,9 +220,7 @@ def get_arch():
             print(u"Running on a 64-bit Intel/AMD system")
 
     """
-    with settings(hide('running', 'stdout')):
-        arch = run('uname -m')
-        return arch
+    return get_fact('arch')
 
 
 def cpus():
@@ -273,10 +234,18 @@ def cpus():
         nb_workers = 2 * cpus() + 1
 
     """
-    with settings(hide('running', 'stdout')):
-        res = run('python -c "import multiprocessing; '
-                  'print(multiprocessing.cpu_count())"')
-        return int(res)
+    count = get_fact('cpus')
+    if count is None:
+        # Hosts without nproc or getconf, so fall back to asking the kernel or Python.
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            res = run('grep -c ^processor /proc/cpuinfo')
+        if res.succeeded and res.strip().isdigit():
+            count = res.strip()
+        else:
+            with settings(hide('running', 'stdout')):
+                count = run('python -c "import multiprocessing; '
+                            'print(multiprocessing.cpu_count())"')
+    return int(count)
 
 
 def using_systemd():
@@ -292,7 +261,7 @@ def using_systemd():
             pass
 
     """
-    return run('which systemctl', quiet=True).succeeded
+    return get_fact('init') == 'systemd'
 
 
 def time():
@@ -5,7 +5,7 @@ import hashlib
 
 from burlap import Satchel
 from burlap.constants import *
-from burlap.common import only_hostname
+from burlap.common import only_hostname, get_ssh_control_options
 
 TARBALL = 'tarball'
 RSYNC = 'rsync'
@@ -32,7 +32,7 @@ class TarballSatchel(Satchel):
         self.env.rsync_source_dirs = [] # This overrides rsync_source_dir
         self.env.rsync_target_dir = None
         self.env.rsync_target_host = '%(user)s@%(host_string)s:'
-        self.env.rsync_auth = '--rsh "ssh -t -o StrictHostKeyChecking=no -i %(key_filename)s"' 
+        self.env.rsync_auth = '--rsh "ssh -t -o StrictHostKeyChecking=no %(ssh_control_options)s -i %(key_filename)s"' 
         self.env.rsync_command_template = ('rsync '
             '--recursive --verbose --perms --times --links '
             '--compress --copy-links %(tarball_exclude_str)s '
@@ -77,15 +77,20 @@ class TarballSatchel(Satchel):
         Called after a deployment to record any data necessary to detect changes
         for a future deployment.
         """
-        from burlap.common import get_last_modified_timestamp
-        self.get_tarball_path()
-        fn = self.env.absolute_src_dir
+        from burlap.common import get_content_fingerprint
+        fn, exclude = self.get_tracked_paths()[0]
         if self.verbose:
             print('tarball.fn:', fn)
-        data = get_last_modified_timestamp(fn)
+        data = get_content_fingerprint(fn, exclude=exclude)
         if self.verbose:
             print(data)
         return data
+    
+    def get_tracked_paths(self):
+        self.get_tarball_path()
+        # Skip what tar does, including everything --exclude-vcs does.
+        exclude = list(self.env.exclusions) + ['.git', '.gitignore', '.hg', '.hgignore', '.svn', '.bzr', 'CVS']
+        return [(self.env.absolute_src_dir, exclude)]
         
     def get_tarball_path(self):
         self.env.gzip_flag = ''
@@ -138,12 +143,13 @@ class TarballSatchel(Satchel):
         
         # Mark executables.
         print('Marking source files as executable...')
-        self.sudo_or_dryrun(
-            'chmod +x %(remote_app_src_package_dir)s/*' % genv)
-        self.sudo_or_dryrun(
-            'chmod -R %(apache_chmod)s %(remote_app_src_package_dir)s' % genv)
-        self.sudo_or_dryrun(
-            'chown -R %(apache_user)s:%(apache_group)s %(remote_app_dir)s' % genv)
+        with self.batch():
+            self.sudo_or_dryrun(
+                'chmod +x %(remote_app_src_package_dir)s/*' % genv)
+            self.sudo_or_dryrun(
+                'chmod -R %(apache_chmod)s %(remote_app_src_package_dir)s' % genv)
+            self.sudo_or_dryrun(
+                'chown -R %(apache_user)s:%(apache_group)s %(remote_app_dir)s' % genv)
     
     def _run_rsync(self, src, dst, genv):
         print('rsync %s -> %s' % (src, dst))
@@ -157,6 +163,7 @@ class TarballSatchel(Satchel):
             src.replace('/', '_'))
         genv.tarball_rsync_target_dir = tmp_dir
         genv.tarball_rsync_source_dir = src
+        genv.ssh_control_options = get_ssh_control_options(genv.host_string)
         tmp_rsync_command = (self.env.rsync_command_template % genv) % genv
         self.local_or_dryrun(tmp_rsync_command)
         
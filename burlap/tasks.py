@@ -28,11 +28,16 @@ class WrappedCallableTask(_WrappedCallableTask):
         return self.run(*args, **kwargs)
 
     def run(self, *args, **kwargs):
-        from burlap.common import set_dryrun, set_verbose
+        from burlap.common import set_dryrun, set_verbose, push_task, pop_task
         if 'dryrun' in kwargs:
             set_dryrun(kwargs['dryrun'])
             del kwargs['dryrun']
         if 'verbose' in kwargs:
             set_verbose(kwargs['verbose'])
             del kwargs['verbose']
-        return self.wrapped(*args, **kwargs)
+        # Record the task being run so traced commands can be attributed to it.
+        push_task(getattr(self.wrapped, 'fabric_name', None) or '%s.%s' % (self.__module__, self.name))
+        try:
+            return self.wrapped(*args, **kwargs)
+        finally:
+            pop_task()
@@ -1,3 +1,4 @@
+import os
 import unittest
 
 import mock
@@ -20,4 +21,470 @@ PATH=/usr/local/sbin:/usr/local/bin:/sbin:/bin:/usr/sbin:/usr/bin
 """
 
         s = shellquote(s)
-        
\ No newline at end of file
+        
+    def test_layered_context(self):
+        from burlap.common import LayeredContext
+
+        base = {'a': 1, 'b': {'c': 2}}
+        ctx = LayeredContext(base)
+        ctx['a'] = 10
+        ctx.d = 3
+        del ctx['b']
+        self.assertEqual(ctx['a'], 10)
+        self.assertEqual(ctx.d, 3)
+        self.assertFalse('b' in ctx)
+        self.assertEqual(ctx.get_overrides(), {'a': 10, 'd': 3})
+        # The underlying mapping must be left untouched.
+        self.assertEqual(base, {'a': 1, 'b': {'c': 2}})
+
+    def test_env_layers(self):
+        from fabric.api import env
+
+        with mock.patch.dict(env, {'apache_sites': {'default': {'port': 80}}, 'apache_modules': ['ssl']}):
+            env.push_layer()
+            try:
+                env.apache_sites['default']['port'] = 8080
+                env.apache_modules.append('wsgi')
+                env.apache_layer_test = 1
+                self.assertIn('apache_layer_test', env.namespace_keys('apache'))
+            finally:
+                env.pop_layer()
+            self.assertEqual(env.apache_sites, {'default': {'port': 80}})
+            self.assertEqual(env.apache_modules, ['ssl'])
+            self.assertNotIn('apache_layer_test', env)
+            self.assertNotIn('apache_layer_test', env.namespace_keys('apache'))
+
+    def test_render_error(self):
+        import shutil
+        import tempfile
+        import traceback
+        from burlap import common
+
+        template_dir = tempfile.mkdtemp()
+        fn = os.path.join(template_dir, 'broken.conf')
+        with open(fn, 'w') as fout:
+            fout.write('Listen 80\n{{ 1 // 0 }}\n')
+        try:
+            with mock.patch('burlap.common.find_template', return_value=fn), \
+                    mock.patch.dict(common._compiled_templates, clear=True):
+                with self.assertRaises(ZeroDivisionError):
+                    try:
+                        common.render_to_string('broken.conf')
+                    except ZeroDivisionError:
+                        # The traceback points at the template's line, as with Template.render().
+                        self.assertIn('File "%s", line 2' % fn, traceback.format_exc())
+                        raise
+        finally:
+            shutil.rmtree(template_dir)
+
+    def test_trace_call(self):
+        import shutil
+        import tempfile
+        from fabric.api import env
+        from burlap import common
+
+        trace_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.dict(env, {'trace_enabled': 1, 'trace_dir': trace_dir, 'host_string': 'myhost'}):
+                common.push_task('deploy.run')
+                common.push_task('apache.configure')
+                try:
+                    common.trace_call('run', 'ls', lambda cmd: 'abc', 'ls')
+                    common.trace_call('run', 'ls', lambda cmd: 'de', 'ls')
+                finally:
+                    common.pop_task()
+                    common.pop_task()
+                records = common.load_traces()
+        finally:
+            shutil.rmtree(trace_dir)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['host'], 'myhost')
+        # The innermost task is recorded.
+        self.assertEqual(records[0]['task'], 'apache.configure')
+        self.assertTrue(records[0]['session'].endswith('-%s' % os.getpid()))
+        self.assertEqual(records[0]['status'], 0)
+        groups = common.aggregate_traces(records, ('op', 'command'))
+        self.assertEqual(groups[0][0], ('run', 'ls'))
+        self.assertEqual(groups[0][1]['count'], 2)
+        self.assertEqual(groups[0][1]['bytes'], 5)
+
+    def test_ssh_control_options(self):
+        from fabric.api import env
+        from burlap import common
+
+        with mock.patch.dict(env, {'ssh_multiplex': 1, 'user': 'bob'}):
+            with mock.patch('burlap.common.get_dryrun', return_value=True):
+                opts1 = common.get_ssh_control_options('bob@host1')
+                opts2 = common.get_ssh_control_options('host1')
+                opts3 = common.get_ssh_control_options('bob@host1:2222')
+            self.assertTrue('ControlMaster=auto' in opts1)
+            self.assertEqual(opts1, opts2)
+            self.assertNotEqual(opts1, opts3)
+            # Dryruns don't open connections, so there's nothing to close.
+            self.assertFalse(common._ssh_control_paths)
+
+        with mock.patch.dict(env, {'ssh_multiplex': 0}):
+            self.assertEqual(common.get_ssh_control_options('host1'), '')
+
+    def test_ssh_control_masters(self):
+        import errno
+        import shutil
+        import tempfile
+        from fabric.api import env
+        from burlap import common
+
+        control_dir = os.path.join(tempfile.mkdtemp(), 'ssh')
+        try:
+            with mock.patch.dict(env, {'ssh_multiplex': 1, 'ssh_control_dir': control_dir}), \
+                    mock.patch.dict(common._ssh_control_paths, clear=True), \
+                    mock.patch('burlap.common.get_dryrun', return_value=False):
+                # Another worker creating the directory first is fine.
+                with mock.patch('os.makedirs', side_effect=OSError(errno.EEXIST, 'File exists')):
+                    common.get_ssh_control_options('bob@host1')
+                common.get_ssh_control_options('bob@host2')
+                self.assertEqual(os.stat(control_dir).st_mode & 0o777, 0o700)
+
+                # Only the masters first used by this process are closed, not a parent's.
+                for path in common._ssh_control_paths:
+                    open(path, 'w').close()
+                path1 = common.get_ssh_control_path('bob@host1')
+                common._ssh_control_paths[path1] = ('bob@host1', os.getpid() + 1)
+                with mock.patch('subprocess.call') as mock_call:
+                    common.close_ssh_masters()
+                self.assertEqual(mock_call.call_count, 1)
+                self.assertEqual(mock_call.call_args[0][0][-1], 'bob@host2')
+                self.assertFalse(common._ssh_control_paths)
+        finally:
+            shutil.rmtree(os.path.dirname(control_dir))
+
+    def test_command_batch(self):
+        import subprocess
+        from fabric.api import env
+        from fabric.operations import _AttributeString as AttributeString
+        from burlap.common import CommandBatch
+
+        scripts = []
+
+        def fake_run(script, **kwargs):
+            scripts.append(script)
+            proc = subprocess.Popen(['bash', '-c', script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            out = proc.communicate()[0].decode('utf-8')
+            ret = AttributeString(out)
+            ret.return_code = proc.returncode
+            return ret
+
+        with mock.patch.dict(env, {'host_string': 'myhost'}):
+            with mock.patch('burlap.common.get_dryrun', return_value=False):
+                with mock.patch('burlap.common.run_or_dryrun', side_effect=fake_run):
+                    batch = CommandBatch()
+                    cmd1 = batch.add('run', 'echo one')
+                    cmd2 = batch.add('run', 'false', warn_only=True)
+                    cmd3 = batch.add('run', 'printf two')
+                    batch.flush()
+                    self.assertEqual(len(scripts), 1)
+                    self.assertEqual((cmd1.output, cmd1.return_code), ('one', 0))
+                    self.assertEqual(cmd2.return_code, 1)
+                    self.assertEqual((cmd3.output, cmd3.return_code), ('two', 0))
+
+                    batch = CommandBatch()
+                    cmd1 = batch.add('run', 'exit 3')
+                    cmd2 = batch.add('run', 'echo never')
+                    with self.assertRaises(SystemExit):
+                        batch.flush()
+                    self.assertEqual(cmd1.return_code, 3)
+                    self.assertEqual(cmd2.return_code, None)
+
+    def test_content_fingerprint(self):
+        import shutil
+        import tempfile
+        from fabric.api import env
+        from burlap import common
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            src_dir = os.path.join(tmp_dir, 'src')
+            os.makedirs(os.path.join(src_dir, 'a'))
+            os.makedirs(os.path.join(src_dir, 'b'))
+            for fn, content in [('a/1.txt', 'one'), ('b/2.txt', 'two'), ('b/2.pyc', 'x')]:
+                with open(os.path.join(src_dir, fn), 'w') as fout:
+                    fout.write(content)
+
+            with mock.patch.dict(env, {'fingerprint_cache_fn': os.path.join(tmp_dir, 'cache.pickle')}), \
+            mock.patch.object(common, '_stat_cache_changes', set()):
+                with mock.patch.object(common, '_stat_cache', None):
+                    before = common.get_content_fingerprint(src_dir, exclude=['*.pyc'])
+                    self.assertEqual(sorted(before), ['.', 'a', 'b'])
+
+                    # Touching a file, or changing an excluded one, doesn't change the fingerprint.
+                    os.utime(os.path.join(src_dir, 'a/1.txt'), (0, 0))
+                    with open(os.path.join(src_dir, 'b/2.pyc'), 'w') as fout:
+                        fout.write('y')
+                    self.assertEqual(common.get_content_fingerprint(src_dir, exclude=['*.pyc']), before)
+
+                    with open(os.path.join(src_dir, 'b/2.txt'), 'w') as fout:
+                        fout.write('three')
+                    after = common.get_content_fingerprint(src_dir, exclude=['*.pyc'])
+                    self.assertEqual(after['a'], before['a'])
+                    self.assertNotEqual(after['b'], before['b'])
+                    self.assertNotEqual(after['.'], before['.'])
+
+                # Unchanged files aren't re-hashed by later runs.
+                with mock.patch.object(common, '_stat_cache', None):
+                    with mock.patch('burlap.common.get_file_hash') as get_file_hash:
+                        self.assertEqual(common.get_content_fingerprint(src_dir, exclude=['*.pyc']), after)
+                        self.assertFalse(get_file_hash.called)
+
+                # Patterns containing a slash match the path relative to the root.
+                with mock.patch.object(common, '_stat_cache', None):
+                    excluded = common.get_content_fingerprint(src_dir, exclude=['*.pyc', 'b/2.txt'])
+                    self.assertEqual(excluded['a'], after['a'])
+                    self.assertNotEqual(excluded['b'], after['b'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_content_fingerprint_concurrent_saves(self):
+        import pickle
+        import shutil
+        import tempfile
+        from fabric.api import env
+        from burlap import common
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache_fn = os.path.join(tmp_dir, 'cache.pickle')
+            for name in ('a', 'b'):
+                os.makedirs(os.path.join(tmp_dir, name))
+                with open(os.path.join(tmp_dir, name, 'file.txt'), 'w') as fout:
+                    fout.write(name)
+
+            with mock.patch.dict(env, {'fingerprint_cache_fn': cache_fn}), \
+            mock.patch.object(common, '_stat_cache', None), \
+            mock.patch.object(common, '_stat_cache_changes', set()):
+                # Two processes that loaded the cache before either saved it.
+                common._stat_cache = {}
+                common.get_content_fingerprint(os.path.join(tmp_dir, 'a'))
+                common._stat_cache = {}
+                common.get_content_fingerprint(os.path.join(tmp_dir, 'b'))
+
+            with open(cache_fn, 'rb') as fin:
+                self.assertEqual(
+                    sorted(os.path.relpath(_, tmp_dir) for _ in pickle.load(fin)),
+                    ['a/file.txt', 'b/file.txt'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_dependency_graph(self):
+        from burlap.common import DependencyGraph, CycleError, topological_sort
+
+        graph = DependencyGraph({'app': ['db', 'cache'], 'db': ['packager'], 'cache': ['packager'], 'packager': [], 'cron': []})
+        self.assertEqual(graph.sort(), ['cron', 'packager', 'cache', 'db', 'app'])
+        self.assertEqual(topological_sort(graph.dependencies.items()), graph.sort())
+        self.assertEqual(graph.levels(), [['cron', 'packager'], ['cache', 'db'], ['app']])
+        self.assertEqual(
+            graph.critical_path({'app': 1, 'db': 10, 'cache': 2, 'packager': 5}),
+            (16, ['packager', 'db', 'app']))
+
+        graph.add('packager', ['app'])
+        with self.assertRaises(CycleError) as cm:
+            graph.sort()
+        self.assertEqual(cm.exception.cycle, ['app', 'cache', 'packager', 'app'])
+
+        with self.assertRaises(ValueError):
+            DependencyGraph({'app': ['db']}).sort()
+
+    def test_manifest_diff(self):
+        from burlap.common import ManifestDiff
+
+        last = {'apache_port': 80, 'sites': {'www': {'apache_ssl': 0}, 'api': {'apache_ssl': 1}}, 'old': 1}
+        current = {'apache_port': 80, 'sites': {'www': {'apache_ssl': 1}, 'api': {'apache_ssl': 1}, 'admin': {}}}
+        diff = ManifestDiff(last, current)
+        self.assertEqual(diff.added, [('sites', 'admin')])
+        self.assertEqual(diff.removed, [('old',)])
+        self.assertEqual(diff.changed, [('sites', 'www', 'apache_ssl')])
+        self.assertTrue(diff.has_changed('sites', 'www'))
+        self.assertFalse(diff.has_changed('sites', 'api'))
+        self.assertFalse(diff.has_changed('apache_port'))
+        self.assertEqual(diff.get_changed_keys('sites'), set(['admin', 'www']))
+        self.assertEqual(diff.get_changed_keys('sites', 'admin', 'apache_ssl'), None)
+        self.assertEqual(ManifestDiff.from_dict(diff.to_dict()).paths, diff.paths)
+        self.assertFalse(ManifestDiff(current, current))
+
+    def test_compiled_templates(self):
+        import shutil
+        import tempfile
+        from burlap import common
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.dict(common.env, {'template_cache_dir': cache_dir}), \
+                    mock.patch.object(common, '_jinja_env', None), \
+                    mock.patch.dict(common._compiled_templates, clear=True):
+                t = common.get_compiled_template('Hello {{ name }}')
+                self.assertIs(common.get_compiled_template(b'Hello {{ name }}'), t)
+                self.assertEqual(t.render(name='world'), 'Hello world')
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+                # A new process loads the compiled template from the bytecode cache.
+                common._compiled_templates.clear()
+                with mock.patch.object(common.get_jinja_environment(), 'compile') as mock_compile:
+                    t = common.get_compiled_template('Hello {{ name }}')
+                    self.assertFalse(mock_compile.called)
+                self.assertEqual(t.render(name='world'), 'Hello world')
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_put_if_changed(self):
+        import hashlib
+        import tempfile
+        from fabric.api import cd, env
+        from burlap import common
+
+        fd, fn = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as fout:
+                fout.write('Listen 80\n')
+            digest = hashlib.sha256(b'Listen 80\n').hexdigest()
+            with mock.patch.dict(env, {'host_string': 'web1'}), \
+                    mock.patch.dict(common._remote_checksums, clear=True), \
+                    mock.patch('burlap.common.put_or_dryrun') as mock_put, \
+                    mock.patch('burlap.files.get_hash_algorithm', return_value='sha256'), \
+                    mock.patch('burlap.files.checksums') as mock_checksums:
+                mock_checksums.side_effect = lambda paths, use_sudo: dict(
+                    (_, {'/etc/apache2/ports.conf': digest, '/etc/apache2/apache2.conf': 'abc'}[_]) for _ in paths)
+                self.assertFalse(common.put_if_changed(local_path=fn, remote_path='/etc/apache2/ports.conf'))
+                self.assertFalse(mock_put.called)
+
+                # Only the file being uploaded is hashed, and its new hash is remembered.
+                self.assertEqual(mock_checksums.call_args[0][0], ['/etc/apache2/ports.conf'])
+                self.assertTrue(common.put_if_changed(local_path=fn, remote_path='/etc/apache2/apache2.conf'))
+                self.assertEqual(mock_checksums.call_count, 2)
+                self.assertEqual(mock_put.call_count, 1)
+                self.assertFalse(common.put_if_changed(local_path=fn, remote_path='/etc/apache2/apache2.conf'))
+                self.assertEqual(mock_checksums.call_count, 2)
+
+                # Read-only commands keep the hashes, anything else may have changed any file.
+                common.forget_remote_checksums(command='cat /etc/apache2/ports.conf')
+                self.assertEqual(len(common._remote_checksums), 2)
+                common.forget_remote_checksums(command='a2ensite www.conf')
+                self.assertEqual(len(common._remote_checksums), 0)
+
+                # Even when the file is only named relative to a cd() prefix.
+                self.assertFalse(common.put_if_changed(local_path=fn, remote_path='/etc/apache2/ports.conf'))
+                self.assertEqual(len(common._remote_checksums), 1)
+                with mock.patch('burlap.common._sudo') as mock_sudo, cd('/etc/apache2'):
+                    common.sudo_or_dryrun("sed -i 's/80/8080/' ports.conf", dryrun=False)
+                self.assertTrue(mock_sudo.called)
+                self.assertEqual(len(common._remote_checksums), 0)
+        finally:
+            os.remove(fn)
+
+    def test_upload_bundle(self):
+        import hashlib
+        import tarfile
+        from fabric.api import env
+        from burlap import common
+
+        archives = []
+
+        def put(**kwargs):
+            with tarfile.open(kwargs['local_path']) as tar:
+                archives.append(dict((_.name, (tar.extractfile(_).read(), _.mode)) for _ in tar.getmembers()))
+
+        bundle = common.UploadBundle()
+        bundle.add('/etc/supervisor/conf.d/web.conf', content=u'[program:web]\n', mode='600')
+        bundle.add('/etc/supervisor/supervisord.conf', content='[supervisord]\n', owner='root', group='root')
+        with mock.patch.dict(env, {'host_string': 'web1'}), \
+                mock.patch.dict(common._remote_checksums, clear=True), \
+                mock.patch('burlap.common.put_or_dryrun', side_effect=put) as mock_put, \
+                mock.patch('burlap.common.sudo_or_dryrun') as mock_sudo, \
+                mock.patch('burlap.common.run_or_dryrun', return_value='/tmp/burlap-bundle.abc\n') as mock_run, \
+                mock.patch('burlap.files.get_hash_algorithm', return_value='md5'), \
+                mock.patch('burlap.files.checksums') as mock_checksums:
+            mock_checksums.return_value = {
+                '/etc/supervisor/conf.d/web.conf': None,
+                '/etc/supervisor/supervisord.conf': hashlib.md5(b'[supervisord]\n').hexdigest(),
+            }
+            self.assertEqual(bundle.upload(dryrun=False), ['/etc/supervisor/conf.d/web.conf'])
+            self.assertEqual(mock_put.call_count, 1)
+            self.assertEqual(mock_sudo.call_count, 1)
+            self.assertEqual(archives, [{
+                'etc/supervisor/conf.d/.web.conf.burlap': (b'[program:web]\n', 0o600),
+            }])
+            # The archive is only readable by the login user, and always removed.
+            self.assertIn('mktemp -d', mock_run.call_args[0][0])
+            self.assertEqual(mock_put.call_args[1]['remote_path'], '/tmp/burlap-bundle.abc/bundle.tar.gz')
+            self.assertEqual(mock_put.call_args[1]['mode'], 0o600)
+            script = mock_sudo.call_args[0][0]
+            self.assertTrue(script.startswith("trap 'rm -rf /tmp/burlap-bundle.abc' EXIT\n"))
+            self.assertIn('mv -f /etc/supervisor/conf.d/.web.conf.burlap /etc/supervisor/conf.d/web.conf', script)
+            self.assertNotIn('supervisord.conf', script)
+
+            # Nothing is sent once the host has everything.
+            self.assertEqual(bundle.upload(dryrun=False), [])
+            self.assertEqual(mock_put.call_count, 1)
+
+    def test_host_lock_commands(self):
+        from burlap.common import is_host_lock_command
+
+        for command in [
+            'apt-get install nginx',
+            'DEBIAN_FRONTEND=noninteractive apt-get install --quiet --assume-yes nginx',
+            'apt-get --quiet --quiet update',
+            'apt-get -o Dpkg::Options::=--force-confold -y dist-upgrade',
+            'cd /tmp && sudo apt remove apache2',
+            'yes y | yum -y install nano',
+            'dpkg -i /tmp/foo.deb',
+            'dpkg --purge foo',
+            'rpm -Uvh /tmp/foo.rpm',
+            'rpm -e foo',
+        ]:
+            self.assertTrue(is_host_lock_command(command), command)
+
+        for command in [
+            "dpkg-query -W -f='${Package}\\n'",
+            'dpkg -l nginx',
+            'apt-cache policy nginx',
+            'rpm --query --all',
+            'rpm -qa',
+            'cat /etc/apt/sources.list',
+            'ls /var/lib/dpkg/info',
+            'grep -r yum /etc/cron.d',
+            'echo install',
+        ]:
+            self.assertFalse(is_host_lock_command(command), command)
+
+    def test_read_only_commands(self):
+        from fabric.api import env
+        from burlap import common
+
+        for command in [
+            'cat /etc/hostname',
+            'cd /usr/local/myapp && grep -c worker settings.py 2>/dev/null || true',
+            'DEBIAN_FRONTEND=noninteractive dpkg-query -W nginx | cut -f2',
+            'test -e /etc/nginx/sites-enabled/default',
+            'sed -n 1p /etc/hosts',
+        ]:
+            self.assertTrue(common.is_read_only_command(command), command)
+
+        for command in [
+            'sed -i "s/a/b/" settings.py',
+            'cat /etc/hosts > /tmp/hosts',
+            'echo 1 | tee /proc/sys/vm/overcommit_memory',
+            'test -d /var/www || mkdir -p /var/www',
+            'find /tmp -name "*.pyc" -delete',
+            'cat `which python`',
+            '',
+        ]:
+            self.assertFalse(common.is_read_only_command(command), command)
+
+        with mock.patch.dict(env, {'host_string': 'web1', 'trace_enabled': 0}), \
+                mock.patch.dict(common._remote_stats, clear=True):
+            common.get_remote_stats()['/etc/nginx/nginx.conf'] = {'mode': '644'}
+
+            # Reading the host keeps the stats cached.
+            common.trace_call('run', 'cat /etc/nginx/nginx.conf', lambda cmd: '', 'cat /etc/nginx/nginx.conf')
+            common.trace_call('get', '/etc/nginx/nginx.conf', lambda: None)
+            self.assertEqual(common.get_remote_stats(), {'/etc/nginx/nginx.conf': {'mode': '644'}})
+
+            common.trace_call('sudo', 'chmod 600 nginx.conf', lambda cmd: '', 'chmod 600 nginx.conf')
+            self.assertEqual(common.get_remote_stats(), {})
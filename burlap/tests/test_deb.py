@@ -0,0 +1,90 @@
+import unittest
+
+import mock
+from fabric.api import env
+
+
+class InstalledPackagesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from burlap import common
+        self.patcher = mock.patch.dict(env, {'host_string': 'web1', 'user': 'root'})
+        self.patcher.start()
+        common._installed_packages.clear()
+
+    def tearDown(self):
+        from burlap import common
+        self.patcher.stop()
+        common._installed_packages.clear()
+
+    @mock.patch('burlap.utils.run')
+    @mock.patch('burlap.deb.run')
+    def test_require_packages(self, mock_run, mock_root_run):
+        from burlap import require
+
+        mock_run.side_effect = ['\n'.join([
+            'curl amd64 7.47.0-1ubuntu2 install ok installed',
+            'nginx all  deinstall ok config-files',
+            'git amd64 1:2.7.4-0ubuntu1 hold ok installed',
+            'vim   unknown ok not-installed',
+        ]), '\n'.join([
+            'curl amd64 7.47.0-1ubuntu2 install ok installed',
+            'nginx all 1.10.3-0ubuntu0.16.04.2 install ok installed',
+            'git amd64 1:2.7.4-0ubuntu1 hold ok installed',
+            'vim amd64 2:7.4.1689-3ubuntu1 install ok installed',
+        ]), '\n'.join([
+            'curl amd64 7.47.0-1ubuntu2 install ok installed',
+        ])]
+        require.deb.packages(['curl', 'git', 'nginx', 'vim'])
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(mock_root_run.call_args[0][0],
+            'DEBIAN_FRONTEND=noninteractive apt-get install --quiet --assume-yes nginx vim')
+
+        # Installing lists the inventory once more, rather than for every package.
+        require.deb.packages(['curl', 'nginx', 'vim'])
+        require.deb.package('git')
+        self.assertEqual(mock_run.call_count, 2)
+        self.assertEqual(mock_root_run.call_count, 1)
+
+        # Removing packages may remove others, so they're listed again.
+        require.deb.nopackage('vim')
+        self.assertEqual(mock_root_run.call_args[0][0],
+            'DEBIAN_FRONTEND=noninteractive apt-get remove --assume-yes vim')
+        require.deb.package('curl')
+        self.assertEqual(mock_run.call_count, 3)
+
+    @mock.patch('burlap.utils.run')
+    @mock.patch('burlap.deb.run')
+    def test_architectures(self, mock_run, mock_root_run):
+        from burlap import deb
+
+        mock_run.return_value = '\n'.join([
+            'libc6 amd64 2.23-0ubuntu10 install ok installed',
+            'tzdata all 2018d-0ubuntu0.16.04 install ok installed',
+        ])
+        self.assertTrue(deb.is_installed('libc6'))
+        self.assertTrue(deb.is_installed('libc6:amd64'))
+        self.assertFalse(deb.is_installed('libc6:i386'))
+        self.assertTrue(deb.is_installed('tzdata:amd64'))
+
+        self.assertTrue(deb.is_installed('libc6=2.23-0ubuntu10'))
+        self.assertFalse(deb.is_installed('libc6=2.23-0ubuntu11'))
+
+        mock_run.return_value += '\nlibc6 i386 2.23-0ubuntu10 install ok installed'
+        deb.install(['libc6:i386'])
+        self.assertTrue(deb.is_installed('libc6:i386'))
+        self.assertEqual(mock_run.call_count, 2)
+
+    @mock.patch('burlap.utils.run')
+    @mock.patch('burlap.deb.run')
+    def test_failed_install(self, mock_run, mock_root_run):
+        from burlap import deb
+
+        mock_run.return_value = 'curl amd64 7.47.0-1ubuntu2 install ok installed'
+        mock_root_run.return_value.succeeded = False
+        self.assertFalse(deb.is_installed('nginx'))
+        deb.install(['nginx'])
+
+        # The inventory is listed again, rather than assuming the install worked.
+        self.assertFalse(deb.is_installed('nginx'))
+        self.assertEqual(mock_run.call_count, 2)
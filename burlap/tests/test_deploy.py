@@ -0,0 +1,419 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import mock
+from fabric.api import env
+
+
+class PlanStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from burlap import deploy
+        self.data_dir = tempfile.mkdtemp()
+        self.patcher = mock.patch.dict(env, {
+            'plan_data_dir': self.data_dir,
+            'plan_storage': deploy.STORAGE_LOCAL,
+            'ROLE': 'prod',
+            'hosts': ['host1', 'host2'],
+            'host_string': 'host1',
+        })
+        self.patcher.start()
+        deploy._plan_stores.clear()
+        deploy._fs_cache.clear()
+
+    def tearDown(self):
+        from burlap import deploy
+        self.patcher.stop()
+        deploy._plan_stores.clear()
+        deploy._fs_cache.clear()
+        shutil.rmtree(self.data_dir)
+
+    def test_import_legacy_plans(self):
+        from burlap import deploy
+
+        # Record a plan completed on both hosts in the per-file layout.
+        with mock.patch.dict(env, {'plan_store': deploy.PLAN_STORE_FILES}):
+            plan = deploy.Plan('000')
+            plan.thumbprint = {'APACHE': {'apache_port': 80}}
+            env.host_string = 'host2'
+            plan.thumbprint = {'APACHE': {'apache_port': 80}}
+            env.host_string = 'host1'
+            self.assertTrue(plan.is_complete())
+        deploy._plan_stores.clear()
+
+        with mock.patch.dict(env, {'plan_store': deploy.PLAN_STORE_INDEX}):
+            self.assertEqual(list(deploy.iter_plan_names()), ['000'])
+            plan = deploy.Plan.get_or_create_next()
+            self.assertEqual(plan.name, '001')
+            self.assertFalse(plan.is_complete())
+            self.assertEqual(deploy.get_last_completed_plan().name, '000')
+            self.assertEqual(deploy.get_last_thumbprint(), {'APACHE': {'apache_port': 80}})
+
+        with open(os.path.join(self.data_dir, 'prod.json')) as fin:
+            data = json.load(fin)
+        self.assertEqual(sorted(data['plans']), ['000', '001'])
+        self.assertEqual(data['plans']['000']['thumbprinted'], ['host1', 'host2'])
+
+    def test_history_log(self):
+        from burlap import deploy
+
+        store = deploy.get_plan_store()
+        store.load('000')
+        store.add_history('000', 1, 't0', 't1')
+        store.add_history('000', 2, 't1', 't2')
+
+        # History is appended to the plan's log rather than rewriting the index.
+        with open(os.path.join(self.data_dir, 'prod.json')) as fin:
+            self.assertFalse('history' in json.load(fin)['plans']['000'])
+        self.assertEqual(
+            deploy.FilePlanStore('prod').load('000', hosts=['host1'])['history'], [['1', 't0', 't1'], ['2', 't1', 't2']])
+
+    def test_timing_report(self):
+        from burlap import deploy
+
+        store = deploy.get_plan_store()
+        for i, seconds in enumerate([10, 12, 11, 40]):
+            name = '%03i' % i
+            deploy.Plan(name)
+            store.set_host_data(name, 'timings', 'host1', [
+                {'component': 'APACHE', 'deployer': 'apache.configure', 'seconds': seconds, 'commands': 5},
+                {'component': 'APACHE', 'deployer': 'apache.restart', 'seconds': 1, 'commands': 1},
+                {'component': 'CRON', 'deployer': 'cron.configure', 'seconds': 2, 'commands': 3},
+            ])
+
+        history = deploy.get_timing_history(count=3)
+        self.assertEqual(history[('APACHE', 'host1')], [('001', 13, 6), ('002', 12, 6), ('003', 41, 6)])
+        self.assertEqual(deploy.timing_report(count=3), [('APACHE', 'host1')])
+        self.assertEqual(deploy.timing_report(count=3, threshold=4), [])
+
+    def test_resume_deployment(self):
+        from burlap import common, deploy
+
+        last = {'A': 1, 'B': 1, 'C': 1}
+        current = {'A': 2, 'B': 2, 'C': 2}
+        calls = []
+        failing = set(['B'])
+
+        def make_deployer(name):
+            def deployer():
+                if name in failing:
+                    raise ValueError('broken deployer')
+                calls.append(name)
+            return deployer
+
+        patches = [
+            mock.patch.dict(env, {'services': ['a', 'b', 'c'], 'deploy_workers': 1}),
+            mock.patch.object(common, 'manifest_deployers', {'A': ['a.configure'], 'B': ['b.configure'], 'C': ['c.configure']}),
+            mock.patch.object(common, 'manifest_deployers_befores', {'B': ['A'], 'C': ['B']}),
+            mock.patch.object(common, 'resolve_deployer', lambda func_name: make_deployer(func_name[0].upper())),
+            mock.patch.object(common, 'load_satchels'),
+            mock.patch.object(common, 'all_satchels', {'A': None, 'B': None, 'C': None}),
+            mock.patch('burlap.deploy.iter_thumbprint_differences',
+                return_value=[(_, (last, current)) for _ in 'ABC']),
+        ]
+        for patcher in patches:
+            patcher.start()
+        try:
+            with self.assertRaises(ValueError):
+                deploy.auto()
+            self.assertEqual(calls, ['A'])
+            self.assertEqual(deploy.get_plan_store().get_checkpoint('host1')['done'], ['A'])
+
+            # The finished component is skipped, and the host isn't thumbprinted again.
+            failing.clear()
+            deploy.iter_thumbprint_differences.reset_mock()
+            deploy.auto()
+            self.assertEqual(calls, ['A', 'B', 'C'])
+            self.assertFalse(deploy.iter_thumbprint_differences.called)
+            self.assertEqual(deploy.get_plan_store().get_checkpoint('host1'), None)
+            self.assertEqual(deploy.Plan('000').thumbprint, current)
+            timings = deploy.get_plan_store().get_timings('000')['host1']
+            self.assertEqual([_['deployer'] for _ in timings], ['a.configure', 'b.configure', 'c.configure'])
+            self.assertEqual(sorted(deploy.Plan('000').get_diffs()), ['A', 'B', 'C'])
+            self.assertTrue(deploy.Plan('000').get_diffs()['B'].has_changed())
+        finally:
+            for patcher in reversed(patches):
+                patcher.stop()
+
+    def test_run_with_workers(self):
+        from burlap import deploy
+
+        with mock.patch('burlap.deploy.confirm_deployment') as mock_confirm, \
+                mock.patch('burlap.deploy.deploy_host') as mock_deploy_host, \
+                mock.patch('burlap.executor.ParallelExecutor') as mock_executor:
+            mock_executor.return_value.failed = []
+            deploy.run(components='APACHE', workers=2, yes=1)
+            self.assertTrue(mock_confirm.called)
+            self.assertEqual(mock_executor.call_args[1]['hosts'], ['host1', 'host2'])
+            self.assertEqual(mock_executor.call_args[1]['pool_size'], 2)
+            self.assertTrue(mock_executor.return_value.run.called)
+            self.assertFalse(mock_deploy_host.called)
+
+            # Each host deploys itself in the executor's worker.
+            mock_executor.call_args[1]['func']()
+            mock_deploy_host.assert_called_once_with(components='APACHE')
+
+            # Fabric calls the task for the other hosts, which were already deployed.
+            with mock.patch.dict(env, {'host_string': 'host2'}):
+                deploy.run(components='APACHE', workers=2, yes=1)
+            self.assertEqual(mock_executor.call_count, 1)
+
+
+class RecordManifestsTestCase(unittest.TestCase):
+
+    def test_concurrent_recorders(self):
+        import time
+        from burlap import common, deploy
+
+        def slow():
+            time.sleep(5)
+
+        def broken():
+            raise ValueError('broken recorder')
+
+        recorders = {
+            'fast': lambda: {'fast_value': 1},
+            'slow': slow,
+            'broken': broken,
+            'other': lambda: {'other_value': 2},
+        }
+        with mock.patch.object(common, 'manifest_recorder', recorders):
+            results = list(deploy.iter_recorded_manifests(
+                ['OTHER', 'SLOW', 'BROKEN', 'FAST'], workers=4, timeout=0.5))
+
+        self.assertEqual([_[0] for _ in results], ['OTHER', 'SLOW', 'BROKEN', 'FAST'])
+        self.assertEqual(results[0][1:3], ('ok', {'other_value': 2}))
+        self.assertEqual(results[1][1], 'error')
+        self.assertTrue('Timed out' in results[1][2])
+        self.assertEqual(results[2][1], 'error')
+        self.assertTrue('broken recorder' in results[2][2])
+        self.assertEqual(results[3][1:3], ('ok', {'fast_value': 1}))
+        self.assertEqual(sorted(deploy.manifest_timings), ['BROKEN', 'FAST', 'OTHER', 'SLOW'])
+        # The worker's exception is sent back with its original type.
+        self.assertEqual(sorted(deploy.manifest_errors), ['BROKEN'])
+        self.assertTrue(isinstance(deploy.manifest_errors['BROKEN'][1], ValueError))
+
+    def test_reraise_keeps_exception_type(self):
+        from burlap import common, deploy
+
+        def broken():
+            raise ValueError('broken recorder')
+
+        patches = {'ROLE': 'prod', 'host_string': 'host1', 'services': ['mysatchel']}
+        with mock.patch.dict(env, patches), \
+        mock.patch.object(common, 'manifest_recorder', {'mysatchel': broken}), \
+        mock.patch('burlap.deploy.get_last_completed_plan', return_value=None):
+            deploy.clear_thumbprint_cache()
+            with self.assertRaises(ValueError):
+                deploy.get_current_thumbprint(reraise=1)
+
+    def test_cached_manifests(self):
+        from burlap import common, deploy
+
+        calls = []
+
+        def record():
+            calls.append(1)
+            return {'mysatchel_port': env.mysatchel_port}
+
+        patches = {'ROLE': 'prod', 'host_string': 'host1', 'services': ['mysatchel'], 'mysatchel_port': 80}
+        with mock.patch.dict(env, patches), \
+        mock.patch.object(common, 'manifest_recorder', {'mysatchel': record}), \
+        mock.patch('burlap.deploy.get_last_completed_plan', return_value=None):
+            deploy.clear_thumbprint_cache()
+            self.assertEqual(deploy.get_current_thumbprint(), {'MYSATCHEL': {'mysatchel_port': 80}})
+            self.assertEqual(deploy.get_current_thumbprint(), {'MYSATCHEL': {'mysatchel_port': 80}})
+            self.assertEqual(len(calls), 1)
+
+            # Changing the component's settings invalidates its cached manifest.
+            env.mysatchel_port = 8080
+            self.assertEqual(deploy.get_current_thumbprint(), {'MYSATCHEL': {'mysatchel_port': 8080}})
+            self.assertEqual(len(calls), 2)
+            deploy.clear_thumbprint_cache()
+
+    def test_cached_manifests_track_files(self):
+        from burlap import common, deploy
+
+        src_dir = tempfile.mkdtemp()
+        calls = []
+
+        def record():
+            calls.append(1)
+            return {'files': sorted(os.listdir(src_dir))}
+
+        satchel = mock.Mock(templates=[])
+        satchel.get_tracked_paths.return_value = [(src_dir, ['*.pyc'])]
+        patches = {'ROLE': 'prod', 'host_string': 'host1', 'services': ['mysatchel']}
+        try:
+            with mock.patch.dict(env, patches), \
+            mock.patch.dict(common.all_satchels, {'MYSATCHEL': satchel}), \
+            mock.patch.object(common, 'manifest_recorder', {'mysatchel': record}), \
+            mock.patch('burlap.deploy.get_last_completed_plan', return_value=None):
+                deploy.clear_thumbprint_cache()
+                self.assertEqual(deploy.get_current_thumbprint(), {'MYSATCHEL': {'files': []}})
+                self.assertEqual(deploy.get_current_thumbprint(), {'MYSATCHEL': {'files': []}})
+                self.assertEqual(len(calls), 1)
+
+                # The tracked files are only walked once during the run.
+                with open(os.path.join(src_dir, 'app.pyc'), 'w') as fout:
+                    fout.write('compiled')
+                with mock.patch('burlap.common.get_content_fingerprint') as mock_fingerprint:
+                    deploy.get_current_thumbprint()
+                    self.assertFalse(mock_fingerprint.called)
+                self.assertEqual(len(calls), 1)
+
+                # Excluded files don't count, but other changes to a tracked directory do.
+                deploy._fingerprint_cache.clear()
+                deploy.get_current_thumbprint()
+                self.assertEqual(len(calls), 1)
+                with open(os.path.join(src_dir, 'app.py'), 'w') as fout:
+                    fout.write('print(1)')
+                deploy._fingerprint_cache.clear()
+                self.assertEqual(
+                    deploy.get_current_thumbprint(), {'MYSATCHEL': {'files': ['app.py', 'app.pyc']}})
+                self.assertEqual(len(calls), 2)
+
+                # Without knowing the tracked paths, the manifest is never reused.
+                satchel.get_tracked_paths.side_effect = ImportError
+                deploy._fingerprint_cache.clear()
+                deploy.get_current_thumbprint()
+                deploy.get_current_thumbprint()
+                self.assertEqual(len(calls), 4)
+                deploy.clear_thumbprint_cache()
+        finally:
+            shutil.rmtree(src_dir)
+
+
+class RunDeployersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def make_deployer(self, name, fail=False):
+        import time
+
+        def deployer():
+            with open(os.path.join(self.log_dir, name), 'w') as fout:
+                fout.write('%s\n' % time.time())
+                time.sleep(0.3)
+                fout.write('%s\n' % time.time())
+            if fail:
+                raise ValueError('broken deployer')
+        return [('%s.configure' % name.lower(), deployer)]
+
+    def get_times(self, name):
+        with open(os.path.join(self.log_dir, name)) as fin:
+            return [float(_) for _ in fin.read().split()]
+
+    def test_run_deployers(self):
+        from burlap import deploy
+
+        dependencies = {'A': set(), 'B': set(), 'C': set(['A', 'B']), 'D': set(['C'])}
+        funcs = dict((name, self.make_deployer(name)) for name in 'ABCD')
+        deploy.run_deployers(['A', 'B', 'C', 'D'], dependencies, funcs, workers=3)
+
+        a_start, a_end = self.get_times('A')
+        b_start, b_end = self.get_times('B')
+        c_start, c_end = self.get_times('C')
+        d_start, _ = self.get_times('D')
+        # Independent components run at once, but never before their dependencies are done.
+        self.assertTrue(b_start < a_end and a_start < b_end)
+        self.assertTrue(c_start >= max(a_end, b_end))
+        self.assertTrue(d_start >= c_end)
+
+    def test_single_ready_component_in_process(self):
+        from burlap import deploy
+
+        pids = {}
+
+        def make_deployer(name):
+            def deployer():
+                pids[name] = os.getpid()
+                env.deploy_test_value = name
+            return [('%s.configure' % name.lower(), deployer)]
+
+        dependencies = {'A': set(), 'B': set(['A'])}
+        funcs = dict((name, make_deployer(name)) for name in 'AB')
+        with mock.patch.dict(env, {'deploy_test_value': None}):
+            deploy.run_deployers(['A', 'B'], dependencies, funcs, workers=4)
+            # Nothing could run alongside either, so neither was forked.
+            self.assertEqual(pids, {'A': os.getpid(), 'B': os.getpid()})
+            self.assertEqual(env.deploy_test_value, 'B')
+
+    def test_abort(self):
+        from burlap import deploy
+
+        dependencies = {'A': set(), 'B': set(), 'C': set(['B'])}
+        funcs = {'A': self.make_deployer('A'), 'B': self.make_deployer('B', fail=True), 'C': self.make_deployer('C')}
+        with self.assertRaises(SystemExit):
+            deploy.run_deployers(['A', 'B', 'C'], dependencies, funcs, workers=2)
+
+        # The running component is allowed to finish, but nothing new is started.
+        self.assertEqual(len(self.get_times('A')), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.log_dir, 'C')))
+
+
+class RemoteFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from burlap import deploy
+        self.patcher = mock.patch.dict(env, {'host_string': 'host1', 'remote_file_flush_interval': 60})
+        self.patcher.start()
+        deploy.RemoteFile._file_cache.clear()
+        deploy.RemoteFile._dirty.clear()
+
+    def tearDown(self):
+        from burlap import deploy
+        self.patcher.stop()
+        deploy.RemoteFile._file_cache.clear()
+        deploy.RemoteFile._dirty.clear()
+
+    @mock.patch('burlap.deploy.sudo_or_dryrun')
+    @mock.patch('burlap.deploy.put_or_dryrun')
+    def test_coalesced_writes(self, mock_put, mock_sudo):
+        from burlap import deploy
+
+        uploads = []
+        mock_put.side_effect = lambda **kwargs: uploads.append(kwargs['local_path'].getvalue())
+
+        # Writing a file replaces its content, even though the instance is shared.
+        for index in range(3):
+            fout = deploy.RemoteFile('/plans/index', 'w')
+            fout.write(str(index))
+            fout.close()
+        self.assertEqual(deploy.RemoteFile('/plans/index').read(), '2')
+        self.assertEqual(uploads, [b'0'])
+        # Rewrites are uploaded beside the file and moved over it.
+        self.assertEqual(mock_put.call_args[1]['remote_path'], '/plans/index.tmp')
+        self.assertEqual(mock_sudo.call_args[0][0], 'mv -f "/plans/index.tmp" "/plans/index"')
+
+        # Appends only send the new content, without reading the file.
+        for index in range(3):
+            fout = deploy.RemoteFile('/plans/history', 'a')
+            fout.write('%s\n' % index)
+            fout.close()
+        self.assertEqual(mock_sudo.call_count, 2)
+        deploy.RemoteFile.flush_all()
+        self.assertEqual(uploads, [b'0', b'2'])
+        self.assertEqual(mock_sudo.call_count, 4)
+        self.assertEqual(mock_sudo.call_args_list[2][0][0], "printf %s '1\n2\n' >> \"/plans/history\"")
+
+    @mock.patch('burlap.deploy.sudo_or_dryrun')
+    @mock.patch('burlap.deploy.put_or_dryrun')
+    def test_writes_on_close(self, mock_put, mock_sudo):
+        from burlap import deploy
+
+        # By default, nothing is held back, so nothing's lost if the process is killed.
+        env.remote_file_flush_interval = 0
+        for index in range(2):
+            fout = deploy.RemoteFile('/plans/history', 'a')
+            fout.write('%s\n' % index)
+            fout.close()
+        self.assertEqual(mock_sudo.call_count, 2)
+        self.assertEqual(deploy.RemoteFile._dirty, {})
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from fabric.api import env
+
+
+def deploy_func():
+    from burlap.executor import check_stop
+    if env.host_string.startswith('bad'):
+        raise Exception('Deployment failed on %s.' % env.host_string)
+    if env.host_string.startswith('slow'):
+        # Each step stands in for a deployer.
+        for _ in range(100):
+            check_stop()
+            time.sleep(0.05)
+    print('Deployed %s.' % env.host_string)
+
+
+class ExecutorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def get_statuses(self, hosts, **kwargs):
+        from burlap.executor import ParallelExecutor
+        executor = ParallelExecutor(deploy_func, hosts=hosts, log_dir=self.log_dir, **kwargs)
+        return executor, [(_.host, _.status) for _ in executor.run()]
+
+    def test_continue(self):
+        executor, statuses = self.get_statuses(['a', 'bad1', 'b'], pool_size=2, on_failure='continue')
+        self.assertEqual(statuses, [('a', 'succeeded'), ('bad1', 'failed'), ('b', 'succeeded')])
+        with open(executor.results[0].log_fn) as fin:
+            self.assertEqual(fin.read().strip(), 'Deployed a.')
+        with open(executor.results[1].log_fn) as fin:
+            self.assertTrue('Deployment failed on bad1.' in fin.read())
+
+    def test_drain_stops_later_batches(self):
+        _, statuses = self.get_statuses(['bad1', 'a', 'b'], pool_size=2, batch_size=2, on_failure='drain')
+        self.assertEqual(statuses, [('bad1', 'failed'), ('a', 'succeeded'), ('b', 'skipped')])
+
+    def test_abort_stops_running_hosts(self):
+        executor, statuses = self.get_statuses(['slow1', 'bad1', 'a'], pool_size=2, on_failure='abort')
+        self.assertEqual(statuses, [('slow1', 'aborted'), ('bad1', 'failed'), ('a', 'skipped')])
+        # The running host stopped between steps, rather than being killed.
+        with open(executor.results[0].log_fn) as fin:
+            self.assertTrue('Stopping, since another host failed.' in fin.read())
+        self.assertTrue(executor.results[0].duration < 4)
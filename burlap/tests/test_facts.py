@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from fabric.api import env
+
+UBUNTU_OUTPUT = """hostname=web1
+fqdn=web1.example.com
+kernel=Linux
+arch=x86_64
+lsb_id=Ubuntu
+lsb_release=16.04
+lsb_codename=xenial
+lsb_desc=Ubuntu 16.04.3 LTS
+distrib_release=16.04
+debian_version=stretch/sid
+fedora_release=
+redhat_release=
+release_files=lsb-release 
+commands=apt-get systemctl 
+cpus=4
+memory=8167148
+"""
+
+
+class FactsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from burlap import facts
+        self.data_dir = tempfile.mkdtemp()
+        self.patcher = mock.patch.dict(env, {'facts_dir': self.data_dir, 'host_string': 'web1'})
+        self.patcher.start()
+        facts._facts.clear()
+
+    def tearDown(self):
+        from burlap import facts
+        self.patcher.stop()
+        facts._facts.clear()
+        shutil.rmtree(self.data_dir)
+
+    def test_parse_facts(self):
+        from burlap.facts import parse_facts
+
+        facts = parse_facts(UBUNTU_OUTPUT)
+        self.assertEqual(facts['os'], ['linux', 'ubuntu', '16.04'])
+        self.assertEqual(facts['packager'], 'apt-get')
+        self.assertEqual(facts['distrib_id'], 'Ubuntu')
+        self.assertEqual(facts['init'], 'systemd')
+        self.assertEqual(facts['cpus'], 4)
+        self.assertEqual(facts['memory'], 8167148*1024)
+
+        facts = parse_facts('kernel=Linux\nfedora_release=Fedora release 25 (Twenty Five)\nredhat_release=Fedora release 25\n')
+        self.assertEqual(facts['os'], ['linux', 'fedora', '25'])
+        self.assertEqual(facts['packager'], 'yum')
+        self.assertEqual(facts['distrib_id'], 'Fedora')
+        self.assertEqual(facts['init'], 'sysv')
+
+    @mock.patch('burlap.facts.run')
+    def test_get_facts(self, mock_run):
+        from burlap import facts
+        from burlap.common import get_os_version, get_packager
+
+        mock_run.return_value = UBUNTU_OUTPUT
+        self.assertEqual(get_os_version().release, '16.04')
+        self.assertEqual(get_packager(), 'apt-get')
+        self.assertEqual(mock_run.call_count, 1)
+
+        # Later runs use the facts saved to disk, until they expire.
+        facts._facts.clear()
+        self.assertEqual(facts.get_fact('hostname'), 'web1')
+        self.assertEqual(mock_run.call_count, 1)
+        facts._facts.clear()
+        with mock.patch.dict(env, {'facts_ttl': 0}):
+            facts.get_facts()
+        self.assertEqual(mock_run.call_count, 2)
+        facts.get_facts(refresh=True)
+        self.assertEqual(mock_run.call_count, 3)
+
+        # Every host has its own facts.
+        with mock.patch.dict(env, {'host_string': 'db1'}):
+            mock_run.return_value = 'kernel=Linux\ncommands=yum\n'
+            self.assertEqual(get_packager(), 'yum')
+        self.assertEqual(get_packager(), 'apt-get')
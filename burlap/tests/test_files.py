@@ -185,3 +185,102 @@ def test_remove_recursive(mock_run):
     from burlap.files import remove
     remove('/tmp/src', recursive=True)
     mock_run.assert_called_with('/bin/rm -r /tmp/src')
+
+
+class TestStatMany(unittest.TestCase):
+
+    def setUp(self):
+        from burlap.common import invalidate_remote_stats
+        invalidate_remote_stats()
+
+    @patch('burlap.files.run')
+    def test_stat_many(self, mock_run):
+        from burlap.common import invalidate_remote_stats
+        from burlap.files import stat_many, is_dir, owner, mode, is_file
+
+        mock_run.return_value = '@stat 0 d root adm 755 1500000000 4096\n@stat 0 - \n@stat 1 f www-data www-data 777 1500000001 11'
+        stats = stat_many(['/etc', '/missing', '/var/link'])
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(stats['/etc']['owner'], 'root')
+        self.assertEqual(stats['/etc']['mtime'], 1500000000)
+        self.assertFalse(stats['/missing']['exists'])
+        self.assertTrue(stats['/var/link']['is_link'] and stats['/var/link']['is_file'])
+
+        # Later queries are answered from the cache, until the host changes.
+        self.assertTrue(is_dir('/etc'))
+        self.assertEqual(owner('/etc'), 'root')
+        self.assertEqual(mode('/etc'), '755')
+        self.assertFalse(is_file('/missing'))
+        self.assertEqual(mock_run.call_count, 1)
+        invalidate_remote_stats(['/missing'])
+        mock_run.return_value = '@stat 0 f root root 644 1500000002 0'
+        self.assertTrue(is_file('/missing'))
+        self.assertEqual(mock_run.call_count, 2)
+
+    @patch('burlap.require.files.run')
+    @patch('burlap.files.run')
+    def test_require_directories(self, mock_run, mock_require_run):
+        from burlap import require
+
+        mock_run.side_effect = [
+            '@stat 0 d root root 755 1 4096\n@stat 0 - \n@stat 0 - ',
+            '@stat 0 d alice alice 700 2 4096\n@stat 0 d alice alice 755 2 4096',
+        ]
+        require.files.directories(['/a', '/b', '/c'], owner='alice', group='alice', mode='700')
+        self.assertEqual(mock_run.call_count, 2)
+        self.assertEqual([_[0][0] for _ in mock_require_run.call_args_list], [
+            'mkdir -p /b /c',
+            'chown alice:alice /a',
+            'chmod 700 /a /c',
+        ])
+
+
+class TestChecksums(unittest.TestCase):
+
+    def setUp(self):
+        from burlap.files import _hash_commands
+        _hash_commands.clear()
+
+    @patch('burlap.files.run')
+    def test_checksums(self, mock_run):
+        from burlap.files import checksums, watch
+
+        mock_run.side_effect = [
+            'shasum -a 256',
+            '@sum aaa\n@sum\n@sum bbb',
+            '@sum aaa\n@sum\n@sum ccc',
+        ]
+        with watch(['/etc/a', '/etc/missing', '/etc/b']) as w:
+            pass
+        self.assertTrue(w.changed)
+        self.assertEqual(mock_run.call_count, 3)
+        self.assertIn('shasum -a 256', mock_run.call_args_list[1][0][0])
+
+        # The hashing tool is only looked for once per host.
+        mock_run.side_effect = ['@sum aaa']
+        self.assertEqual(checksums(['/etc/a']), {'/etc/a': 'aaa'})
+        self.assertEqual(mock_run.call_count, 4)
+
+    @patch('burlap.files.run')
+    def test_md5_fallback(self, mock_run):
+        from burlap.files import get_hash_algorithm, watch
+
+        # A host with only an MD5 utility, like SmartOS.
+        mock_run.side_effect = [
+            '/opt/local/bin/md5sum',
+            '@sum aaa',
+            '@sum aaa',
+        ]
+        with watch('/etc/a') as w:
+            pass
+        self.assertFalse(w.changed)
+        self.assertIn('/opt/local/bin/md5sum', mock_run.call_args_list[1][0][0])
+        self.assertEqual(get_hash_algorithm('sha256'), 'md5')
+
+    @patch('burlap.files.run')
+    def test_no_hash_command(self, mock_run):
+        from burlap.files import checksums
+
+        mock_run.return_value = ''
+        with pytest.raises(SystemExit):
+            checksums(['/etc/a'])
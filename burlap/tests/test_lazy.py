@@ -0,0 +1,36 @@
+import unittest
+
+import mock
+
+
+class LazyTestCase(unittest.TestCase):
+
+    def test_placeholder_tasks(self):
+        from fabric.main import load_tasks_from_module
+        from burlap.lazy import LazyModule, LazyTask
+
+        module = LazyModule('mysatchel', {'configure': 'Configures things.'})
+
+        with mock.patch('burlap.lazy.load_namespace') as load_namespace:
+            _, tasks, _, _ = load_tasks_from_module(module)
+            self.assertEqual(list(tasks), ['configure'])
+            self.assertTrue(isinstance(tasks['configure'], LazyTask))
+            self.assertEqual(tasks['configure'].__doc__, 'Configures things.')
+            # Listing tasks must not import the real module.
+            self.assertFalse(load_namespace.called)
+
+            real_module = mock.Mock()
+            real_module.configure.run.return_value = 123
+            load_namespace.return_value = real_module
+            self.assertEqual(module.configure.run(1, b=2), 123)
+            load_namespace.assert_called_with('mysatchel')
+            real_module.configure.run.assert_called_with(1, b=2)
+
+    def test_role_satchels(self):
+        from burlap import lazy
+
+        with mock.patch.dict(lazy._satchel_modules, {'apache': 'apache', 'mysql': 'db', 'cron': 'cron'}, clear=True):
+            # Satchels with settings are loaded, even when they aren't services.
+            self.assertEqual(
+                lazy.get_role_satchels({'apache_port': 8080, 'mysql_user': 'root', 'services': ['cron']}),
+                ['apache', 'mysql'])
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from fabric.api import env
+
+
+class RoleSettingsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.role_dir = os.path.join(self.data_dir, 'roles')
+        self.write_settings('base', 'app_name: base\ndebug: 1\n')
+        self.write_settings('prod', 'inherits: base\ndebug: 0\n')
+        self.patchers = [
+            mock.patch('burlap.common.ROLE_DIR', self.role_dir),
+            mock.patch.dict(env, {'burlap_data_dir': os.path.join(self.data_dir, 'data')}),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+        shutil.rmtree(self.data_dir)
+
+    def write_settings(self, role, content, mtime=None):
+        if not os.path.isdir(os.path.join(self.role_dir, role)):
+            os.makedirs(os.path.join(self.role_dir, role))
+        fn = os.path.join(self.role_dir, role, 'settings.yaml')
+        with open(fn, 'w') as fout:
+            fout.write(content)
+        if mtime:
+            os.utime(fn, (mtime, mtime))
+
+    def get_cache_fn(self, role):
+        return os.path.join(env.burlap_data_dir, 'roles', '%s.pickle' % role)
+
+    def test_cache_hit(self):
+        import burlap
+
+        config = burlap.get_role_settings('prod')
+        self.assertEqual(config['app_name'], 'base')
+        self.assertEqual(config['debug'], 0)
+        self.assertTrue(os.path.isfile(self.get_cache_fn('prod')))
+
+        with mock.patch('burlap.load_yaml_settings') as load_yaml_settings:
+            self.assertEqual(burlap.get_role_settings('prod'), config)
+            self.assertFalse(load_yaml_settings.called)
+
+    def test_inherited_file_change_invalidates(self):
+        import burlap
+
+        self.assertEqual(burlap.get_role_settings('prod')['app_name'], 'base')
+
+        # Same size, so only the mtime tells the files apart.
+        self.write_settings('base', 'app_name: BASE\ndebug: 1\n', mtime=1)
+        self.assertEqual(burlap.get_role_settings('prod')['app_name'], 'BASE')
+
+        # A local override that didn't exist before is picked up too.
+        with open(os.path.join(self.role_dir, 'prod', 'settings_local.yaml'), 'w') as fout:
+            fout.write('app_name: local\n')
+        self.assertEqual(burlap.get_role_settings('prod')['app_name'], 'local')
+
+    def test_corrupt_cache_reparses(self):
+        import burlap
+
+        burlap.get_role_settings('prod')
+        with open(self.get_cache_fn('prod'), 'wb') as fout:
+            fout.write(b'not a pickle')
+        self.assertEqual(burlap.get_role_settings('prod')['app_name'], 'base')
+
+        # The fresh parse replaced the corrupt cache.
+        with mock.patch('burlap.load_yaml_settings') as load_yaml_settings:
+            self.assertEqual(burlap.get_role_settings('prod')['app_name'], 'base')
+            self.assertFalse(load_yaml_settings.called)
+
+    def test_unreadable_cache_reparses(self):
+        import burlap
+
+        cache_fn = self.get_cache_fn('prod')
+        os.makedirs(cache_fn)
+        with mock.patch('warnings.warn'):
+            self.assertEqual(burlap.get_role_settings('prod')['debug'], 0)
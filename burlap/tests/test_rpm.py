@@ -0,0 +1,43 @@
+import unittest
+
+import mock
+from fabric.api import env
+
+
+class InstalledPackagesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from burlap import common
+        self.patcher = mock.patch.dict(env, {'host_string': 'db1', 'user': 'root'})
+        self.patcher.start()
+        common._installed_packages.clear()
+
+    def tearDown(self):
+        from burlap import common
+        self.patcher.stop()
+        common._installed_packages.clear()
+
+    @mock.patch('burlap.utils.run')
+    @mock.patch('burlap.rpm.run')
+    def test_is_installed(self, mock_run, mock_root_run):
+        from burlap import rpm
+
+        mock_run.return_value = '\n'.join([
+            'glibc 2.17-222.el7 x86_64',
+            'kernel 3.10.0-862.el7 x86_64',
+            'kernel 3.10.0-957.el7 x86_64',
+        ])
+        self.assertTrue(rpm.is_installed('glibc'))
+        self.assertTrue(rpm.is_installed('glibc.x86_64'))
+        self.assertFalse(rpm.is_installed('glibc.i686'))
+        self.assertTrue(rpm.is_installed('glibc-2.17'))
+
+        # Every installed version of an installonly package is kept.
+        self.assertTrue(rpm.is_installed('kernel-3.10.0-862.el7'))
+        self.assertTrue(rpm.is_installed('kernel-3.10.0-957.el7.x86_64'))
+        self.assertFalse(rpm.is_installed('kernel-3.10.0-1062.el7'))
+
+        # Installing lists the inventory again, whether or not it worked.
+        rpm.install(['glibc.i686'])
+        self.assertFalse(rpm.is_installed('glibc.i686'))
+        self.assertEqual(mock_run.call_count, 2)
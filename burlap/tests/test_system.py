@@ -16,3 +16,19 @@ def test_unsupported_system():
 
     exception_msg = str(excinfo.value)
     assert exception_msg == "Unsupported family other (foo). Supported families: debian, redhat"
+
+
+def test_cpus_fallback():
+
+    from fabric.operations import _AttributeString
+    from burlap.system import cpus
+
+    with patch('burlap.system.get_fact', return_value=4):
+        assert cpus() == 4
+
+    res = _AttributeString('2\n')
+    res.succeeded = True
+    with patch('burlap.system.get_fact', return_value=None), \
+            patch('burlap.system.run', return_value=res) as mock_run:
+        assert cpus() == 2
+        assert mock_run.call_args[0][0] == 'grep -c ^processor /proc/cpuinfo'
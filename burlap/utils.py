@@ -20,11 +20,14 @@ def run_as_root(command, *args, **kwargs):
     When connecting as root to the remote system, this will use Fabric's
     ``run`` function. In other cases, it will use ``sudo``.
     """
+    from burlap.common import command_lock, forget_changed_host_state
     if env.user == 'root':
         func = run
     else:
         func = sudo
-    return func(command, *args, **kwargs)
+    forget_changed_host_state('sudo', command)
+    with command_lock(command):
+        return func(command, *args, **kwargs)
 
 
 def get_cwd(local=False):
@@ -78,14 +81,14 @@ def oct(v, **kwargs):
             v = '0o' + v[1:]
     return eval('_oct(%s, **kwargs)' % v)
 
-def get_file_hash(fin, block_size=2**20):
+def get_file_hash(fin, block_size=2**20, algorithm='sha512'):
     """
     Iteratively builds a file hash without loading the entire file into memory.
     Designed to process an arbitrary binary file.
     """
     if isinstance(fin, basestring):
         fin = open(fin)
-    h = hashlib.sha512()
+    h = hashlib.new(algorithm)
     while True:
         data = fin.read(block_size)
         if not data:
@@ -0,0 +1,16 @@
+"""
+Keeps the files burlap writes while being imported and tested, like its task index,
+host locks and compiled templates, out of the checkout.
+"""
+import os
+import shutil
+import tempfile
+
+_data_dir = None
+
+if 'BURLAP_DATA_DIR' not in os.environ:
+    _data_dir = os.environ['BURLAP_DATA_DIR'] = tempfile.mkdtemp(prefix='burlap-test-')
+
+def pytest_unconfigure(config):
+    if _data_dir:
+        shutil.rmtree(_data_dir, ignore_errors=True)